@@ -1,5 +1,7 @@
-from typing import Sequence, Any, Generator
-from fastapi import APIRouter, Depends, HTTPException
+from typing import Sequence, Any, Generator, Optional
+from contextlib import nullcontext
+from functools import partial
+from fastapi import APIRouter, Body, Depends, HTTPException, Request
 import asyncio
 #from fastapi.responses import HTMLResponse
 
@@ -12,13 +14,38 @@ import xarray as xr
 # import asyncio
 import gc
 import json
+import uuid
 import numpy as np
 import math
 
 from xpublish import Plugin, hookimpl, Dependencies
+from xpublish.utils.api import JSONResponse
 from xpublish.utils.api import DATASET_ID_ATTR_KEY
 from datetime import datetime
 from cloudify.utils.datasethelper import *
+from cloudify.utils.chunkcache import ChunkCache
+from cloudify.utils.fileslice import (
+    FileSliceResponse,
+    advise_willneed,
+    open_file_slice,
+    reference_file,
+    reference_target,
+    resolve_file_reference,
+)
+from cloudify.utils.clients import client_id
+from cloudify.utils.limiter import BackendBusy, BackendLimiter
+from cloudify.utils.prefetch import SequentialPrefetcher
+from cloudify.utils.recall import RecallScheduler
+from cloudify.utils.refindex import open_reference_index, replace_references
+from cloudify.utils.singleflight import AsyncSingleFlight
+from cloudify.utils.ranges import (
+    content_range,
+    parse_range_header,
+    resolve_ranges,
+    not_satisfiable_response,
+    partial_response,
+    range_response_from_bytes,
+)
 
 # Constants for garbage collection
 GCLIMIT = 500
@@ -26,6 +53,9 @@ gctrigger = 0
 
 todaystring = datetime.today().strftime("%a, %d %b %Y %H:%M:%S GMT")
 
+# Concurrent requests for the same (source, key) share one backend read
+inflight = AsyncSingleFlight()
+
 
 async def kerchunk_stream_content_safe(
     fsmap: Any, key: str,
@@ -37,6 +67,85 @@ async def kerchunk_stream_content_safe(
         # Let the outer logic raise 404 before returning a StreamingResponse
         raise
          
+async def kerchunk_object_size(fsmap: Any, key: str):
+    """
+    Length of the referenced object or None if the backend cannot tell.
+
+    Inlined references also give None: their info reports the length of the
+    encoded string, e.g. of ``base64:...``, not of the payload.
+    """
+    path = fsmap._key_to_str(key)
+    try:
+        references = getattr(fsmap.fs, "references", None)
+        if references is not None and isinstance(references.get(path), (str, bytes)):
+            return None
+        info = await fsmap.fs._info(path)
+    except Exception:
+        return None
+    return info.get("size")
+
+async def kerchunk_range_response(fsmap: Any, key: str, range_header: str):
+    """
+    Answer a ranged request with offset/length reads against the reference.
+
+    Only the requested byte ranges are read from the underlying file. If the
+    object size is unknown, the full object is read and sliced instead.
+    """
+    ranges = parse_range_header(range_header)
+    size = await kerchunk_object_size(fsmap, key)
+    if size is None:
+        # inlined chunks are small, slice the decoded payload
+        data = await fsmap.asyncitem(key)
+        return range_response_from_bytes(data, range_header)
+
+    resolved = resolve_ranges(ranges, size)
+    if not resolved:
+        return not_satisfiable_response(size)
+    parts = await asyncio.gather(*(
+        fsmap.asyncitem(key, start=first, end=last + 1)
+        for first, last in resolved
+    ))
+    return partial_response(parts, resolved, size)
+
+def multipart_part(boundary: str, key: str, content: Any) -> bytes:
+    """One part of a `multipart/mixed` batch response."""
+    status = 200
+    if isinstance(content, Exception):
+        status = 404 if isinstance(content, (FileNotFoundError, KeyError)) else 503
+        content = b""
+    header = (
+        f"--{boundary}\r\n"
+        f"Content-Type: application/octet-stream\r\n"
+        f"Content-Location: {key}\r\n"
+        f"Content-Length: {len(content)}\r\n"
+        f"X-Status: {status}\r\n\r\n"
+    ).encode()
+    return header + content + b"\r\n"
+
+async def kerchunk_batch_stream(fetch_many: Any, keys: list, boundary: str, batch_size: int):
+    """
+    Stream the chunks for `keys` as `multipart/mixed` parts in request order.
+
+    Keys are fetched in batches of `batch_size` concurrent reads by the
+    coroutine function `fetch_many`. The next batch is already requested while
+    the current one is sent to the client.
+    """
+    batches = [keys[i:i + batch_size] for i in range(0, len(keys), batch_size)]
+    pending = asyncio.ensure_future(fetch_many(batches[0])) if batches else None
+    try:
+        for i, batch in enumerate(batches):
+            results = await pending
+            pending = None
+            if i + 1 < len(batches):
+                pending = asyncio.ensure_future(fetch_many(batches[i + 1]))
+            for key in batch:
+                yield multipart_part(boundary, key, results[key])
+            del results
+    finally:
+        if pending is not None:
+            pending.cancel()
+    yield f"--{boundary}--\r\n".encode()
+
 def kerchunk_stream_content_safe_sync(
     fsmap: Any, key: str
 ) -> Generator[bytes, None, None]:
@@ -47,46 +156,48 @@ def kerchunk_stream_content_safe_sync(
         # Let the outer logic raise 404 before returning a StreamingResponse
         raise
 
-def create_response_for_zmetadata(zm, key):
-    if key.endswith(".zgroup"):
-        jsondump = json.dumps({"zarr_format": 2}) #.encode("utf-8")
-        return Response(jsondump, media_type="application/json")
-
-    zmetadata = json.loads(zm.decode("utf-8"))
-    zmetadata = sanitize_for_json(zmetadata)
-    if key == ".zmetadata" or key == "zarr.json":
-        jsondump = json.dumps(zmetadata)
-        if key == ".zmetadata":
-            zmetadata["zarr_consolidated_format"] = 1
-    elif key.endswith("zarr.json"):
-        cm = zmetadata.get("consolidated_metadata",{})
-        md = cm.get("metadata",{})
-        km = key.split('/')[-2]
-        jsondump = md.get(km,{})
-    else:
-        jsondump = zmetadata["metadata"].get(key)
+ZGROUP_V2 = json.dumps({"zarr_format": 2}).encode("utf-8")
+
+def build_metadata_responses(zm: bytes, metakey: str) -> dict:
+    """
+    Prepare the response body of every metadata key of a dataset.
+
+    The consolidated metadata is parsed and sanitized once. Each per-key
+    document (`.zattrs`, `var/.zarray`, `var/zarr.json`, ...) is serialized
+    right away, so that requests only need a dict lookup.
 
-    if jsondump:
-        jsondump = json.dumps(jsondump)
+    Args:
+        zm: Content of `.zmetadata` (Zarr v2) or the root `zarr.json` (Zarr v3)
+        metakey: Either ".zmetadata" or "zarr.json"
+
+    Returns:
+        dict: Metadata key to ready-to-send JSON bytes
+    """
+    zmetadata = sanitize_for_json(json.loads(zm.decode("utf-8")))
+    responses = {}
+    if metakey == ".zmetadata":
+        zmetadata["zarr_consolidated_format"] = 1
+        responses[".zmetadata"] = json.dumps(zmetadata).encode("utf-8")
+        for k, v in zmetadata.get("metadata", {}).items():
+            responses[k] = json.dumps(v).encode("utf-8")
     else:
-        return Respose(status_code=404)
+        responses["zarr.json"] = json.dumps(zmetadata).encode("utf-8")
+        md = zmetadata.get("consolidated_metadata", {}).get("metadata", {})
+        for k, v in md.items():
+            responses[f"{k}/zarr.json"] = json.dumps(v).encode("utf-8")
+    return responses
 
-    return Response(jsondump, media_type="application/json")
-    
-async def get_zarr_config_response_async(dataset, DATASET_ID_ATTR_KEY, key, cache,fsmap):
-    cache_key = dataset.attrs.get(DATASET_ID_ATTR_KEY, "") + "/kerchunk/" + f"{key}"
-    resp = cache.get(cache_key)
-    if resp is None:
-        metakey=".zmetadata"
-        if key.endswith("zarr.json"):
-            metakey="zarr.json"
-        try:
-            zm = await fsmap.asyncitem(metakey)
-        except:
-            raise FileNotFoundError(metakey)
-        resp = create_response_for_zmetadata(zm, key)
-        cache.put(cache_key, resp, 999)
-    return resp
+def metadata_response(responses: dict, key: str):
+    if key.endswith(".zgroup"):
+        return Response(ZGROUP_V2, media_type="application/json")
+    body = responses.get(key)
+    if body is None:
+        raise FileNotFoundError(key)
+    return Response(body, media_type="application/json")
+
+def create_response_for_zmetadata(zm, key):
+    metakey = "zarr.json" if key.endswith("zarr.json") else ".zmetadata"
+    return metadata_response(build_metadata_responses(zm, metakey), key)
 
 def get_zarr_config_response(dataset, DATASET_ID_ATTR_KEY, key, cache,fsmap):
     cache_key = dataset.attrs.get(DATASET_ID_ATTR_KEY, "") + "/kerchunk/" + f"{key}"
@@ -104,12 +215,21 @@ def get_zarr_config_response(dataset, DATASET_ID_ATTR_KEY, key, cache,fsmap):
     return resp
 
 
+def _log_disk_write_error(sp, key, future):
+    """Report failed background writes to the disk tier of the chunk cache."""
+    if not future.cancelled() and future.exception() is not None:
+        print(f"Could not write {key} of {sp} to the chunk cache: {future.exception()}")
+
 def set_headers_and_clear_garbage(resp):
     global gctrigger
     # Common headers
     resp.headers["X-EERIE-Request-Id"] = "True"
     resp.headers["Last-Modified"] = todaystring
-    resp.headers["Cache-control"] = "max-age=604800"     
+    if resp.status_code < 400:
+        resp.headers["Cache-control"] = "max-age=604800"
+    else:
+        # errors like 416 or 503 may change with the next request
+        resp.headers["Cache-control"] = "no-store"
 
     if gctrigger > GCLIMIT:
         print("Run Gccollect")
@@ -143,6 +263,8 @@ def handle_exception(e, tape):
     resp.headers["X-EERIE-Request-Id"] = "True"    
     if tape:
         resp.headers["Retry-After"] = str(60*60*3)
+    elif isinstance(e, BackendBusy):
+        resp.headers["Retry-After"] = str(e.retry_after)
     return resp
 
 class KerchunkPlugin(Plugin):
@@ -156,9 +278,325 @@ class KerchunkPlugin(Plugin):
     name: str = "kerchunk"
     mapper_dict: dict = {}
 
+    # Limits for the batched multi-key endpoint
+    batch_max_keys: int = 10000
+    batch_fetch_size: int = 64
+
+    # Raw chunk byte cache, a disk tier is only used if a directory is set.
+    # The disk budget is enforced per process: server processes sharing
+    # the directory can fill it up to their number times the budget.
+    chunk_cache_memory_bytes: int = 512 * 2**20
+    chunk_cache_disk_bytes: int = 0
+    chunk_cache_dir: Optional[str] = None
+    chunk_cache_max_item_bytes: int = 64 * 2**20
+    chunk_cache: Any = None
+
+    # Serve slices of local files referenced with remote_protocol="file"
+    # straight from the file instead of reading them through fsspec, with
+    # sendfile only on ASGI servers offering zerocopysend
+    sendfile: bool = True
+
+    # Directory for compiled, memory-mapped reference indexes shared by all
+    # server processes. Indexes are only used if this is set. The in-memory
+    # JSON references of the mappers are replaced by their index.
+    reference_index_dir: Optional[str] = None
+    reference_indexes: dict = {}
+
+    # Concurrent reads per target protocol ({"https": 32}) and per mount
+    # ({"/work/bm1344": 64}). Reads above the limits are queued for at most
+    # backend_queue_timeout seconds before they fail with a 503.
+    backend_limits: dict = {}
+    mount_limits: dict = {}
+    backend_default_limit: int = 0
+    backend_queue_timeout: float = 30.0
+    backend_retry_after: int = 10
+    backend_limiter: Any = None
+
+    # Read ahead of clients walking sequentially along a chunk axis. Chunks
+    # are fetched into the chunk cache, file-backed chunks into the page
+    # cache. Disabled with prefetch_depth=0.
+    prefetch_depth: int = 0
+    prefetch_trigger: int = 2
+    prefetch_max_tasks: int = 16
+    prefetch_max_bytes: int = 256 * 2**20
+    prefetcher: Any = None
+
+    # Bulk recall of tape-backed files ordered via the -tape-order routes
+    tape_batch_size: int = 100
+    tape_window: float = 5.0
+    recall_scheduler: Any = None
+
+    # Ready-to-send metadata documents per (source, ".zmetadata"|"zarr.json")
+    metadata_responses: dict = {}
+
+    app_router_prefix: str = "/kerchunk"
+    app_router_tags: Sequence[str] = ["kerchunk"]
+
     dataset_router_prefix: str = "/kerchunk"
     dataset_router_tags: Sequence[str] = ["kerchunk"]
 
+    def get_chunk_cache(self) -> Optional[ChunkCache]:
+        if self.chunk_cache is None and (
+            self.chunk_cache_memory_bytes > 0 or self.chunk_cache_disk_bytes > 0
+        ):
+            self.chunk_cache = ChunkCache(
+                memory_bytes=self.chunk_cache_memory_bytes,
+                disk_bytes=self.chunk_cache_disk_bytes,
+                disk_dir=self.chunk_cache_dir,
+                max_item_bytes=self.chunk_cache_max_item_bytes,
+            )
+        return self.chunk_cache
+
+    def get_backend_limiter(self) -> Optional[BackendLimiter]:
+        if self.backend_limiter is None and (
+            self.backend_limits or self.mount_limits or self.backend_default_limit > 0
+        ):
+            self.backend_limiter = BackendLimiter(
+                protocol_limits=self.backend_limits,
+                mount_limits=self.mount_limits,
+                default_limit=self.backend_default_limit,
+                queue_timeout=self.backend_queue_timeout,
+                retry_after=self.backend_retry_after,
+            )
+        return self.backend_limiter
+
+    def get_recall_scheduler(self) -> RecallScheduler:
+        if self.recall_scheduler is None:
+            self.recall_scheduler = RecallScheduler(
+                batch_size=self.tape_batch_size, window=self.tape_window
+            )
+        return self.recall_scheduler
+
+    def _order_recall(self, sp, fsmap, keys):
+        """
+        Queue the files referenced by `keys` for recall.
+
+        Returns:
+            dict: Counts of requested keys, distinct files, newly queued
+            files and keys without a referenced file
+        """
+        index = self.reference_indexes.get(sp)
+        by_fs = {}
+        unknown = 0
+        for key in keys:
+            located = reference_file(fsmap, key, index=index)
+            if located is None:
+                unknown += 1
+                continue
+            target_fs, path = located
+            by_fs.setdefault(id(target_fs), (target_fs, set()))[1].add(path)
+        scheduler = self.get_recall_scheduler()
+        queued = sum(
+            scheduler.submit(sp, target_fs, paths)
+            for target_fs, paths in by_fs.values()
+        )
+        return dict(
+            keys=len(keys),
+            files=sum(len(paths) for _, paths in by_fs.values()),
+            queued=queued,
+            unknown=unknown,
+        )
+
+    def get_prefetcher(self) -> Optional[SequentialPrefetcher]:
+        if self.prefetcher is None and self.prefetch_depth > 0:
+            self.prefetcher = SequentialPrefetcher(
+                depth=self.prefetch_depth,
+                trigger=self.prefetch_trigger,
+                max_tasks=self.prefetch_max_tasks,
+                max_bytes=self.prefetch_max_bytes,
+            )
+        return self.prefetcher
+
+    def _read_ahead(self, sp, fsmap, key, client, resp):
+        """
+        Start background fetches of the chunks following `key` if `client`
+        reads the variable sequentially. Fetches only start while the
+        backend of the chunk has free slots.
+        """
+        prefetcher = self.get_prefetcher()
+        if prefetcher is None or client is None or resp.status_code >= 300:
+            return
+        stream = (client, sp)
+        keys = prefetcher.observe(stream, key)
+        if not keys:
+            return
+        nbytes = int(resp.headers.get("content-length", 0))
+        limiter = self.get_backend_limiter()
+        index = self.reference_indexes.get(sp)
+        for ahead in keys:
+            location = None
+            if self.sendfile:
+                location = resolve_file_reference(fsmap, ahead, index=index)
+            if location is not None:
+                target = ("file", location[0])
+                fetch = partial(asyncio.to_thread, advise_willneed, *location)
+            elif self.get_chunk_cache() is not None:
+                target = reference_target(fsmap, ahead, index=index)
+                fetch = partial(self._fetch_chunk, sp, fsmap, ahead)
+            else:
+                return
+            # inlined or unknown keys, e.g. beyond the end of the array
+            if target is None:
+                continue
+            if limiter is not None and not limiter.available(limiter.gates(*target)):
+                prefetcher.counters["skipped_backend"] += 1
+                return
+            if not prefetcher.schedule(stream, ahead, fetch, nbytes):
+                return
+
+    def _backend_slot(self, sp, fsmap, keys):
+        """
+        Slot of the backend limiter for reading `keys`, weighted by their
+        number. Keys without a backend, e.g. inlined ones, pass freely.
+        """
+        limiter = self.get_backend_limiter()
+        if limiter is None:
+            return nullcontext()
+        index = self.reference_indexes.get(sp)
+        names = set()
+        for key in keys:
+            target = reference_target(fsmap, key, index=index)
+            if target is not None:
+                names.update(limiter.gates(*target))
+        return limiter.slot(names, weight=len(keys))
+
+    async def load_reference_indexes(self):
+        """
+        Open the compiled reference index of every kerchunk source in
+        `mapper_dict` and let its mapper read the references from it.
+        Missing indexes are compiled first, in a thread, so the event loop
+        keeps serving while processes wait for the compile lock.
+        """
+        if not self.reference_index_dir:
+            return
+        for sp, fsmap in list(self.mapper_dict.items()):
+            if sp in self.reference_indexes:
+                continue
+            try:
+                index = await asyncio.to_thread(
+                    open_reference_index, fsmap, sp, self.reference_index_dir
+                )
+            except Exception as e:
+                print(f"Could not compile reference index for {sp}: {e}")
+                continue
+            if index is not None:
+                self.reference_indexes[sp] = index
+                replace_references(fsmap, index)
+
+    def _inline_chunk(self, sp, key):
+        """Bytes of inlined references from the compiled index, else None."""
+        index = self.reference_indexes.get(sp)
+        if index is None:
+            return None
+        ref = index.lookup(key)
+        return ref if isinstance(ref, bytes) else None
+
+    async def _load_metadata_responses(self, sp, fsmap, metakey):
+        try:
+            zm = await fsmap.asyncitem(metakey)
+        except Exception:
+            raise FileNotFoundError(metakey)
+        responses = build_metadata_responses(zm, metakey)
+        self.metadata_responses[(sp, metakey)] = responses
+        return responses
+
+    async def _metadata_response(self, sp, fsmap, key):
+        """
+        Serve a metadata key from the precomputed responses of the dataset.
+
+        The responses are built on first touch, concurrent first requests
+        share one fetch of the consolidated metadata.
+        """
+        metakey = "zarr.json" if key.endswith("zarr.json") else ".zmetadata"
+        responses = self.metadata_responses.get((sp, metakey))
+        if responses is None and not key.endswith(".zgroup"):
+            responses = await inflight.do(
+                (sp, metakey), self._load_metadata_responses, sp, fsmap, metakey
+            )
+        return metadata_response(responses or {}, key)
+
+    async def _cached_chunk(self, sp, key):
+        """Look up a chunk in the memory tier and then in the disk tier."""
+        chunk_cache = self.get_chunk_cache()
+        if chunk_cache is None:
+            return None
+        data = chunk_cache.get_memory(sp, key)
+        if data is None and chunk_cache.disk_enabled:
+            data = await asyncio.to_thread(chunk_cache.get_disk, sp, key)
+        if data is None:
+            chunk_cache.record_miss()
+        return data
+
+    def _cache_chunk(self, sp, key, data):
+        chunk_cache = self.get_chunk_cache()
+        if chunk_cache is None:
+            return
+        chunk_cache.put_memory(sp, key, data)
+        if chunk_cache.disk_enabled:
+            # do not let the client wait for the disk write
+            future = asyncio.get_running_loop().run_in_executor(
+                None, chunk_cache.put_disk, sp, key, data
+            )
+            future.add_done_callback(partial(_log_disk_write_error, sp, key))
+
+    async def _fetch_and_cache_chunk(self, sp, fsmap, key):
+        async with self._backend_slot(sp, fsmap, [key]):
+            data = await fsmap.asyncitem(key)
+        self._cache_chunk(sp, key, data)
+        return data
+
+    async def _fetch_chunk(self, sp, fsmap, key):
+        data = self._inline_chunk(sp, key)
+        if data is not None:
+            return data
+        data = await self._cached_chunk(sp, key)
+        if data is None:
+            data = await inflight.do(
+                (sp, key), self._fetch_and_cache_chunk, sp, fsmap, key
+            )
+        return data
+
+    async def _fetch_chunks(self, sp, fsmap, keys):
+        results = {}
+        missing = []
+        for key in keys:
+            data = await self._cached_chunk(sp, key)
+            if data is None:
+                missing.append(key)
+            else:
+                results[key] = data
+        if missing:
+            try:
+                async with self._backend_slot(sp, fsmap, missing):
+                    fetched = await fsmap.asyncitems(missing)
+            except BackendBusy as e:
+                fetched = {key: e for key in missing}
+            for key, data in fetched.items():
+                if not isinstance(data, Exception):
+                    self._cache_chunk(sp, key, data)
+            results.update(fetched)
+        return results
+
+    @hookimpl
+    def app_router(self, deps: Dependencies):
+        router = APIRouter(
+            prefix=self.app_router_prefix, tags=list(self.app_router_tags)
+        )
+
+        @router.get("/stats")
+        def get_stats():
+            """Counters of the kerchunk chunk serving machinery."""
+            chunk_cache = self.get_chunk_cache()
+            return JSONResponse(dict(
+                chunk_cache=chunk_cache.stats() if chunk_cache else None,
+                inflight=dict(inflight.counters, in_flight=inflight.in_flight),
+                backends=self.backend_limiter.stats() if self.backend_limiter else None,
+                prefetch=self.prefetcher.stats() if self.prefetcher else None,
+                recall=self.recall_scheduler.stats() if self.recall_scheduler else None,
+            ))
+
+        return router
+
     @hookimpl
     def dataset_router(self, deps: Dependencies):
         router = APIRouter(
@@ -170,11 +608,14 @@ class KerchunkPlugin(Plugin):
         @router.api_route("/{key:path}", methods=["GET", "HEAD"])
         async def get_chunk(
             key: str,
+            request: Request,
             dataset: xr.Dataset = Depends(deps.dataset),
             cache: cachey.Cache = Depends(deps.cache),
         ):
             return await self._handle_request_async(
-                key, dataset, cache, tape=dataset.attrs.get("from_tape")
+                key, dataset, cache, tape=dataset.attrs.get("from_tape"),
+                range_header=request.headers.get("range"),
+                client=client_id(request),
             )
        
         # ------------------------------
@@ -188,6 +629,21 @@ class KerchunkPlugin(Plugin):
         #):            
         #    return self._handle_request_sync(key,dataset,cache)
         
+        @router.post("-batch")
+        async def get_chunk_batch(
+            keys: list[str] = Body(...),
+            dataset: xr.Dataset = Depends(deps.dataset),
+        ):
+            """
+            Fetch many chunks in one request.
+
+            The body is a JSON list of chunk keys. The response is a
+            `multipart/mixed` stream with one part per key in request order.
+            Each part carries the key in `Content-Location` and the per-key
+            status in `X-Status`.
+            """
+            return await self._handle_request_batch(keys, dataset)
+
         @router.api_route("-tape-order/{key:path}", methods=["GET", "HEAD"])
         async def order_tape_chunk(
             key: str,
@@ -198,9 +654,55 @@ class KerchunkPlugin(Plugin):
             return await self._handle_request_tape_order(
                 key, dataset, cache, tape=dataset.attrs.get("from_tape")
             )
+
+        @router.post("-tape-order")
+        async def order_tape_chunks(
+            keys: list[str] = Body(...),
+            dataset: xr.Dataset = Depends(deps.dataset),
+        ):
+            """
+            Order the recall of many chunks from tape.
+
+            The body is a JSON list of chunk keys. Their files are recalled in
+            bulk, sorted by tape position. Use `-tape-status` to follow the
+            progress.
+            """
+            sp = get_source(dataset.encoding)
+            if len(keys) > self.batch_max_keys:
+                raise HTTPException(
+                    status_code=413,
+                    detail=f"At most {self.batch_max_keys} keys per tape order"
+                )
+            return JSONResponse(self._order_recall(sp, self.mapper_dict[sp], keys))
+
+        @router.get("-tape-status")
+        def tape_status(dataset: xr.Dataset = Depends(deps.dataset)):
+            """Staging progress of the files ordered for this dataset."""
+            sp = get_source(dataset.encoding)
+            return JSONResponse(self.get_recall_scheduler().status(sp))
         
         return router
         
+    async def _handle_request_batch(self, keys, dataset):
+        sp = get_source(dataset.encoding)
+        fsmap = self.mapper_dict[sp]
+        if not keys:
+            raise HTTPException(status_code=400, detail="No keys requested")
+        if len(keys) > self.batch_max_keys:
+            raise HTTPException(
+                status_code=413,
+                detail=f"At most {self.batch_max_keys} keys per batch request"
+            )
+        boundary = uuid.uuid4().hex
+        async def fetch_many(batch):
+            return await self._fetch_chunks(sp, fsmap, batch)
+
+        resp = StreamingResponse(
+            kerchunk_batch_stream(fetch_many, keys, boundary, self.batch_fetch_size),
+            media_type=f"multipart/mixed; boundary={boundary}",
+        )
+        return set_headers_and_clear_garbage(resp)
+
     async def _handle_request_tape_order(self, key, dataset, cache, tape=False):
         global gctrigger
         sp = get_source(dataset.encoding)
@@ -210,17 +712,14 @@ class KerchunkPlugin(Plugin):
         try:
         #if True:
             if any(a in key for a in [".zmetadata", ".zarray", ".zgroup", ".zattrs", "zarr.json"]):
-                resp = await get_zarr_config_response_async(
-                        dataset, DATASET_ID_ATTR_KEY, key, cache,fsmap
-                        )
+                resp = await self._metadata_response(sp, fsmap, key)
             else:
                 gen = None
                 if not any(b in key for b in ["time","lat/","lon/"]):            
                     resp = Response(status_code=404)                    
                     try:
                     #if True:
-                        gen = kerchunk_stream_content_safe(fsmap, key, start=0,end=1)
-                        first = await anext(gen)
+                        self._order_recall(sp, fsmap, [key])
                     except Exception as e:
                         print(e)
                         pass
@@ -234,7 +733,9 @@ class KerchunkPlugin(Plugin):
             resp = handle_exception(e, tape)
         return resp   
                     
-    async def _handle_request_async(self, key, dataset, cache, tape=False):
+    async def _handle_request_async(
+        self, key, dataset, cache, tape=False, range_header=None, client=None
+    ):
         global gctrigger
 
         sp = get_source(dataset.encoding)
@@ -248,13 +749,12 @@ class KerchunkPlugin(Plugin):
         try:
         #if True:
             if any(a in key for a in [".zmetadata", ".zarray", ".zgroup", ".zattrs", "zarr.json"]):
-                resp = await get_zarr_config_response_async(
-                        dataset, DATASET_ID_ATTR_KEY, key, cache,fsmap
-                        )                
+                resp = await self._metadata_response(sp, fsmap, key)
             else:
-                gen = kerchunk_stream_content_safe(fsmap, key)
-                full_stream = await get_full_stream(gen)
-                resp = StreamingResponse(full_stream(), media_type="application/octet-stream")
+                resp = await self._file_slice_response(sp, fsmap, key, range_header)
+                if resp is None:
+                    resp = await self._chunk_response(sp, fsmap, key, range_header)
+                self._read_ahead(sp, fsmap, key, client, resp)
 
             fsmap.fs.dircache.clear()
             resp = set_headers_and_clear_garbage(resp)            
@@ -263,6 +763,73 @@ class KerchunkPlugin(Plugin):
             resp = handle_exception(e, tape)
         return resp   
 
+    async def _file_slice_response(self, sp, fsmap, key, range_header=None):
+        """
+        Response streaming the slice of a local file a key references,
+        see `FileSliceResponse`.
+
+        Returns None if the key cannot be served this way, e.g. for inlined
+        data, remote targets or multi-range requests.
+        """
+        if not self.sendfile:
+            return None
+        location = resolve_file_reference(
+            fsmap, key, index=self.reference_indexes.get(sp)
+        )
+        if location is None:
+            return None
+        path, offset, length = location
+
+        ranges = parse_range_header(range_header)
+        status_code = 200
+        if ranges is not None:
+            resolved = resolve_ranges(ranges, length)
+            if not resolved:
+                return not_satisfiable_response(length)
+            if len(resolved) > 1:
+                return None
+            first, last = resolved[0]
+            status_code = 206
+
+        # the slot is held until the file slice is sent
+        on_close = None
+        limiter = self.get_backend_limiter()
+        if limiter is not None:
+            token = await limiter.acquire(limiter.gates("file", path))
+            on_close = lambda: limiter.release(token)
+
+        # open here, so a missing, unreadable or truncated file is answered
+        # by handle_exception like any other backend error
+        try:
+            f = await asyncio.to_thread(open_file_slice, path, offset, length)
+        except BaseException:
+            if on_close is not None:
+                on_close()
+            raise
+        if status_code == 200:
+            resp = FileSliceResponse(f, offset, length, on_close=on_close)
+        else:
+            resp = FileSliceResponse(
+                f, offset + first, last - first + 1, status_code=206,
+                on_close=on_close,
+            )
+            resp.headers["Content-Range"] = content_range(first, last, length)
+        resp.headers["Accept-Ranges"] = "bytes"
+        return resp
+
+    async def _chunk_response(self, sp, fsmap, key, range_header=None):
+        if parse_range_header(range_header) is not None:
+            data = await self._cached_chunk(sp, key)
+            if data is not None:
+                return range_response_from_bytes(data, range_header)
+            async with self._backend_slot(sp, fsmap, [key]):
+                return await kerchunk_range_response(fsmap, key, range_header)
+
+        data = await self._fetch_chunk(sp, fsmap, key)
+        resp = Response(data, media_type="application/octet-stream")
+        resp.headers["Accept-Ranges"] = "bytes"
+        return resp
+
     def _handle_request_sync(self, key, dataset, cache):
         global gctrigger
         if "source" not in dataset.encoding:
@@ -0,0 +1,320 @@
+from typing import Sequence, Any, Optional
+from collections import OrderedDict
+from fastapi import APIRouter, Body, Depends, HTTPException
+from fastapi.responses import JSONResponse
+import hashlib
+import json
+import os
+import re
+import tempfile
+import weakref
+
+import xarray as xr
+
+from xpublish import Plugin, hookimpl, Dependencies
+from xpublish.utils.api import DATASET_ID_ATTR_KEY
+
+SUBSET_ID = re.compile(r"^(?P<parent>.+)\.subset-(?P<digest>[0-9a-f]{12})$")
+
+
+def normalize_subset_spec(spec: dict) -> dict:
+    """
+    Canonical form of a subset specification.
+
+    A specification has the optional keys
+
+    - ``variables``: list of data variables to keep
+    - ``isel``: ``{dim: index}`` or ``{dim: [start, stop]}``
+    - ``sel``: ``{dim: label}`` or ``{dim: [first, last]}``, e.g. a time
+      range or a lat/lon box
+
+    Raises:
+        ValueError: for unknown keys or malformed selections
+    """
+    unknown = set(spec) - {"variables", "isel", "sel"}
+    if unknown:
+        raise ValueError(f"Unknown subset keys {sorted(unknown)}")
+    normalized = {}
+    if spec.get("variables"):
+        variables = spec["variables"]
+        if isinstance(variables, str):
+            variables = [variables]
+        normalized["variables"] = sorted(set(variables))
+    for method in ["isel", "sel"]:
+        selection = spec.get(method) or {}
+        if not isinstance(selection, dict):
+            raise ValueError(f"{method} has to map dimensions to selections")
+        for dim, value in selection.items():
+            if isinstance(value, (list, tuple)) and len(value) != 2:
+                raise ValueError(f"{method} range of {dim} needs two values")
+            if method == "isel" and not all(
+                isinstance(v, int) or v is None
+                for v in (value if isinstance(value, (list, tuple)) else [value])
+            ):
+                raise ValueError(f"isel of {dim} needs integers")
+        if selection:
+            normalized[method] = {
+                dim: list(value) if isinstance(value, (list, tuple)) else value
+                for dim, value in sorted(selection.items())
+            }
+    return normalized
+
+
+def subset_id(parent_id: str, spec: dict) -> str:
+    """Stable id of the subset `spec` of the dataset `parent_id`."""
+    dumped = json.dumps([parent_id, spec], sort_keys=True, default=str)
+    digest = hashlib.sha256(dumped.encode("utf-8")).hexdigest()[:12]
+    return f"{parent_id}.subset-{digest}"
+
+
+def _sel_range(ds: xr.Dataset, dim: str, first: Any, last: Any) -> slice:
+    # label slices only select in the order of the coordinate, e.g. lat
+    # often runs from north to south
+    if dim in ds.indexes and first is not None and last is not None:
+        index = ds.indexes[dim]
+        if index.is_monotonic_decreasing and not index.is_monotonic_increasing:
+            first, last = (last, first) if first < last else (first, last)
+        elif first > last:
+            first, last = last, first
+    return slice(first, last)
+
+
+def apply_subset(ds: xr.Dataset, spec: dict) -> xr.Dataset:
+    """
+    Select the normalized subset `spec` from `ds`.
+
+    Dask-backed variables are rechunked to the chunk shape of the parent,
+    starting at the first element of the subset, so the view has a regular
+    chunk grid aligned to the subset.
+
+    Raises:
+        ValueError: for unknown variables or dimensions and empty subsets
+    """
+    chunksizes = {
+        var: ds[var].data.chunksize
+        for var in ds.variables
+        if hasattr(ds[var].data, "chunksize")
+    }
+    variables = spec.get("variables")
+    if variables:
+        missing = [v for v in variables if v not in ds.data_vars]
+        if missing:
+            raise ValueError(f"Variables {missing} not in dataset")
+        ds = ds[variables]
+    for method in ["isel", "sel"]:
+        selection = spec.get(method, {})
+        missing = [dim for dim in selection if dim not in ds.dims]
+        if missing:
+            raise ValueError(f"Dimensions {missing} not in dataset")
+        indexers = {}
+        for dim, value in selection.items():
+            if not isinstance(value, list):
+                # keep the dimension for a single index or label
+                indexers[dim] = [value]
+            elif method == "isel":
+                indexers[dim] = slice(*value)
+            else:
+                indexers[dim] = _sel_range(ds, dim, *value)
+        try:
+            ds = getattr(ds, method)(indexers)
+        except (KeyError, IndexError, TypeError) as e:
+            raise ValueError(f"Invalid {method}: {e}")
+    empty = [dim for dim, size in ds.sizes.items() if size == 0]
+    if empty:
+        raise ValueError(f"Subset is empty along {empty}")
+
+    # variables not touched by the selection are shared with the parent
+    ds = ds.copy()
+    for var in ds.variables:
+        data = ds[var].variable.data
+        if var in chunksizes and data.ndim == len(chunksizes[var]):
+            ds[var].variable.data = data.rechunk(
+                tuple(min(c, n) for c, n in zip(chunksizes[var], data.shape))
+            )
+        # chunk encodings of the parent do not fit the view
+        ds[var].encoding.pop("chunks", None)
+        ds[var].encoding.pop("preferred_chunks", None)
+    return ds
+
+
+class SubsetPlugin(Plugin):
+    """
+    Register server-side subsets of datasets as virtual datasets.
+
+    POST a subset specification (see :func:`normalize_subset_spec`) to
+    ``/datasets/{id}/subset``. The view is served under the stable id
+    ``{id}.subset-<hash>`` through the same endpoints as its parent, e.g.
+    ``/datasets/{id}.subset-<hash>/zarr``. Identical specifications give
+    the same id and reuse the view. Specifications are persisted in
+    `subset_dir`, so all server processes can open views registered by one
+    of them.
+
+    Views are only resolved by their id, they are not part of the dataset
+    listing. At most `max_specs` specifications are kept, the least recently
+    used ones are dropped, also from `subset_dir`. The parent of a view is
+    looked up in `datasets` on each access, so a reloaded parent replaces
+    the views of the old one.
+    """
+
+    name: str = "subset"
+
+    # Parent datasets by id, set like KerchunkPlugin.mapper_dict
+    datasets: dict = {}
+
+    subset_dir: Optional[str] = None
+    max_views: int = 256
+    max_specs: int = 4096
+    views: Any = None
+    specs: Any = None
+
+    dataset_router_prefix: str = "/subset"
+    dataset_router_tags: Sequence[str] = ["subset"]
+
+    def _spec_path(self, view_id: str) -> Optional[str]:
+        if not self.subset_dir:
+            return None
+        return os.path.join(self.subset_dir, view_id + ".json")
+
+    def _remember_spec(self, view_id: str, entry: tuple[str, dict]):
+        if self.specs is None:
+            self.specs = OrderedDict()
+        self.specs[view_id] = entry
+        self.specs.move_to_end(view_id)
+        while len(self.specs) > self.max_specs:
+            self.specs.popitem(last=False)
+
+    def _store_spec(self, view_id: str, parent_id: str, spec: dict):
+        self._remember_spec(view_id, (parent_id, spec))
+        path = self._spec_path(view_id)
+        if path is None:
+            return
+        if os.path.exists(path):
+            self._touch(path)
+            return
+        try:
+            os.makedirs(self.subset_dir, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(prefix="tmp", dir=self.subset_dir)
+            with os.fdopen(fd, "w") as f:
+                json.dump(dict(parent=parent_id, spec=spec), f)
+            os.replace(tmp, path)
+        except Exception as e:
+            print(f"Could not persist subset {view_id}: {e}")
+            return
+        self._evict_stored_specs()
+
+    @staticmethod
+    def _touch(path: str):
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def _evict_stored_specs(self):
+        """Remove the least recently used specifications beyond `max_specs`."""
+        entries = []
+        for entry in os.scandir(self.subset_dir):
+            if not entry.name.endswith(".json") or entry.name.startswith("tmp"):
+                continue
+            try:
+                entries.append((entry.stat().st_mtime, entry.path))
+            except FileNotFoundError:
+                continue
+        entries.sort()
+        for _, path in entries[:max(len(entries) - self.max_specs, 0)]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _load_spec(self, view_id: str) -> Optional[tuple[str, dict]]:
+        entry = self.specs.get(view_id) if self.specs is not None else None
+        if entry is not None:
+            self.specs.move_to_end(view_id)
+            return entry
+        path = self._spec_path(view_id)
+        if path is None:
+            return None
+        try:
+            with open(path) as f:
+                stored = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        self._touch(path)
+        entry = (stored["parent"], stored["spec"])
+        self._remember_spec(view_id, entry)
+        return entry
+
+    def get_view(self, view_id: str, parent: xr.Dataset, spec: dict) -> xr.Dataset:
+        """The view `view_id` of `parent`, created on first use."""
+        if self.views is None:
+            self.views = OrderedDict()
+        cached = self.views.get(view_id)
+        if cached is not None and cached[0]() is parent:
+            self.views.move_to_end(view_id)
+            return cached[1]
+        view = apply_subset(parent, spec)
+        view.attrs = dict(parent.attrs)
+        view.attrs["subset_of"] = parent.attrs.get(DATASET_ID_ATTR_KEY, "")
+        view.attrs["subset"] = json.dumps(spec, default=str)
+        view.attrs[DATASET_ID_ATTR_KEY] = view_id
+        # the raw references of the parent do not match the view
+        view.encoding = {
+            k: v for k, v in parent.encoding.items() if k != "source"
+        }
+        # views of a replaced parent are rebuilt
+        self.views[view_id] = (weakref.ref(parent), view)
+        self.views.move_to_end(view_id)
+        while len(self.views) > self.max_views:
+            self.views.popitem(last=False)
+        return view
+
+    @hookimpl
+    def get_dataset(self, dataset_id: str):
+        if SUBSET_ID.match(dataset_id) is None:
+            return None
+        entry = self._load_spec(dataset_id)
+        if entry is None:
+            return None
+        parent_id, spec = entry
+        parent = self.datasets.get(parent_id)
+        if parent is None:
+            return None
+        try:
+            return self.get_view(dataset_id, parent, spec)
+        except ValueError as e:
+            print(f"Could not open subset {dataset_id}: {e}")
+            return None
+
+    @hookimpl
+    def dataset_router(self, deps: Dependencies):
+        router = APIRouter(
+            prefix=self.dataset_router_prefix, tags=list(self.dataset_router_tags)
+        )
+
+        @router.post("")
+        def create_subset(
+            spec: dict = Body(...),
+            dataset: xr.Dataset = Depends(deps.dataset),
+        ):
+            """Register a subset view of the dataset and return its id."""
+            parent_id = dataset.attrs.get(DATASET_ID_ATTR_KEY, "")
+            try:
+                spec = normalize_subset_spec(spec)
+                view_id = subset_id(parent_id, spec)
+                view = self.get_view(view_id, dataset, spec)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            self._store_spec(view_id, parent_id, spec)
+            return JSONResponse(
+                dict(
+                    id=view_id,
+                    parent=parent_id,
+                    spec=spec,
+                    sizes=dict(view.sizes),
+                    variables=list(view.data_vars),
+                    nbytes=int(view.nbytes),
+                    url=f"/datasets/{view_id}/zarr",
+                )
+            )
+
+        return router
@@ -0,0 +1,419 @@
+from typing import Sequence, Any, Optional
+from functools import partial
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.responses import Response
+import asyncio
+import math
+import weakref
+
+import cachey
+import numpy as np
+import xarray as xr
+
+from xpublish import Plugin, hookimpl, Dependencies
+from xpublish.utils.api import DATASET_ID_ATTR_KEY, JSONResponse
+from xpublish.utils.zarr import (
+    ChunkTooLarge,
+    DaskArrayType,
+    ZARR_METADATA_KEY,
+    array_meta_key,
+    as_buffer,
+    attrs_key,
+    chunk_templates,
+    classified_flight,
+    compute_tasks_async,
+    get_data_chunk_async,
+    get_zmetadata,
+    get_zvariables,
+    group_meta_key,
+    jsonify_zmetadata,
+    memory_admission,
+    request_classifier,
+    zmetadata_fingerprint,
+)
+from cloudify.utils.chunkcache import ChunkCache
+from cloudify.utils.clients import client_id
+from cloudify.utils.limiter import BackendBusy
+from cloudify.utils.sharding import shard_chunks, shard_factors
+from cloudify.utils.singleflight import AsyncSingleFlight
+
+# Concurrent requests for the same group of layout chunks or the same
+# chunk share one computation
+layout_flights = AsyncSingleFlight()
+
+
+def rechunk_layout(ds: xr.Dataset, chunks: dict, chunk_bytes: int) -> xr.Dataset:
+    """
+    Copy of `ds` with the dask variables rechunked to `chunks`.
+
+    Dimensions of a variable which are not in `chunks` are chunked "auto"
+    so that a chunk stays below `chunk_bytes`. Variables without any of the
+    dimensions in `chunks` keep their chunks.
+    """
+    layout = ds.copy()
+    for var in layout.variables:
+        variable = layout[var].variable
+        if not isinstance(variable.data, DaskArrayType):
+            continue
+        if not any(dim in chunks for dim in variable.dims):
+            continue
+        variable.data = variable.data.rechunk(
+            {i: chunks.get(dim, "auto") for i, dim in enumerate(variable.dims)},
+            block_size_limit=chunk_bytes,
+            # chunks are computed one by one from culled graphs, a p2p
+            # rechunk would run the full shuffle for each of them
+            method="tasks",
+        )
+        variable.encoding.pop("chunks", None)
+        variable.encoding.pop("preferred_chunks", None)
+    return layout
+
+
+def fan_in_shape(source_chunks: tuple, target_chunks: tuple) -> tuple:
+    """
+    Largest extent along each dimension of the source chunks which a single
+    target chunk reads.
+    """
+    shape = []
+    for source, target in zip(source_chunks, target_chunks):
+        bounds = np.cumsum((0,) + tuple(source))
+        largest = start = 0
+        for size in target:
+            first = np.searchsorted(bounds, start, side="right") - 1
+            last = np.searchsorted(bounds, start + size, side="left")
+            largest = max(largest, int(bounds[last] - bounds[first]))
+            start += size
+        shape.append(largest)
+    return tuple(shape)
+
+
+class TimeseriesPlugin(Plugin):
+    """
+    Time-series layout of the dask-served datasets.
+
+    Served datasets are mostly chunked for maps, a few time steps of the
+    full field per chunk, so a point time-series touches thousands of
+    chunks. Under /zarr-timeseries, each dataset is served as zarr with an
+    alternative chunk grid, by default the full time axis and the other
+    dimensions chunked to about `chunk_bytes`.
+
+    A layout chunk reads all source chunks it overlaps, for the default grid
+    all time steps of a variable. So a request materializes the group of
+    neighbouring layout chunks around its chunk, up to `group_bytes`, in one
+    dask computation sharing the reads of the source chunks, and writes them
+    to the chunk cache, the disk tier if one is set. Variables the cache
+    cannot keep are computed chunk by chunk instead. Variables whose layout
+    chunks read more than `max_fan_in_bytes` of the source each are
+    rejected. Computations are admitted in the interactive or bulk queue of
+    their requests, as for /zarr.
+    """
+
+    name: str = "zarr-timeseries"
+
+    # Alternative chunk grid, -1 for the full dimension
+    chunks: dict = {"time": -1}
+    chunk_bytes: int = 32 * 2**20
+
+    # Materialized layout chunks, a disk tier is only used if a directory is set
+    cache_memory_bytes: int = 512 * 2**20
+    cache_disk_bytes: int = 0
+    cache_dir: Optional[str] = None
+    cache: Any = None
+
+    # Bound of the source bytes a single layout chunk reads
+    max_fan_in_bytes: int = 8 * 2**30
+
+    # Decoded bytes of the layout chunks materialized together
+    group_bytes: int = 1024 * 2**20
+
+    # Layouts per served dataset, dropped with the dataset
+    layouts: Any = None
+
+    dataset_router_prefix: str = "/zarr-timeseries"
+    dataset_router_tags: Sequence[str] = ["zarr-timeseries"]
+
+    def get_cache(self) -> ChunkCache:
+        if self.cache is None:
+            self.cache = ChunkCache(
+                memory_bytes=self.cache_memory_bytes,
+                disk_bytes=self.cache_disk_bytes,
+                disk_dir=self.cache_dir,
+                max_item_bytes=4 * self.chunk_bytes,
+            )
+        return self.cache
+
+    def get_layout(self, dataset: xr.Dataset) -> tuple[xr.Dataset, str]:
+        """
+        Layout of `dataset` and the key of its chunks in the chunk cache.
+
+        The key contains a fingerprint of the layout, so chunks cached for a
+        changed dataset or chunk grid are not served.
+        """
+        if self.layouts is None:
+            self.layouts = {}
+        entry = self.layouts.get(id(dataset))
+        if entry is not None and entry[0]() is dataset:
+            return entry[1]
+        layout = rechunk_layout(dataset, self.chunks, self.chunk_bytes)
+        layout_id = dataset.attrs.get(DATASET_ID_ATTR_KEY, "") + ".timeseries"
+        layout.attrs[DATASET_ID_ATTR_KEY] = layout_id
+        source = layout_id + "-" + zmetadata_fingerprint(layout)[:16]
+
+        key = id(dataset)
+        ref = weakref.ref(dataset, lambda _: self.layouts.pop(key, None))
+        self.layouts[key] = (ref, (layout, source))
+        return layout, source
+
+    def _metadata(self, dataset: xr.Dataset, cache: cachey.Cache) -> tuple:
+        layout, source = self.get_layout(dataset)
+        zvariables = get_zvariables(layout, cache)
+        zmetadata = get_zmetadata(layout, cache, zvariables)
+        return layout, source, zvariables, zmetadata
+
+    def _fan_in_bytes(self, dataset: xr.Dataset, layout: xr.Dataset, var: str) -> int:
+        """Estimated worker memory of computing a layout chunk of `var`."""
+        source, target = dataset[var].data, layout[var].data
+        if not isinstance(source, DaskArrayType):
+            return 0
+        nbytes = memory_admission.estimate(
+            fan_in_shape(source.chunks, target.chunks), target.dtype
+        )
+        if nbytes > self.max_fan_in_bytes:
+            raise ChunkTooLarge(nbytes, self.max_fan_in_bytes)
+        return nbytes
+
+    def _groups(self, dataset: xr.Dataset, layout: xr.Dataset, var: str) -> Optional[tuple]:
+        """
+        (group factors, bytes to admit per group) to materialize `var` with,
+        None if the chunk cache could not keep the variable.
+        """
+        source, target = dataset[var].data, layout[var].data
+        chunk_bytes = target.dtype.itemsize * int(
+            np.prod([max(c) for c in target.chunks])
+        )
+        chunk_cache = self.get_cache()
+        budget = chunk_cache.disk_bytes if chunk_cache.disk_enabled else chunk_cache.memory_bytes
+        if (
+            chunk_bytes > chunk_cache.max_item_bytes
+            or chunk_bytes * math.prod(target.numblocks) > budget
+        ):
+            return None
+        factors = shard_factors(
+            [max(c) for c in target.chunks],
+            target.numblocks,
+            target.dtype.itemsize,
+            max_chunks=math.prod(target.numblocks),
+            max_bytes=self.group_bytes,
+        )
+        group_chunks = [
+            [sum(c[i:i + f]) for i in range(0, len(c), f)]
+            for c, f in zip(target.chunks, factors)
+        ]
+        nbytes = memory_admission.estimate(
+            fan_in_shape(source.chunks, group_chunks), target.dtype
+        )
+        capacity = memory_admission.capacity()
+        if nbytes > self.max_fan_in_bytes or (capacity is not None and nbytes > capacity):
+            # the group would not fit where its chunks alone do
+            factors = (1,) * target.ndim
+            nbytes = self._fan_in_bytes(dataset, layout, var)
+        return factors, nbytes
+
+    async def get_chunk(
+        self,
+        client: Any,
+        dataset: xr.Dataset,
+        cache: cachey.Cache,
+        var: str,
+        chunk: str,
+        request_class: str,
+    ) -> bytes:
+        """
+        Encoded layout chunk `chunk` of `var`, computed in the admission
+        queue of the most urgent `request_class` waiting for it.
+        """
+        layout, source, zvariables, zmetadata = await asyncio.to_thread(
+            self._metadata, dataset, cache
+        )
+        chunk_cache = self.get_cache()
+        key = f"{var}/{chunk}"
+        data = chunk_cache.get_memory(source, key)
+        if data is None:
+            data = await asyncio.to_thread(chunk_cache.get_disk, source, key)
+        if data is not None:
+            return data
+        chunk_cache.record_miss()
+        nbytes = self._fan_in_bytes(dataset, layout, var)
+
+        da = zvariables[var].data
+        rechunked = isinstance(da, DaskArrayType) and da.chunks != dataset[var].data.chunks
+        groups = (
+            self._groups(dataset, layout, var)
+            if rechunked and getattr(client, "asynchronous", False)
+            else None
+        )
+        if groups is not None:
+            factors, group_nbytes = groups
+            ikeys = tuple(map(int, chunk.split(".")))
+            if len(ikeys) != da.ndim or any(
+                not 0 <= i < n for i, n in zip(ikeys, da.numblocks)
+            ):
+                raise IndexError(f"Chunk {ikeys} out of range {da.numblocks}")
+            group = tuple(i // f for i, f in zip(ikeys, factors))
+            await classified_flight(
+                layout_flights,
+                (source, var, group),
+                request_class,
+                partial(
+                    self._materialize, client, source, zvariables, zmetadata,
+                    var, group, factors, group_nbytes,
+                ),
+            )
+            data = chunk_cache.get_memory(source, key)
+            if data is None:
+                data = await asyncio.to_thread(chunk_cache.get_disk, source, key)
+            if data is not None:
+                return data
+        # not rechunked, too large for the cache or already evicted
+        return await classified_flight(
+            layout_flights,
+            (source, key),
+            request_class,
+            partial(
+                self._compute_chunk, client, layout, source, zvariables,
+                zmetadata, var, chunk, nbytes,
+            ),
+        )
+
+    async def _materialize(
+        self, client, source, zvariables, zmetadata, var, group, factors, nbytes, priority=0
+    ):
+        arr_meta = zmetadata["metadata"][f"{var}/{array_meta_key}"]
+        da = zvariables[var].data
+        ikeys = [ik for _, ik in shard_chunks(group, factors, da.numblocks)]
+        tasks = await asyncio.to_thread(
+            lambda: [
+                chunk_templates.get(
+                    da,
+                    ik,
+                    filters=arr_meta["filters"],
+                    compressor=arr_meta["compressor"],
+                    out_shape=arr_meta["chunks"],
+                )
+                for ik in ikeys
+            ]
+        )
+        chunk_cache = self.get_cache()
+        put = chunk_cache.put_disk if chunk_cache.disk_enabled else chunk_cache.put_memory
+        async for i, data in compute_tasks_async(
+            client, tasks, nbytes=nbytes, priority=priority
+        ):
+            key = f"{var}/" + ".".join(map(str, ikeys[i]))
+            await asyncio.to_thread(put, source, key, bytes(as_buffer(data)))
+
+    async def _compute_chunk(
+        self, client, layout, source, zvariables, zmetadata, var, chunk, nbytes=None, priority=0
+    ) -> bytes:
+        arr_meta = zmetadata["metadata"][f"{var}/{array_meta_key}"]
+        data = await get_data_chunk_async(
+            client,
+            zvariables[var].data,
+            chunk,
+            out_shape=arr_meta["chunks"],
+            filters=arr_meta["filters"],
+            compressor=arr_meta["compressor"],
+            batch_key=layout.attrs[DATASET_ID_ATTR_KEY],
+            nbytes=nbytes or None,
+            priority=priority,
+        )
+        data = bytes(as_buffer(data))
+        await asyncio.to_thread(self.get_cache().put, source, f"{var}/{chunk}", data)
+        return data
+
+    @hookimpl
+    def dataset_router(self, deps: Dependencies) -> APIRouter:
+        router = APIRouter(
+            prefix=self.dataset_router_prefix,
+            tags=list(self.dataset_router_tags),
+        )
+
+        @router.api_route(f"/{ZARR_METADATA_KEY}", methods=["GET", "HEAD"])
+        async def get_zarr_metadata(
+            dataset: xr.Dataset = Depends(deps.dataset),
+            cache: cachey.Cache = Depends(deps.cache),
+        ):
+            """Consolidated Zarr metadata of the time-series layout."""
+            layout, _, _, zmetadata = await asyncio.to_thread(
+                self._metadata, dataset, cache
+            )
+            return JSONResponse(jsonify_zmetadata(layout, zmetadata))
+
+        @router.api_route(f"/{group_meta_key}", methods=["GET", "HEAD"])
+        async def get_zarr_group(
+            dataset: xr.Dataset = Depends(deps.dataset),
+            cache: cachey.Cache = Depends(deps.cache),
+        ):
+            _, _, _, zmetadata = await asyncio.to_thread(self._metadata, dataset, cache)
+            return JSONResponse(zmetadata["metadata"][group_meta_key])
+
+        @router.api_route(f"/{attrs_key}", methods=["GET", "HEAD"])
+        async def get_zarr_attrs(
+            dataset: xr.Dataset = Depends(deps.dataset),
+            cache: cachey.Cache = Depends(deps.cache),
+        ):
+            _, _, _, zmetadata = await asyncio.to_thread(self._metadata, dataset, cache)
+            return JSONResponse(zmetadata["metadata"][attrs_key])
+
+        @router.api_route("/{var}/{chunk}", methods=["GET", "HEAD"])
+        async def get_variable_chunk(
+            request: Request,
+            var: str,
+            chunk: str,
+            dataset: xr.Dataset = Depends(deps.dataset),
+            cache: cachey.Cache = Depends(deps.cache),
+        ):
+            """Array metadata or a chunk of the time-series layout."""
+            if var not in dataset.variables:
+                raise HTTPException(status_code=404, detail="Not in dataset")
+            if chunk in (array_meta_key, attrs_key):
+                layout, _, _, zmetadata = await asyncio.to_thread(
+                    self._metadata, dataset, cache
+                )
+                zjson = jsonify_zmetadata(layout, zmetadata)
+                return JSONResponse(zjson["metadata"][f"{var}/{chunk}"])
+            if chunk == group_meta_key:
+                raise HTTPException(status_code=404, detail="No subgroups")
+            _, _, _, zmetadata = await asyncio.to_thread(self._metadata, dataset, cache)
+            arr_meta = zmetadata["metadata"][f"{var}/{array_meta_key}"]
+            request_class = request_classifier.classify(
+                request.headers.get("x-priority"),
+                client_id(request),
+                math.prod(arr_meta["chunks"]) * np.dtype(arr_meta["dtype"]).itemsize,
+            )
+            try:
+                data = await self.get_chunk(
+                    request.app.state.dask_client, dataset, cache, var, chunk,
+                    request_class,
+                )
+            except (IndexError, ValueError):
+                raise HTTPException(status_code=404, detail="Invalid chunk")
+            except BackendBusy as e:
+                raise HTTPException(
+                    status_code=503,
+                    detail=(
+                        "Not enough worker memory" if e.gate == "memory"
+                        else f"Too many {request_class} requests"
+                    ),
+                    headers={"Retry-After": str(e.retry_after)},
+                )
+            except ChunkTooLarge as e:
+                raise HTTPException(status_code=413, detail=str(e))
+
+            response = Response(data, media_type="application/octet-stream")
+            response.headers["Cache-control"] = "max-age=3600"
+            response.headers["Access-Control-Allow-Origin"] = "*"
+            response.headers["Access-Control-Allow-Methods"] = "POST,GET,HEAD"
+            response.headers["Access-Control-Allow-Headers"] = "*"
+            return response
+
+        return router
@@ -0,0 +1,400 @@
+from typing import Sequence, Any, Optional
+from functools import partial
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.responses import JSONResponse, Response
+import asyncio
+import math
+import time
+import weakref
+
+import cachey
+import numpy as np
+import xarray as xr
+
+from xpublish import Plugin, hookimpl, Dependencies
+from xpublish.utils.api import DATASET_ID_ATTR_KEY
+from xpublish.utils.zarr import (
+    ChunkTooLarge,
+    DaskArrayType,
+    array_meta_key,
+    as_buffer,
+    attrs_key,
+    classified_flight,
+    encode_chunk,
+    get_data_chunk_async,
+    get_zmetadata,
+    get_zvariables,
+    request_classifier,
+)
+from cloudify.utils.clients import client_id
+from cloudify.utils.limiter import BackendBusy
+from cloudify.utils.ranges import (
+    not_satisfiable_response,
+    parse_range_header,
+    partial_response,
+    resolve_ranges,
+)
+from cloudify.utils.sharding import (
+    EMPTY_CHUNK,
+    ZARR_V3_METADATA_KEY,
+    assemble_shard,
+    shard_chunks,
+    shard_index,
+    shard_size,
+    shard_factors,
+    v3_array_metadata,
+    v3_group_metadata,
+)
+from cloudify.utils.singleflight import AsyncSingleFlight
+
+# Concurrent range requests on the same shard or inner chunk share one
+# computation
+shard_flights = AsyncSingleFlight()
+
+
+class ZarrV3Plugin(Plugin):
+    """
+    Zarr v3 view of the dask-served datasets with sharded arrays.
+
+    The chunks of the /zarr endpoint become inner chunks which are grouped
+    into shards with an index at their end. Clients read the index and then
+    the inner chunks they need with range requests against one shard URL.
+    The inner chunks of a shard are computed together, through the chunk
+    batcher, and cached one by one next to the shard index. Range requests
+    for the index or for single inner chunks are answered from these
+    without assembling the shard. Inner chunks are computed in the
+    interactive or bulk admission queue of their requests, as for /zarr.
+    """
+
+    name: str = "zarr-v3"
+
+    # Bounds of a shard: number of inner chunks and their uncompressed size
+    shard_max_chunks: int = 64
+    shard_max_bytes: int = 256 * 2**20
+
+    # Shard indexes and inner chunks, weighted by the time it took to
+    # compute them
+    shard_cache_bytes: int = 2**30
+    shard_cache: Any = None
+
+    # v3 metadata per served dataset, dropped with the dataset
+    metadata: Any = None
+
+    dataset_router_prefix: str = "/zarr3"
+    dataset_router_tags: Sequence[str] = ["zarr3"]
+
+    def get_shard_cache(self) -> cachey.Cache:
+        if self.shard_cache is None:
+            self.shard_cache = cachey.Cache(available_bytes=self.shard_cache_bytes)
+        return self.shard_cache
+
+    def get_metadata(self, dataset: xr.Dataset, cache: cachey.Cache) -> dict:
+        """
+        v3 metadata of `dataset`, derived from its v2 metadata.
+
+        Returns:
+            dict with the group ``zarr.json``, the array ``zarr.json`` per
+            variable and the shard factors per variable
+        """
+        if self.metadata is None:
+            self.metadata = {}
+        entry = self.metadata.get(id(dataset))
+        if entry is not None and entry[0]() is dataset:
+            return entry[1]
+
+        zvariables = get_zvariables(dataset, cache)
+        zmetadata = get_zmetadata(dataset, cache, zvariables)["metadata"]
+        arrays = {}
+        factors = {}
+        for var in dataset.variables:
+            zarray = dict(zmetadata[f"{var}/{array_meta_key}"])
+            if zarray.get("compressor") is not None:
+                zarray["compressor"] = zarray["compressor"].get_config()
+            data = dataset[var].data
+            numblocks = (
+                data.numblocks if isinstance(data, DaskArrayType) else (1,) * data.ndim
+            )
+            var_factors = shard_factors(
+                zarray["chunks"],
+                numblocks,
+                np.dtype(zarray["dtype"]).itemsize,
+                max_chunks=self.shard_max_chunks,
+                max_bytes=self.shard_max_bytes,
+            )
+            array = v3_array_metadata(
+                zarray, zmetadata[f"{var}/{attrs_key}"], var_factors
+            )
+            if array is None:
+                print(f"Leaving {var} of dtype {zarray['dtype']} out of the v3 view")
+                continue
+            arrays[var] = array
+            factors[var] = var_factors
+        meta = dict(
+            group=v3_group_metadata(zmetadata[attrs_key], arrays),
+            arrays=arrays,
+            factors=factors,
+        )
+        key = id(dataset)
+        ref = weakref.ref(dataset, lambda _: self.metadata.pop(key, None))
+        self.metadata[key] = (ref, meta)
+        return meta
+
+    def _chunk_kwargs(self, dataset: xr.Dataset, cache: cachey.Cache, var: str) -> dict:
+        zvariables = get_zvariables(dataset, cache)
+        zarray = get_zmetadata(dataset, cache, zvariables)["metadata"][
+            f"{var}/{array_meta_key}"
+        ]
+        return dict(
+            filters=zarray["filters"],
+            compressor=zarray["compressor"],
+            out_shape=zarray["chunks"],
+        )
+
+    async def _compute_chunk(
+        self,
+        client: Any,
+        dataset: xr.Dataset,
+        cache: cachey.Cache,
+        var: str,
+        ikeys: tuple,
+        priority: int,
+    ) -> bytes:
+        """Encoded inner chunk `ikeys` of `var` with the dask `priority`, cached."""
+        key = (dataset.attrs.get(DATASET_ID_ATTR_KEY, ""), var, "chunk", ikeys)
+        data = self.get_shard_cache().get(key)
+        if data is not None:
+            return data
+        start = time.perf_counter()
+        kwargs = self._chunk_kwargs(dataset, cache, var)
+        da = get_zvariables(dataset, cache)[var].data
+        if isinstance(da, DaskArrayType):
+            dsid = dataset.attrs.get(DATASET_ID_ATTR_KEY, "")
+            data = await get_data_chunk_async(
+                client,
+                da,
+                ".".join(map(str, ikeys)),
+                batch_key=dsid,
+                affinity=(dataset.encoding.get("source") or dsid, var),
+                priority=priority,
+                **kwargs,
+            )
+        else:
+            # in-memory variables are a single inner chunk
+            data = await asyncio.to_thread(encode_chunk, np.asarray(da), **kwargs)
+        data = bytes(as_buffer(data))
+        self.get_shard_cache().put(key, data, time.perf_counter() - start, len(data))
+        return data
+
+    async def get_chunk(
+        self,
+        client: Any,
+        dataset: xr.Dataset,
+        cache: cachey.Cache,
+        var: str,
+        ikeys: tuple,
+        request_class: str,
+    ) -> bytes:
+        """
+        Encoded inner chunk `ikeys` of `var`, computed in the admission queue
+        of the most urgent `request_class` waiting for it.
+        """
+        key = (dataset.attrs.get(DATASET_ID_ATTR_KEY, ""), var, "chunk", ikeys)
+        data = self.get_shard_cache().get(key)
+        if data is not None:
+            return data
+        return await classified_flight(
+            shard_flights,
+            key,
+            request_class,
+            partial(self._compute_chunk, client, dataset, cache, var, ikeys),
+        )
+
+    def _inner_chunks(self, dataset: xr.Dataset, cache: cachey.Cache, var: str, shard: tuple) -> tuple:
+        """(positions, chunk indexes, number of positions) of the inner chunks of `shard`."""
+        factors = self.get_metadata(dataset, cache)["factors"][var]
+        da = get_zvariables(dataset, cache)[var].data
+        numblocks = da.numblocks if isinstance(da, DaskArrayType) else (1,) * da.ndim
+        inner = shard_chunks(shard, factors, numblocks)
+        return [p for p, _ in inner], [i for _, i in inner], math.prod(factors)
+
+    async def get_index(
+        self,
+        client: Any,
+        dataset: xr.Dataset,
+        cache: cachey.Cache,
+        var: str,
+        shard: tuple,
+        request_class: str,
+    ) -> np.ndarray:
+        """(offset, nbytes) of each inner chunk of `shard`, see `shard_index`."""
+        key = (dataset.attrs.get(DATASET_ID_ATTR_KEY, ""), var, "index", shard)
+        index = self.get_shard_cache().get(key)
+        if index is not None:
+            return index
+        start = time.perf_counter()
+        positions, ikeys, nchunks = self._inner_chunks(dataset, cache, var, shard)
+        # the chunks are submitted together and cached for the following
+        # range requests, concurrent requests share them chunk by chunk
+        chunks = await asyncio.gather(
+            *[
+                self.get_chunk(client, dataset, cache, var, ik, request_class)
+                for ik in ikeys
+            ]
+        )
+        index = shard_index(positions, [len(c) for c in chunks], nchunks)
+        self.get_shard_cache().put(key, index, time.perf_counter() - start, index.nbytes)
+        return index
+
+    async def get_shard(
+        self,
+        client: Any,
+        dataset: xr.Dataset,
+        cache: cachey.Cache,
+        var: str,
+        shard: tuple,
+        request_class: str,
+    ) -> bytes:
+        """The full shard, assembled from its cached inner chunks."""
+        await self.get_index(client, dataset, cache, var, shard, request_class)
+        positions, ikeys, nchunks = self._inner_chunks(dataset, cache, var, shard)
+        chunks = await asyncio.gather(
+            *[
+                self.get_chunk(client, dataset, cache, var, ik, request_class)
+                for ik in ikeys
+            ]
+        )
+        return assemble_shard(*chunks, positions=positions, nchunks=nchunks)
+
+    async def get_shard_range(
+        self,
+        client: Any,
+        dataset: xr.Dataset,
+        cache: cachey.Cache,
+        var: str,
+        shard: tuple,
+        index: np.ndarray,
+        first: int,
+        last: int,
+        request_class: str,
+    ) -> bytes:
+        """
+        Bytes `first` to `last` (inclusive) of the shard with `index`, read
+        from the index and the inner chunks they overlap only.
+        """
+        positions, ikeys, _ = self._inner_chunks(dataset, cache, var, shard)
+        chunk_of = dict(zip(positions, ikeys))
+        data_size = shard_size(index) - index.nbytes
+        parts = []
+        for position, (offset, nbytes) in enumerate(index.tolist()):
+            if offset == EMPTY_CHUNK or offset > last or offset + nbytes <= first:
+                continue
+            chunk = await self.get_chunk(
+                client, dataset, cache, var, chunk_of[position], request_class
+            )
+            parts.append(
+                (offset, chunk[max(first - offset, 0):last + 1 - offset])
+            )
+        if last >= data_size:
+            tail = index.tobytes()
+            parts.append((data_size, tail[max(first - data_size, 0):last + 1 - data_size]))
+        return b"".join(part for _, part in sorted(parts, key=lambda p: p[0]))
+
+    @hookimpl
+    def dataset_router(self, deps: Dependencies) -> APIRouter:
+        router = APIRouter(
+            prefix=self.dataset_router_prefix,
+            tags=list(self.dataset_router_tags),
+        )
+
+        @router.api_route(f"/{ZARR_V3_METADATA_KEY}", methods=["GET", "HEAD"])
+        async def get_group_metadata(
+            dataset: xr.Dataset = Depends(deps.dataset),
+            cache: cachey.Cache = Depends(deps.cache),
+        ):
+            """Zarr v3 root group with consolidated metadata."""
+            meta = await asyncio.to_thread(self.get_metadata, dataset, cache)
+            return JSONResponse(meta["group"])
+
+        @router.api_route("/{var}/{key:path}", methods=["GET", "HEAD"])
+        async def get_array_key(
+            request: Request,
+            var: str,
+            key: str,
+            dataset: xr.Dataset = Depends(deps.dataset),
+            cache: cachey.Cache = Depends(deps.cache),
+        ):
+            """Array metadata or a shard of an array, with range support."""
+            meta = await asyncio.to_thread(self.get_metadata, dataset, cache)
+            if var not in meta["arrays"]:
+                raise HTTPException(status_code=404, detail="Not in dataset")
+            if key == ZARR_V3_METADATA_KEY:
+                return JSONResponse(meta["arrays"][var])
+            if key != "c" and not key.startswith("c/"):
+                raise HTTPException(status_code=404, detail="Not found")
+            try:
+                shard = tuple(int(i) for i in key[2:].split("/") if i)
+            except ValueError:
+                raise HTTPException(status_code=404, detail="Invalid shard key")
+            array = meta["arrays"][var]
+            shard_shape = array["chunk_grid"]["configuration"]["chunk_shape"]
+            if len(shard) != len(shard_shape) or any(
+                not 0 <= s < math.ceil(n / c)
+                for s, n, c in zip(shard, array["shape"], shard_shape)
+            ):
+                raise HTTPException(status_code=404, detail="Shard out of range")
+
+            client = request.app.state.dask_client
+            ranges = parse_range_header(request.headers.get("range"))
+            # classified by the inner chunks, the unit of computation
+            request_class = request_classifier.classify(
+                request.headers.get("x-priority"),
+                client_id(request),
+                math.prod(array["codecs"][0]["configuration"]["chunk_shape"])
+                * np.dtype(array["data_type"]).itemsize,
+            )
+            try:
+                if ranges is None:
+                    data = await self.get_shard(
+                        client, dataset, cache, var, shard, request_class
+                    )
+                    response = Response(data, media_type="application/octet-stream")
+                    response.headers["Accept-Ranges"] = "bytes"
+                else:
+                    index = await self.get_index(
+                        client, dataset, cache, var, shard, request_class
+                    )
+                    size = shard_size(index)
+                    resolved = resolve_ranges(ranges, size)
+                    if not resolved:
+                        response = not_satisfiable_response(size)
+                    else:
+                        parts = [
+                            await self.get_shard_range(
+                                client, dataset, cache, var, shard, index,
+                                first, last, request_class,
+                            )
+                            for first, last in resolved
+                        ]
+                        response = partial_response(parts, resolved, size)
+            except BackendBusy as e:
+                raise HTTPException(
+                    status_code=503,
+                    detail=(
+                        "Not enough worker memory" if e.gate == "memory"
+                        else f"Too many {request_class} requests"
+                    ),
+                    headers={"Retry-After": str(e.retry_after)},
+                )
+            except ChunkTooLarge as e:
+                raise HTTPException(status_code=413, detail=str(e))
+            if response.status_code < 400:
+                response.headers["Cache-control"] = "max-age=3600"
+            else:
+                response.headers["Cache-control"] = "no-store"
+            response.headers["Access-Control-Allow-Origin"] = "*"
+            response.headers["Access-Control-Allow-Methods"] = "POST,GET,HEAD"
+            response.headers["Access-Control-Allow-Headers"] = "*"
+            response.headers["Access-Control-Expose-Headers"] = "Content-Range, Accept-Ranges"
+            return response
+
+        return router
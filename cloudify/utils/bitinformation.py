@@ -0,0 +1,210 @@
+from pathlib import Path
+from statistics import NormalDist
+from typing import Optional, Union
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+import xarray as xr
+
+BITINFORMATION_VERSION = 1
+
+# (unsigned int view, sign+exponent bits, mantissa bits) per float type
+FLOAT_LAYOUT = {
+    np.dtype("float16"): (np.uint16, 6, 10),
+    np.dtype("float32"): (np.uint32, 9, 23),
+    np.dtype("float64"): (np.uint64, 12, 52),
+}
+
+
+def bit_pair_counts(arr: np.ndarray, axis: int = -1) -> np.ndarray:
+    """
+    Count the combinations of each bit in neighbouring elements along `axis`.
+
+    Pairs with a NaN are left out, fill values would otherwise appear as
+    information.
+
+    Returns:
+        Array of shape (nbits, 4) with the counts of (0,0), (0,1), (1,0),
+        (1,1), most significant bit first.
+    """
+    uint, _, _ = FLOAT_LAYOUT[arr.dtype]
+    arr = np.moveaxis(arr, axis, -1)
+    valid = ~(np.isnan(arr[..., :-1]) | np.isnan(arr[..., 1:]))
+    u = np.ascontiguousarray(arr).view(uint)
+    a, b = u[..., :-1][valid], u[..., 1:][valid]
+    nbits = 8 * arr.dtype.itemsize
+    counts = np.zeros((nbits, 4), dtype=np.int64)
+    for i in range(nbits):
+        shift = uint(nbits - 1 - i)
+        code = ((a >> shift) & uint(1)) * uint(2) + ((b >> shift) & uint(1))
+        counts[i] = np.bincount(code.astype(np.int64), minlength=4)
+    return counts
+
+
+def _entropy(p: np.ndarray) -> np.ndarray:
+    p = np.where(p > 0, p, 1)
+    return -(p * np.log2(p))
+
+
+def mutual_information(counts: np.ndarray, confidence: float = 0.99) -> np.ndarray:
+    """
+    Mutual information between each bit of neighbouring elements.
+
+    Information below what independent random bits reach with probability
+    `confidence` for the given sample size is considered insignificant and
+    set to zero.
+
+    Args:
+        counts: Output of :func:`bit_pair_counts`
+
+    Returns:
+        Information in bits per bit position, most significant bit first
+    """
+    n = counts.sum(axis=1, keepdims=True)
+    joint = counts / np.maximum(n, 1)
+    pa = joint[:, 2] + joint[:, 3]
+    pb = joint[:, 1] + joint[:, 3]
+    info = (
+        _entropy(np.stack([1 - pa, pa], axis=1)).sum(axis=1)
+        + _entropy(np.stack([1 - pb, pb], axis=1)).sum(axis=1)
+        - _entropy(joint).sum(axis=1)
+    )
+    # information of random bits for this sample size at `confidence`
+    z = NormalDist().inv_cdf(1 - (1 - confidence) / 2)
+    p = 0.5 + z / (2 * np.sqrt(np.maximum(n[:, 0], 1)))
+    p = np.minimum(p, 1)
+    threshold = 1 - _entropy(np.stack([p, 1 - p], axis=1)).sum(axis=1)
+    info[info <= threshold] = 0
+    return np.maximum(info, 0)
+
+
+def keepbits_from_information(
+    info: np.ndarray, dtype: np.dtype, inflevel: float = 0.99, min_keepbits: int = 1
+) -> Optional[int]:
+    """
+    Mantissa bits to keep so that `inflevel` of the information is preserved.
+
+    Returns:
+        Keepbits between `min_keepbits` and the mantissa length, None if no
+        bit carries significant information, e.g. for constant fields.
+    """
+    _, exponent_bits, mantissa_bits = FLOAT_LAYOUT[np.dtype(dtype)]
+    total = info.sum()
+    if total <= 0:
+        return None
+    cdf = np.cumsum(info) / total
+    needed = int(np.argmax(cdf >= inflevel)) + 1
+    return int(min(max(needed - exponent_bits, min_keepbits), mantissa_bits))
+
+
+def sample_counts(da: xr.DataArray, nchunks: int = 3, axis: int = -1) -> np.ndarray:
+    """Aggregate bit pair counts over up to `nchunks` chunks spread over `da`."""
+    data = da.data
+    nblocks = int(np.prod(data.numblocks))
+    picks = sorted(set(np.linspace(0, nblocks - 1, nchunks).astype(int)))
+    counts = None
+    for flat in picks:
+        block = np.asarray(data.blocks[np.unravel_index(flat, data.numblocks)].compute())
+        if block.shape[axis] < 2:
+            continue
+        c = bit_pair_counts(block, axis=axis)
+        counts = c if counts is None else counts + c
+    return counts
+
+
+def variable_fingerprint(da: xr.DataArray) -> str:
+    parts = [
+        BITINFORMATION_VERSION,
+        str(da.dtype),
+        list(da.dims),
+        list(da.shape),
+        [list(c) for c in da.chunks],
+    ]
+    return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+
+def get_keepbits(
+    ds: xr.Dataset,
+    dsid: str,
+    cache_dir: Union[str, Path],
+    inflevel: float = 0.99,
+    nchunks: int = 3,
+    dim: Optional[str] = None,
+    min_keepbits: int = 1,
+) -> dict:
+    """
+    Keepbits per float variable of a dataset derived from its bitwise
+    real information content.
+
+    For each dask-backed float variable, the mutual information of the bits
+    of neighbouring elements along `dim` is computed on a sample of chunks.
+    The keepbits are the mantissa bits that hold `inflevel` of the
+    information. Results are cached in ``cache_dir/<dsid>.json`` and reused
+    while the variable does not change.
+
+    Args:
+        ds: The dataset, before any rounding
+        dsid: Dataset id, names the cache file
+        cache_dir: Directory of the cache files
+        inflevel: Fraction of the information to preserve
+        nchunks: Chunks sampled per variable
+        dim: Dimension of neighbouring elements, defaults to the last one
+        min_keepbits: Lower bound of the keepbits
+
+    Returns:
+        dict: Variable name to keepbits, for apply_lossy_compression.
+        Variables without significant information are left out.
+    """
+    path = Path(cache_dir) / f"{dsid}.json"
+    try:
+        stored = json.loads(path.read_text())
+    except (FileNotFoundError, ValueError):
+        stored = {}
+
+    analysis = {}
+    for var in ds.data_vars:
+        da = ds[var]
+        if da.chunks is None or da.dtype not in FLOAT_LAYOUT:
+            continue
+        fingerprint = variable_fingerprint(da)
+        entry = stored.get(var)
+        if (
+            entry is None
+            or entry.get("fingerprint") != fingerprint
+            or entry.get("inflevel") != inflevel
+            or entry.get("min_keepbits") != min_keepbits
+        ):
+            axis = da.get_axis_num(dim) if dim else da.ndim - 1
+            try:
+                counts = sample_counts(da, nchunks=nchunks, axis=axis)
+            except Exception as e:
+                print(f"Could not analyse bit information of {dsid}/{var}: {e}")
+                continue
+            if counts is None:
+                continue
+            info = mutual_information(counts)
+            entry = dict(
+                fingerprint=fingerprint,
+                inflevel=inflevel,
+                min_keepbits=min_keepbits,
+                information=info.tolist(),
+                keepbits=keepbits_from_information(
+                    info, da.dtype, inflevel, min_keepbits
+                ),
+            )
+        analysis[var] = entry
+
+    if analysis != stored:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(prefix="tmp", dir=path.parent)
+        with os.fdopen(fd, "w") as f:
+            json.dump(analysis, f, indent=1)
+        os.replace(tmp, path)
+    return {
+        var: entry["keepbits"]
+        for var, entry in analysis.items()
+        if entry["keepbits"] is not None
+    }
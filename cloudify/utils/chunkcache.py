@@ -0,0 +1,198 @@
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+import hashlib
+import os
+import tempfile
+import threading
+
+
+class ChunkCache:
+    """
+    Two tiered byte cache for raw chunk payloads.
+
+    The first tier is an in-process LRU, the second tier a directory on local
+    disk which can be shared by several server processes. Both tiers have a
+    byte budget and evict the least recently used entries. Entries are keyed
+    by the dataset source and the chunk key.
+
+    The disk index is per process. Processes sharing a directory each enforce
+    their budget on the files they know about, files removed by another
+    process are dropped from the index lazily.
+    """
+
+    def __init__(
+        self,
+        memory_bytes: int = 512 * 2**20,
+        disk_bytes: int = 0,
+        disk_dir: Optional[str] = None,
+        max_item_bytes: int = 64 * 2**20,
+    ):
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes if disk_dir else 0
+        self.disk_dir = Path(disk_dir) if disk_dir else None
+        self.max_item_bytes = max_item_bytes
+
+        self._memory = OrderedDict()
+        self._memory_used = 0
+        self._disk = OrderedDict()
+        self._disk_used = 0
+        self._lock = threading.Lock()
+
+        self.counters = dict(
+            memory_hits=0,
+            disk_hits=0,
+            misses=0,
+            memory_evictions=0,
+            disk_evictions=0,
+        )
+        if self.disk_enabled:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+            self._scan_disk()
+
+    @property
+    def disk_enabled(self) -> bool:
+        return self.disk_bytes > 0
+
+    @staticmethod
+    def cache_key(source: str, key: str) -> str:
+        return hashlib.sha256(f"{source}\0{key}".encode("utf-8")).hexdigest()
+
+    def _disk_path(self, ckey: str) -> Path:
+        return self.disk_dir / ckey[:2] / ckey
+
+    def _scan_disk(self):
+        """Rebuild the disk index from a previous run, oldest files first."""
+        entries = []
+        for path in self.disk_dir.glob("*/*"):
+            try:
+                st = path.stat()
+            except FileNotFoundError:
+                continue
+            if path.name.startswith("tmp"):
+                continue
+            entries.append((st.st_mtime, path.name, st.st_size))
+        for _, ckey, size in sorted(entries):
+            self._disk[ckey] = size
+            self._disk_used += size
+        self._evict_disk()
+
+    def _evict_memory(self):
+        while self._memory_used > self.memory_bytes and self._memory:
+            _, data = self._memory.popitem(last=False)
+            self._memory_used -= len(data)
+            self.counters["memory_evictions"] += 1
+
+    def _evict_disk(self):
+        while self._disk_used > self.disk_bytes and self._disk:
+            ckey, size = self._disk.popitem(last=False)
+            self._disk_used -= size
+            self.counters["disk_evictions"] += 1
+            try:
+                os.remove(self._disk_path(ckey))
+            except FileNotFoundError:
+                pass
+
+    def get_memory(self, source: str, key: str) -> Optional[bytes]:
+        ckey = self.cache_key(source, key)
+        with self._lock:
+            data = self._memory.get(ckey)
+            if data is not None:
+                self._memory.move_to_end(ckey)
+                self.counters["memory_hits"] += 1
+        return data
+
+    def get_disk(self, source: str, key: str) -> Optional[bytes]:
+        """Read an entry from the disk tier and promote it to memory."""
+        if not self.disk_enabled:
+            return None
+        ckey = self.cache_key(source, key)
+        path = self._disk_path(ckey)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                size = self._disk.pop(ckey, None)
+                if size is not None:
+                    self._disk_used -= size
+            return None
+        with self._lock:
+            if ckey in self._disk:
+                self._disk.move_to_end(ckey)
+            self.counters["disk_hits"] += 1
+        self.put_memory(source, key, data)
+        return data
+
+    def get(self, source: str, key: str) -> Optional[bytes]:
+        data = self.get_memory(source, key)
+        if data is None:
+            data = self.get_disk(source, key)
+        if data is None:
+            self.record_miss()
+        return data
+
+    def record_miss(self):
+        with self._lock:
+            self.counters["misses"] += 1
+
+    def put_memory(self, source: str, key: str, data: bytes):
+        size = len(data)
+        if size > self.max_item_bytes or size > self.memory_bytes:
+            return
+        ckey = self.cache_key(source, key)
+        with self._lock:
+            old = self._memory.pop(ckey, None)
+            if old is not None:
+                self._memory_used -= len(old)
+            self._memory[ckey] = bytes(data)
+            self._memory_used += size
+            self._evict_memory()
+
+    def put_disk(self, source: str, key: str, data: bytes):
+        size = len(data)
+        if not self.disk_enabled or size > self.max_item_bytes or size > self.disk_bytes:
+            return
+        ckey = self.cache_key(source, key)
+        path = self._disk_path(ckey)
+        path.parent.mkdir(exist_ok=True)
+        # write to a temporary file first, so other processes never read
+        # half written entries
+        fd, tmp = tempfile.mkstemp(prefix="tmp", dir=path.parent)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        with self._lock:
+            old = self._disk.pop(ckey, None)
+            if old is not None:
+                self._disk_used -= old
+            self._disk[ckey] = size
+            self._disk_used += size
+            self._evict_disk()
+
+    def put(self, source: str, key: str, data: bytes):
+        self.put_memory(source, key, data)
+        self.put_disk(source, key, data)
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self.counters)
+            stats.update(
+                memory_entries=len(self._memory),
+                memory_used_bytes=self._memory_used,
+                memory_budget_bytes=self.memory_bytes,
+                disk_entries=len(self._disk),
+                disk_used_bytes=self._disk_used,
+                disk_budget_bytes=self.disk_bytes,
+            )
+        requests = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_ratio"] = (
+            (stats["memory_hits"] + stats["disk_hits"]) / requests if requests else 0.0
+        )
+        return stats
@@ -0,0 +1,10 @@
+from typing import Optional
+from fastapi import Request
+
+
+def client_id(request: Request) -> Optional[str]:
+    """Address of the client, the first hop if the server runs behind a proxy."""
+    forwarded = request.headers.get("x-forwarded-for")
+    if forwarded:
+        return forwarded.split(",")[0].strip()
+    return request.client.host if request.client else None
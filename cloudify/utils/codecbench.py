@@ -0,0 +1,184 @@
+from pathlib import Path
+from typing import Optional, Union
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+import numcodecs
+import numpy as np
+import xarray as xr
+
+CALIBRATION_VERSION = 1
+
+# Candidates benchmarked per variable, byte shuffle and bit shuffle each
+CANDIDATES = [
+    dict(id="blosc", cname=cname, clevel=clevel, shuffle=shuffle, blocksize=0)
+    for cname, clevels in [("lz4", [1, 5, 9]), ("zstd", [1, 3, 5])]
+    for clevel in clevels
+    for shuffle in [numcodecs.Blosc.SHUFFLE, numcodecs.Blosc.BITSHUFFLE]
+]
+
+# The codec used by set_compression so far, kept as fallback
+DEFAULT_CODEC = dict(id="blosc", cname="lz4", clevel=5, shuffle=2, blocksize=0)
+
+
+def sample_chunk(da: xr.DataArray) -> np.ndarray:
+    """
+    Load one representative chunk of a dask-backed variable.
+
+    The chunk in the middle of the array is used, the first chunks are often
+    all fill values. Filters from the encoding, e.g. BitRound, are applied as
+    they are when the chunk is served.
+    """
+    data = da.data
+    middle = tuple(n // 2 for n in data.numblocks)
+    chunk = np.ascontiguousarray(data.blocks[middle].compute())
+    for f in da.encoding.get("filters") or []:
+        chunk = f.decode(f.encode(chunk))
+    return chunk
+
+
+def benchmark_codec(config: dict, chunk: np.ndarray, repeats: int = 3) -> dict:
+    """
+    Encode and decode `chunk` with the codec `config`.
+
+    Returns:
+        dict: ratio, encoded bytes and encode/decode throughput in MB/s of
+        uncompressed data, best of `repeats`
+    """
+    codec = numcodecs.get_codec(dict(config))
+    encode_time = decode_time = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        encoded = codec.encode(chunk)
+        encode_time = min(encode_time, time.perf_counter() - start)
+        start = time.perf_counter()
+        codec.decode(encoded)
+        decode_time = min(decode_time, time.perf_counter() - start)
+    nbytes = chunk.nbytes
+    return dict(
+        codec=config,
+        encoded_bytes=len(encoded),
+        ratio=nbytes / max(len(encoded), 1),
+        encode_mbps=nbytes / 1e6 / max(encode_time, 1e-9),
+        decode_mbps=nbytes / 1e6 / max(decode_time, 1e-9),
+    )
+
+
+def choose_codec(results: list, policy: str = "min_bytes", min_throughput: float = 0.0) -> dict:
+    """
+    Pick a codec from benchmark results.
+
+    Args:
+        results: Output of :func:`benchmark_codec` per candidate
+        policy: "min_bytes" for the smallest output or "max_throughput" for
+            the fastest encoding
+        min_throughput: Encode and decode throughput in MB/s a candidate
+            needs to reach. If none does, the fastest one is used.
+
+    Returns:
+        dict: Config of the chosen codec
+    """
+    if not results:
+        return dict(DEFAULT_CODEC)
+    fast_enough = [
+        r for r in results
+        if min(r["encode_mbps"], r["decode_mbps"]) >= min_throughput
+    ]
+    if not fast_enough:
+        policy, fast_enough = "max_throughput", results
+    if policy == "min_bytes":
+        best = min(fast_enough, key=lambda r: (r["encoded_bytes"], -r["encode_mbps"]))
+    elif policy == "max_throughput":
+        best = max(fast_enough, key=lambda r: min(r["encode_mbps"], r["decode_mbps"]))
+    else:
+        raise ValueError(f"Unknown codec policy {policy}")
+    return best["codec"]
+
+
+def variable_fingerprint(da: xr.DataArray) -> str:
+    """Identify what a calibration result of a variable depends on."""
+    filters = [f.get_config() for f in da.encoding.get("filters") or []]
+    parts = [
+        CALIBRATION_VERSION,
+        str(da.dtype),
+        list(da.shape),
+        [list(c) for c in da.chunks],
+        filters,
+    ]
+    return hashlib.sha256(json.dumps(parts, default=str).encode()).hexdigest()
+
+
+def calibrate_codecs(
+    ds: xr.Dataset,
+    dsid: str,
+    calibration_dir: Union[str, Path],
+    policy: str = "min_bytes",
+    min_throughput: float = 0.0,
+    candidates: Optional[list] = None,
+) -> dict:
+    """
+    Choose a codec per dask-backed variable of a dataset.
+
+    A sample chunk of each variable is encoded with every candidate codec.
+    Ratios, throughputs and the choice are stored in
+    ``calibration_dir/<dsid>.json``. Later calls reuse the stored choice as
+    long as the variable, its chunks and filters did not change, so the
+    served encoding stays reproducible across restarts.
+
+    Args:
+        ds: Dataset with filters already set, e.g. by apply_lossy_compression
+        dsid: Dataset id, names the result file
+        calibration_dir: Directory of the result files
+        policy: See :func:`choose_codec`
+        min_throughput: See :func:`choose_codec`
+        candidates: Codec configs, defaults to ``CANDIDATES``
+
+    Returns:
+        dict: Variable name to numcodecs codec, for set_compression
+    """
+    candidates = candidates or CANDIDATES
+    path = Path(calibration_dir) / f"{dsid}.json"
+    try:
+        stored = json.loads(path.read_text())
+    except (FileNotFoundError, ValueError):
+        stored = {}
+
+    settings = dict(policy=policy, min_throughput=min_throughput)
+    calibration = {}
+    codecs = {}
+    for var in ds.variables:
+        if ds[var].chunks is None:
+            continue
+        fingerprint = variable_fingerprint(ds[var])
+        entry = stored.get(var)
+        if (
+            entry is None
+            or entry.get("fingerprint") != fingerprint
+            or entry.get("settings") != settings
+        ):
+            try:
+                chunk = sample_chunk(ds[var])
+                results = [benchmark_codec(c, chunk) for c in candidates]
+            except Exception as e:
+                print(f"Could not calibrate codecs for {dsid}/{var}: {e}")
+                continue
+            entry = dict(
+                fingerprint=fingerprint,
+                settings=settings,
+                sample_bytes=chunk.nbytes,
+                results=results,
+                chosen=choose_codec(results, policy, min_throughput),
+            )
+        calibration[var] = entry
+        codecs[var] = numcodecs.get_codec(dict(entry["chosen"]))
+
+    if calibration != stored:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(prefix="tmp", dir=path.parent)
+        with os.fdopen(fd, "w") as f:
+            json.dump(calibration, f, indent=1)
+        os.replace(tmp, path)
+    return codecs
@@ -7,6 +7,7 @@ import itertools
 import xarray as xr
 from datetime import datetime
 from copy import deepcopy as copy
+from copy import deepcopy
 import fastapi
 import numcodecs
 import fsspec
@@ -18,7 +19,12 @@ import numcodecs
 import zarr
 from dask.array import Array as Daarray
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import partial
+from typing import Callable, Optional
 import json
+import os
+import time
 
 rounding = numcodecs.BitRound(keepbits=10)
 
@@ -75,6 +81,22 @@ class AsyncFSMap(FSMap):
         #    raise KeyError(key) from exc
         return result
 
+    async def asyncitems(self, keys, **kwargs):
+        """Retrieve several keys concurrently with one `_cat` call.
+
+        Returns a dict mapping each key to its bytes or to the exception
+        raised while fetching it.
+        """
+        paths = {self._key_to_str(key): key for key in keys}
+        try:
+            result = await self.fs._cat(list(paths), on_error="return", **kwargs)
+        except Exception as e:
+            return {key: e for key in keys}
+        return {
+            key: result.get(path, FileNotFoundError(key))
+            for path, key in paths.items()
+        }
+
 def async_get_mapper(
     url="",
     check=False,
@@ -337,10 +359,20 @@ def split_ds(ds: xr.Dataset) -> list[xr.Dataset]:
     
     return subdss
 
-def open_zarr_and_mapper(uri, storage_options=None,**kwargs):    
-    use_options = copy(STORAGE_OPTIONS)
+def open_zarr_and_mapper(uri, storage_options=None, loop=None, **kwargs):
+    """
+    Open the zarr dataset at `uri` and an async mapper for its raw chunks.
+
+    The mapper is bound to `loop`, the running event loop by default. Pass
+    the server loop to open datasets from other threads, see
+    `open_concurrently`.
+    """
+    # the nested remote_options are modified below, so neither the caller
+    # nor the mapper of the dataset may share them. Concurrent openers of
+    # one catalog entry pass the same storage_options.
+    use_options = deepcopy(STORAGE_OPTIONS)
     if storage_options:
-        use_options.update(storage_options)
+        use_options.update(deepcopy(storage_options))
     if uri.startswith("reference"):
         if not use_options.get("remote_protocol"):
             use_options["remote_protocol"] = "file"
@@ -355,7 +387,7 @@ def open_zarr_and_mapper(uri, storage_options=None,**kwargs):
             
     use_options["asynchronous"]=True
     use_options["loop"]=None
-    mapper = fsspec.get_mapper(uri, **use_options)
+    mapper = fsspec.get_mapper(uri, **deepcopy(use_options))
     ds = xr.open_dataset(
             mapper,
             #uri,
@@ -369,7 +401,7 @@ def open_zarr_and_mapper(uri, storage_options=None,**kwargs):
             ds["time"] = ds["time"].data.compute()   
             
     use_options["asynchronous"]=False
-    lp = asyncio.get_running_loop()
+    lp = loop or asyncio.get_running_loop()
     use_options["loop"]=lp
     if uri.startswith("reference"):    
         if not use_options.get("remote_options"):
@@ -510,7 +542,7 @@ def lossy_compress_chunk(partds) :
 
 
 def apply_lossy_compression(
-    ds: xr.Dataset, L_DASK: bool = True
+    ds: xr.Dataset, L_DASK: bool = True, keepbits: dict = None
 ) -> xr.Dataset:
     """
     Apply lossy compression to dataset chunks and store in Zarr format.
@@ -521,6 +553,9 @@ def apply_lossy_compression(
     Args:
         ds (xr.Dataset): Dataset to compress
         L_DASK (bool): Whether to use Dask for parallel processing
+        keepbits (dict): Optional keepbits per variable, e.g. from
+            cloudify.utils.bitinformation.get_keepbits. Variables not in it
+            keep 10 bits.
 
     """
     
@@ -535,14 +570,15 @@ def apply_lossy_compression(
 #    else:
 #        for var in ds.data_vars:
 #            ds[var].encoding["filters"]=numcodecs.BitRound(keepbits=12)            
+    keepbits = keepbits or {}
     for var in ds.data_vars:
         if ds[var].chunks is not None:
-            ds[var].encoding["filters"]=[numcodecs.BitRound(keepbits=10)]
+            ds[var].encoding["filters"]=[numcodecs.BitRound(keepbits=keepbits.get(var, 10))]
     ds.encoding["source"]=se         
     
     return ds
 
-def set_compression(ds: xr.Dataset) -> xr.Dataset:
+def set_compression(ds: xr.Dataset, codecs: dict = None) -> xr.Dataset:
     """
     Set compression for dataset variables.
 
@@ -551,14 +587,18 @@ def set_compression(ds: xr.Dataset) -> xr.Dataset:
 
     Args:
         ds (xr.Dataset): Input dataset to compress
+        codecs (dict): Optional compressor per variable, e.g. from
+            cloudify.utils.codecbench.calibrate_codecs. Variables not in it
+            get the default.
 
     Returns:
         xr.Dataset: Dataset with compression applied
     """
+    codecs = codecs or {}
     for var in ds.variables:
         if ds[var].chunks is not None:
         #if isinstance(ds[var].data, Daarray):
-            ds[var].encoding["compressor"] = numcodecs.Blosc(
+            ds[var].encoding["compressor"] = codecs.get(var) or numcodecs.Blosc(
                     cname="lz4", clevel=5, shuffle=2
                 )  # , blocksize=0),
         else:
@@ -566,6 +606,70 @@ def set_compression(ds: xr.Dataset) -> xr.Dataset:
     return ds
 
 
+# Datasets are opened by CLOUDIFY_OPEN_WORKERS threads at server startup.
+# Sources which are not open CLOUDIFY_OPEN_DEADLINE seconds after the first
+# one was started are left out, 0 waits for all of them.
+CLOUDIFY_OPEN_WORKERS = int(os.environ.get("CLOUDIFY_OPEN_WORKERS", 16))
+CLOUDIFY_OPEN_DEADLINE = float(os.environ.get("CLOUDIFY_OPEN_DEADLINE", 0))
+
+_startup_deadline = None
+
+def startup_deadline() -> Optional[float]:
+    """time.monotonic() by which all datasets of the startup have to be open."""
+    global _startup_deadline
+    if CLOUDIFY_OPEN_DEADLINE and _startup_deadline is None:
+        _startup_deadline = time.monotonic() + CLOUDIFY_OPEN_DEADLINE
+    return _startup_deadline
+
+def open_concurrently(
+    openers: dict[str, Callable], workers: int = None, deadline: float = None
+) -> dict:
+    """
+    Run dataset openers in a thread pool.
+
+    Sources are isolated from each other: an opener which fails or is not
+    done by the deadline is left out with a message, it does not stop the
+    others. The calling thread waits for the openers.
+
+    Args:
+        openers (dict): Opener without arguments per name, e.g. a partial
+            of `open_zarr_and_mapper` with the server loop
+        workers (int, optional): Threads, CLOUDIFY_OPEN_WORKERS by default
+        deadline (float, optional): time.monotonic() by which the openers
+            have to be done, `startup_deadline()` by default
+
+    Returns:
+        dict: Results of the successful openers in the order of `openers`
+    """
+    if not openers:
+        return {}
+    if deadline is None:
+        deadline = startup_deadline()
+    executor = ThreadPoolExecutor(
+        max_workers=max(min(workers or CLOUDIFY_OPEN_WORKERS, len(openers)), 1),
+        thread_name_prefix="cloudify-open",
+    )
+    futures = {name: executor.submit(opener) for name, opener in openers.items()}
+    start = time.monotonic()
+    timeout = None if deadline is None else max(deadline - start, 0)
+    _, pending = wait(futures.values(), timeout=timeout)
+    # hanging openers keep their thread but are not waited for
+    executor.shutdown(wait=False, cancel_futures=True)
+
+    results = {}
+    for name, future in futures.items():
+        if future in pending:
+            print(f"Could not open {name} before the startup deadline")
+        elif future.exception() is not None:
+            print(f"Could not open {name}: {future.exception()}")
+        else:
+            results[name] = future.result()
+    print(
+        f"Opened {len(results)} of {len(openers)} datasets "
+        f"in {time.monotonic() - start:.1f}s"
+    )
+    return results
+
 def get_combination_list(ups: dict) -> list[dict]:
     """
     Generate all possible combinations of update parameters.
@@ -674,7 +778,8 @@ def get_dataset_dict_from_intake(
     This function loads datasets from an intake catalog with various configuration
     options for chunking, variable dropping, and path filtering. It's used by
     multiple cloudify scripts (cloudify_era5.py, cloudify_dyamond.py,
-    cloudify_eerie.py, cloudify_cosmorea.py) for dataset loading.
+    cloudify_eerie.py, cloudify_cosmorea.py) for dataset loading. The
+    datasets are opened concurrently, see `open_concurrently`.
 
     Args:
         cat: Intake catalog object containing the datasets
@@ -694,6 +799,9 @@ def get_dataset_dict_from_intake(
     """
     dsdict = {}
     mapper_dict = {}
+    loop = asyncio.get_running_loop()
+    openers = {}
+    entries = {}
     for dsname in dsnames:
         print(dsname)
         desc = dotted_get(cat,dsname).to_dict()
@@ -712,7 +820,7 @@ def get_dataset_dict_from_intake(
         if whitelist_paths:
             if not any(a in urlpath for a in whitelist_paths):
                 print("Not in known projects:")
-                print(mdsid)
+                print(dsname)
                 continue
         dictname = dsname if not prefix else prefix + dsname
 
@@ -757,53 +865,58 @@ def get_dataset_dict_from_intake(
                     comb["consolidated"]=False
                 elif args.get("consolidated"):
                     comb["consolidated"]=args.get("consolidated")               
-                try:
-#                if True:
-                    #ds = cat[dsname](**comb).to_dask()
-                    ds,mapper = open_zarr_and_mapper(urlpath, **comb)
-                    ds.encoding["source"]=urlpath
-                    dsdict[dictname] = ds
-                    mapper_dict[urlpath] = mapper
-                    if mdupdate:
-                        ds.attrs.update(md)
-                    # chunks="auto",storage_options=storage_options).to_dask()
-                    ds.attrs["href"] = (
-                        ds.encoding["source"] if ds.encoding["source"] else urlpath
-                    )
-                    ds.attrs["open_kwargs"] = copy(args)
-                    if l_dask:
-                        ds.attrs["total_no_of_chunks"] = sum(
-                            np.prod(var.data.numblocks)
-                            for var in ds.data_vars.values()
-                            if hasattr(var.data, "numblocks")
-                        )
-                    del ds.attrs["open_kwargs"]["urlpath"]
-                    ds.attrs["open_kwargs"].update(dict(engine="zarr"))
-                    dsdict[iakey] = ds
-
-                except:
-                    print("Could not open " + iakey)
-                    continue
+                #ds = cat[dsname](**comb).to_dask()
+                openers[iakey] = partial(
+                    open_zarr_and_mapper, urlpath, loop=loop, **deepcopy(comb)
+                )
+                entries[iakey] = (dictname, urlpath, args, md)
         else:
-            try:
-#            if True:
-                if urlpath.startswith("reference"):
-                    comb["consolidated"]=False
-                elif args.get("consolidated"):
-                    comb["consolidated"]=args.get("consolidated")
-                print(urlpath)
-                print(comb)
-                ds,mapper = open_zarr_and_mapper(urlpath, **comb)                
-#                ds = cat[dsname](**comb).to_dask()
-                if mdupdate:
-                    ds.attrs.update(md)
-                ds.encoding["source"]=urlpath
-                dsdict[dictname] = ds
-                mapper_dict[urlpath] = mapper
-                # chunks="auto",storage_options=storage_options).to_dask()
-            except:
-                print("Could not open " + dsname)
-                continue
+            if urlpath.startswith("reference"):
+                comb["consolidated"]=False
+            elif args.get("consolidated"):
+                comb["consolidated"]=args.get("consolidated")
+            print(urlpath)
+            print(comb)
+#            ds = cat[dsname](**comb).to_dask()
+            openers[dictname] = partial(
+                open_zarr_and_mapper, urlpath, loop=loop, **deepcopy(comb)
+            )
+            entries[dictname] = (None, urlpath, args, md)
+
+    opened = open_concurrently(openers)
+    for key, (ds, mapper) in opened.items():
+        dictname, urlpath, args, md = entries[key]
+        if dictname is None:
+            if mdupdate:
+                ds.attrs.update(md)
+            ds.encoding["source"]=urlpath
+            dsdict[key] = ds
+            mapper_dict[urlpath] = mapper
+            continue
+        try:
+            ds.encoding["source"]=urlpath
+            dsdict[dictname] = ds
+            mapper_dict[urlpath] = mapper
+            if mdupdate:
+                ds.attrs.update(md)
+            # chunks="auto",storage_options=storage_options).to_dask()
+            ds.attrs["href"] = (
+                ds.encoding["source"] if ds.encoding["source"] else urlpath
+            )
+            ds.attrs["open_kwargs"] = copy(args)
+            if l_dask:
+                ds.attrs["total_no_of_chunks"] = sum(
+                    np.prod(var.data.numblocks)
+                    for var in ds.data_vars.values()
+                    if hasattr(var.data, "numblocks")
+                )
+            del ds.attrs["open_kwargs"]["urlpath"]
+            ds.attrs["open_kwargs"].update(dict(engine="zarr"))
+            dsdict[key] = ds
+
+        except:
+            print("Could not open " + key)
+            continue
     return mapper_dict, dsdict
 
 
@@ -0,0 +1,244 @@
+from typing import Any, Callable, Optional
+import asyncio
+import os
+
+from fastapi.responses import Response
+from fsspec.utils import stringify_path
+from fsspec.core import split_protocol
+
+LOCAL_PROTOCOLS = ("file", "local")
+
+
+def _resolve_reference(fsmap: Any, key: str, index: Any = None):
+    """(reference fs, target url, start, end) of a key or None if not resolvable."""
+    fs = getattr(fsmap.fs, "sync_fs", fsmap.fs)
+    if index is not None:
+        ref = index.lookup(key)
+        if ref is None or isinstance(ref, bytes):
+            return None
+        part, start, size = ref
+        end = None if size < 0 else start + size
+    else:
+        if not hasattr(fs, "_cat_common"):
+            return None
+        try:
+            part, start, end = fs._cat_common(fsmap._key_to_str(key))
+        except Exception:
+            return None
+        if isinstance(part, bytes):
+            return None
+    return fs, part, start, end
+
+
+def _target_fs(fs: Any, part: str):
+    protocol, path = split_protocol(stringify_path(part))
+    target_fs = getattr(fs, "fss", {}).get(protocol)
+    if target_fs is None:
+        return None, path
+    return target_fs, path
+
+
+def _protocols(fs: Any) -> tuple:
+    protocols = fs.protocol
+    if isinstance(protocols, str):
+        protocols = (protocols,)
+    return tuple(protocols)
+
+
+def reference_file(fsmap: Any, key: str, index: Any = None) -> Optional[tuple[Any, str]]:
+    """
+    (target filesystem, path) of the file a reference key points into.
+
+    None for inlined or unknown keys and for mappers without references.
+    """
+    resolved = _resolve_reference(fsmap, key, index=index)
+    if resolved is None:
+        return None
+    fs, part, _, _ = resolved
+    target_fs, path = _target_fs(fs, part)
+    if target_fs is None:
+        return None
+    return target_fs, path
+
+
+def reference_target(
+    fsmap: Any, key: str, index: Any = None
+) -> Optional[tuple[str, str]]:
+    """
+    Locate the storage backend a key is read from.
+
+    Args:
+        fsmap: Mapper, on top of a kerchunk ``ReferenceFileSystem`` or not
+        key: Chunk key, e.g. ``tas/0.0``
+        index: Optional compiled ``ReferenceIndex`` of the mapper
+
+    Returns:
+        (protocol, path) of the target, None for inlined or unknown keys.
+    """
+    fs = getattr(fsmap.fs, "sync_fs", fsmap.fs)
+    if not hasattr(fs, "_cat_common"):
+        return _protocols(fs)[0], fsmap._key_to_str(key)
+    located = reference_file(fsmap, key, index=index)
+    if located is None:
+        return None
+    target_fs, path = located
+    return _protocols(target_fs)[0], path
+
+
+def resolve_file_reference(
+    fsmap: Any, key: str, index: Any = None
+) -> Optional[tuple[str, int, int]]:
+    """
+    Resolve a key of a reference mapper to a slice of a local file.
+
+    Args:
+        fsmap: Mapper on top of a kerchunk ``ReferenceFileSystem``
+        key: Chunk key, e.g. ``tas/0.0``
+        index: Optional compiled ``ReferenceIndex`` of the mapper, used
+            instead of the references held by the mapper
+
+    Returns:
+        (path, offset, length) if the key references a local file, None for
+        inlined data, remote targets or mappers without references.
+    """
+    resolved = _resolve_reference(fsmap, key, index=index)
+    if resolved is None:
+        return None
+    fs, part, start, end = resolved
+    target_fs, path = _target_fs(fs, part)
+    if target_fs is None:
+        return None
+    if not any(p in LOCAL_PROTOCOLS for p in _protocols(target_fs)):
+        return None
+
+    if start is None:
+        start = 0
+    if end is None:
+        try:
+            end = os.path.getsize(path)
+        except OSError:
+            return None
+    return path, start, end - start
+
+
+def advise_willneed(path: str, offset: int, length: int):
+    """Ask the kernel to read a file slice into the page cache in the background."""
+    if not hasattr(os, "posix_fadvise"):
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, offset, length, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
+
+
+def open_file_slice(path: str, offset: int, length: int):
+    """
+    Open `path` for sending the slice at `offset` of `length` bytes.
+
+    Raises:
+        OSError: if the file cannot be opened or is too short for the slice
+    """
+    f = open(path, "rb")
+    try:
+        size = os.fstat(f.fileno()).st_size
+        if offset + length > size:
+            raise OSError(f"{path} has {size} bytes, slice ends at {offset + length}")
+    except BaseException:
+        f.close()
+        raise
+    return f
+
+
+class FileSliceResponse(Response):
+    """
+    Response which sends ``length`` bytes of an open file starting at
+    ``offset``. The file is opened by the caller, see `open_file_slice`, so
+    errors opening it are handled before a response is returned. It is
+    closed once the response is finished.
+
+    If the ASGI server supports the ``http.response.zerocopysend`` extension,
+    the kernel copies the bytes with ``sendfile``. uvicorn, which serves
+    cataloghost, supports neither it nor ranged ``pathsend`` and does not
+    expose its socket, so there the slice is read with ``os.pread`` in a
+    thread, in blocks of ``chunk_size``, and each block is copied once into
+    a Python ``bytes`` object. That skips fsspec and its caches and holds at
+    most one block in memory, but it is not zero-copy.
+
+    ``on_close`` is called once the response is finished, e.g. to release a
+    backend slot held while the file is read.
+    """
+
+    chunk_size = 2**20
+
+    def __init__(
+        self,
+        file: Any,
+        offset: int,
+        length: int,
+        status_code: int = 200,
+        headers: Optional[dict] = None,
+        media_type: str = "application/octet-stream",
+        on_close: Optional[Callable] = None,
+    ):
+        self.file = file
+        self.on_close = on_close
+        self.offset = offset
+        self.length = length
+        self.status_code = status_code
+        self.media_type = media_type
+        self.background = None
+        self.init_headers(headers)
+        self.headers["content-length"] = str(length)
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await self._send_slice(scope, send)
+        finally:
+            self.file.close()
+            if self.on_close is not None:
+                self.on_close()
+
+    async def _send_slice(self, scope, send):
+        f = self.file
+        await send(
+            {
+                "type": "http.response.start",
+                "status": self.status_code,
+                "headers": self.raw_headers,
+            }
+        )
+        if scope.get("method") == "HEAD" or self.length == 0:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+
+        if "http.response.zerocopysend" in scope.get("extensions", {}):
+            await send(
+                {
+                    "type": "http.response.zerocopysend",
+                    "file": f,
+                    "offset": self.offset,
+                    "count": self.length,
+                    "more_body": False,
+                }
+            )
+            return
+
+        fd = f.fileno()
+        position = self.offset
+        remaining = self.length
+        while remaining > 0:
+            block = await asyncio.to_thread(
+                os.pread, fd, min(self.chunk_size, remaining), position
+            )
+            if not block:
+                raise OSError(f"Unexpected end of file in {f.name}")
+            position += len(block)
+            remaining -= len(block)
+            await send(
+                {
+                    "type": "http.response.body",
+                    "body": block,
+                    "more_body": remaining > 0,
+                }
+            )
@@ -0,0 +1,222 @@
+from collections import deque
+from typing import Iterable, Optional
+import asyncio
+import time
+
+
+class BackendBusy(Exception):
+    """Raised if no backend slot became free before the queue deadline."""
+
+    def __init__(self, gate: str, retry_after: int):
+        super().__init__(f"Backend {gate} is busy")
+        self.gate = gate
+        self.retry_after = retry_after
+
+
+class _Gate:
+    """Weighted async semaphore with a FIFO wait queue and counters."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.active = 0
+        self.waiters = deque()
+        self.counters = dict(
+            requests=0,
+            queued=0,
+            rejected=0,
+            wait_seconds=0.0,
+            max_wait_seconds=0.0,
+        )
+
+    def _wake(self):
+        while self.waiters:
+            weight, fut = self.waiters[0]
+            if fut.done():
+                self.waiters.popleft()
+                continue
+            if self.active + weight > self.limit:
+                break
+            self.waiters.popleft()
+            self.active += weight
+            fut.set_result(None)
+
+    async def acquire(self, weight: int, timeout: float) -> bool:
+        weight = min(weight, self.limit)
+        self.counters["requests"] += 1
+        if not self.waiters and self.active + weight <= self.limit:
+            self.active += weight
+            return True
+
+        self.counters["queued"] += 1
+        fut = asyncio.get_running_loop().create_future()
+        entry = (weight, fut)
+        self.waiters.append(entry)
+        started = time.monotonic()
+        granted = False
+        try:
+            await asyncio.wait_for(asyncio.shield(fut), timeout)
+            granted = True
+        except asyncio.TimeoutError:
+            self.counters["rejected"] += 1
+        finally:
+            waited = time.monotonic() - started
+            self.counters["wait_seconds"] += waited
+            self.counters["max_wait_seconds"] = max(
+                self.counters["max_wait_seconds"], waited
+            )
+            if not fut.done():
+                fut.cancel()
+                try:
+                    self.waiters.remove(entry)
+                except ValueError:
+                    pass
+                self._wake()
+            elif not granted and not fut.cancelled():
+                # the slot was handed over while the deadline expired
+                self.release(weight)
+        return granted
+
+    def release(self, weight: int):
+        self.active -= min(weight, self.limit)
+        self._wake()
+
+    def stats(self) -> dict:
+        stats = dict(self.counters)
+        stats.update(limit=self.limit, active=self.active, queue_depth=len(self.waiters))
+        return stats
+
+
+class BackendLimiter:
+    """
+    Bound the number of concurrent reads per storage backend.
+
+    Reads are classified by the protocol of their target (``file``, ``https``,
+    ...) and by the mount, i.e. the longest configured path prefix of the
+    target. Each configured protocol and mount has its own limit. Requests
+    above the limit wait in a FIFO queue and only fail with
+    :class:`BackendBusy` if no slot became free within ``queue_timeout``.
+
+    Args:
+        protocol_limits: Concurrent reads per protocol, e.g. ``{"https": 32}``
+        mount_limits: Concurrent reads per path prefix, e.g. ``{"/work/bm1344": 64}``
+        default_limit: Limit for protocols not in `protocol_limits`, 0 for none
+        queue_timeout: Seconds a read may wait for a slot
+        retry_after: Seconds suggested to clients which were rejected
+    """
+
+    def __init__(
+        self,
+        protocol_limits: Optional[dict] = None,
+        mount_limits: Optional[dict] = None,
+        default_limit: int = 0,
+        queue_timeout: float = 30.0,
+        retry_after: int = 10,
+    ):
+        self.protocol_limits = dict(protocol_limits or {})
+        self.mount_limits = {
+            m.rstrip("/") + "/": limit for m, limit in (mount_limits or {}).items()
+        }
+        self.default_limit = default_limit
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self._gates = {}
+
+    def _gate(self, name: str, limit: int) -> _Gate:
+        gate = self._gates.get(name)
+        if gate is None:
+            gate = self._gates[name] = _Gate(limit)
+        return gate
+
+    def gates(self, protocol: str, path: str) -> list[str]:
+        """Names of the gates a read of `path` via `protocol` has to pass."""
+        names = []
+        limit = self.protocol_limits.get(protocol, self.default_limit)
+        if limit > 0:
+            self._gate(f"protocol:{protocol}", limit)
+            names.append(f"protocol:{protocol}")
+        mounts = [m for m in self.mount_limits if path.startswith(m)]
+        if mounts:
+            mount = max(mounts, key=len)
+            self._gate(f"mount:{mount}", self.mount_limits[mount])
+            names.append(f"mount:{mount}")
+        return names
+
+    async def acquire(self, names: Iterable[str], weight: int = 1) -> list:
+        """
+        Take a slot of weight `weight` from each gate in `names`.
+
+        Returns:
+            A token for :meth:`release`
+        """
+        token = []
+        deadline = time.monotonic() + self.queue_timeout
+        try:
+            for name in sorted(set(names)):
+                gate = self._gates[name]
+                if not await gate.acquire(weight, max(deadline - time.monotonic(), 0)):
+                    raise BackendBusy(name, self.retry_after)
+                token.append((gate, weight))
+        except BaseException:
+            self.release(token)
+            raise
+        return token
+
+    def release(self, token: list):
+        for gate, weight in token:
+            gate.release(weight)
+        token.clear()
+
+    def available(self, names: Iterable[str]) -> bool:
+        """True if every gate in `names` has a free slot and no queue."""
+        for name in names:
+            gate = self._gates[name]
+            if gate.waiters or gate.active >= gate.limit:
+                return False
+        return True
+
+    def slot(self, names: Iterable[str], weight: int = 1) -> "_Slot":
+        """Async context manager holding a slot of each gate in `names`."""
+        return _Slot(self, names, weight)
+
+    def stats(self) -> dict:
+        return {name: gate.stats() for name, gate in sorted(self._gates.items())}
+
+
+class _Slot:
+    def __init__(self, limiter: BackendLimiter, names: Iterable[str], weight: int):
+        self.limiter = limiter
+        self.names = list(names)
+        self.weight = weight
+        self.token = []
+
+    async def __aenter__(self):
+        if self.names:
+            self.token = await self.limiter.acquire(self.names, self.weight)
+        return self
+
+    async def __aexit__(self, *exc):
+        self.limiter.release(self.token)
+
+
+class AdmissionQueues(BackendLimiter):
+    """
+    Separate admission queues per request class.
+
+    Each class in `limits` has its own concurrency limit and FIFO queue, so
+    a flood of requests of one class only queues behind itself. Classes
+    without a limit are admitted immediately. Requests waiting longer than
+    ``queue_timeout`` fail with :class:`BackendBusy`.
+
+    Args:
+        limits: Concurrent requests per class, e.g. ``{"bulk": 16}``
+    """
+
+    def __init__(self, limits: dict, queue_timeout: float = 60.0, retry_after: int = 10):
+        super().__init__(queue_timeout=queue_timeout, retry_after=retry_after)
+        for name, limit in limits.items():
+            if limit > 0:
+                self._gate(name, limit)
+
+    def admit(self, name: str, weight: int = 1) -> "_Slot":
+        """Async context manager holding a slot of the class `name`."""
+        return self.slot([name] if name in self._gates else [], weight)
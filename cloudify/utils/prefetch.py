@@ -0,0 +1,215 @@
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable, Optional
+import asyncio
+import re
+
+# v2 keys look like `tas/3.0.0`, v3 keys like `tas/c/3/0/0`
+CHUNK_KEY = re.compile(r"^(?P<var>.+?)/(?P<index>c(?:/\d+)+|\d+(?:\.\d+)*)$")
+
+
+def split_chunk_key(key: str) -> Optional[tuple[str, tuple, bool]]:
+    """(variable, chunk index, is_v3) of a chunk key or None for other keys."""
+    m = CHUNK_KEY.match(key)
+    if m is None:
+        return None
+    index = m.group("index")
+    if index.startswith("c/"):
+        return m.group("var"), tuple(int(i) for i in index[2:].split("/")), True
+    return m.group("var"), tuple(int(i) for i in index.split(".")), False
+
+
+def join_chunk_key(var: str, index: tuple, v3: bool) -> str:
+    if v3:
+        return var + "/c/" + "/".join(map(str, index))
+    return var + "/" + ".".join(map(str, index))
+
+
+class _Stream:
+    __slots__ = ("index", "axis", "run", "ahead")
+
+    def __init__(self, index):
+        self.index = index
+        self.axis = None
+        self.run = 0
+        # position along `axis` up to which chunks are scheduled
+        self.ahead = None
+
+
+class SequentialPrefetcher:
+    """
+    Read ahead for clients walking through the chunks of a variable in order.
+
+    Accesses are tracked per stream, e.g. per (client, dataset, variable).
+    If `trigger` consecutive requests each advanced the same chunk axis by
+    one, the next `depth` chunks along that axis are fetched in the
+    background. At most `max_tasks` fetches and an estimated `max_bytes` are
+    in flight at any time.
+
+    Args:
+        depth: Chunks to read ahead
+        trigger: Consecutive sequential requests before reading ahead
+        max_tasks: Concurrent background fetches
+        max_bytes: Estimated bytes of concurrent background fetches
+        max_streams: Tracked streams, the least recently active are dropped
+    """
+
+    def __init__(
+        self,
+        depth: int = 4,
+        trigger: int = 2,
+        max_tasks: int = 16,
+        max_bytes: int = 256 * 2**20,
+        max_streams: int = 10000,
+    ):
+        self.depth = depth
+        self.trigger = trigger
+        self.max_tasks = max_tasks
+        self.max_bytes = max_bytes
+        self.max_streams = max_streams
+
+        self._streams = OrderedDict()
+        self._tasks = {}
+        self._bytes = 0
+        # prefetched keys, to count how many were requested afterwards
+        self._prefetched = OrderedDict()
+
+        self.counters = dict(
+            observed=0,
+            sequential=0,
+            scheduled=0,
+            completed=0,
+            failed=0,
+            used=0,
+            skipped_budget=0,
+            skipped_backend=0,
+        )
+
+    def observe(self, stream: Hashable, key: str) -> list[str]:
+        """
+        Record a request of `key` and return the keys to read ahead.
+
+        Keys are offered again until they were passed to `schedule`.
+        """
+        self.counters["observed"] += 1
+        if self._prefetched.pop((stream, key), None) is not None:
+            self.counters["used"] += 1
+        parsed = split_chunk_key(key)
+        if parsed is None:
+            return []
+        var, index, v3 = parsed
+        stream = (stream, var)
+
+        state = self._streams.get(stream)
+        if state is None:
+            self._streams[stream] = _Stream(index)
+            while len(self._streams) > self.max_streams:
+                self._streams.popitem(last=False)
+            return []
+        self._streams.move_to_end(stream)
+
+        axis = self._step_axis(state.index, index)
+        if axis is not None and axis == state.axis:
+            state.run += 1
+        elif axis is not None:
+            state.axis, state.run, state.ahead = axis, 1, None
+        else:
+            state.axis, state.run, state.ahead = None, 0, None
+        state.index = index
+        if state.run < self.trigger:
+            return []
+
+        self.counters["sequential"] += 1
+        start = max(index[axis], state.ahead if state.ahead is not None else index[axis])
+        stop = index[axis] + self.depth
+        if start >= stop:
+            return []
+        keys = []
+        for pos in range(start + 1, stop + 1):
+            ahead = index[:axis] + (pos,) + index[axis + 1:]
+            keys.append(join_chunk_key(var, ahead, v3))
+        return keys
+
+    @staticmethod
+    def _step_axis(previous: tuple, index: tuple) -> Optional[int]:
+        """Axis advanced by exactly one chunk from `previous`, else None."""
+        if len(previous) != len(index):
+            return None
+        diff = [i for i, (a, b) in enumerate(zip(previous, index)) if a != b]
+        if len(diff) == 1 and index[diff[0]] == previous[diff[0]] + 1:
+            return diff[0]
+        return None
+
+    def _advance(self, stream: Hashable, key: str):
+        """Mark the stream read ahead up to the scheduled `key`."""
+        parsed = split_chunk_key(key)
+        if parsed is None:
+            return
+        var, index, _ = parsed
+        state = self._streams.get((stream, var))
+        if state is None or state.axis is None or state.axis >= len(index):
+            return
+        position = index[state.axis]
+        if state.ahead is None or position > state.ahead:
+            state.ahead = position
+
+    def has_budget(self, nbytes: int) -> bool:
+        return (
+            len(self._tasks) < self.max_tasks
+            and self._bytes + nbytes <= self.max_bytes
+        )
+
+    def schedule(
+        self,
+        stream: Hashable,
+        key: str,
+        fetch: Callable[[], Awaitable[Any]],
+        nbytes: int,
+    ) -> bool:
+        """
+        Run `fetch` in the background if the budget allows it.
+
+        Args:
+            stream: Stream the key was read ahead for, as passed to `observe`
+            key: Chunk key, fetches already in flight are not repeated
+            fetch: Coroutine function doing the fetch
+            nbytes: Estimated size of the fetched data
+
+        Returns:
+            bool: Whether `key` is being fetched. Keys following one which
+            is not should not be scheduled, they would leave a gap.
+        """
+        task_key = (stream, key)
+        if task_key in self._tasks:
+            self._advance(stream, key)
+            return True
+        if not self.has_budget(nbytes):
+            self.counters["skipped_budget"] += 1
+            return False
+        self._advance(stream, key)
+        self.counters["scheduled"] += 1
+        self._bytes += nbytes
+        task = asyncio.ensure_future(fetch())
+        self._tasks[task_key] = task
+
+        def done(t):
+            self._tasks.pop(task_key, None)
+            self._bytes -= nbytes
+            if t.cancelled() or t.exception() is not None:
+                self.counters["failed"] += 1
+                return
+            self.counters["completed"] += 1
+            self._prefetched[task_key] = True
+            while len(self._prefetched) > self.max_streams:
+                self._prefetched.popitem(last=False)
+
+        task.add_done_callback(done)
+        return True
+
+    def stats(self) -> dict:
+        stats = dict(self.counters)
+        stats.update(
+            streams=len(self._streams),
+            in_flight=len(self._tasks),
+            in_flight_bytes=self._bytes,
+        )
+        return stats
@@ -0,0 +1,193 @@
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, Hashable, Optional
+import asyncio
+import time
+
+INTERACTIVE = "interactive"
+BULK = "bulk"
+
+# dask runs tasks with higher priority first
+PRIORITIES = {INTERACTIVE: 10, BULK: 0}
+
+
+class _Rate:
+    __slots__ = ("start", "count", "previous")
+
+    def __init__(self, start: float):
+        self.start = start
+        self.count = 0
+        self.previous = 0
+
+
+class RequestClassifier:
+    """
+    Sort chunk requests into interactive and bulk requests.
+
+    In this order:
+
+    - an explicit class in the ``X-Priority`` header is used as is
+    - chunks of at least `bulk_chunk_bytes` uncompressed are bulk
+    - clients above `bulk_rate` requests per second are bulk
+    - everything else is interactive
+
+    Request rates are estimated per client with a sliding window of
+    `window` seconds.
+
+    Args:
+        bulk_chunk_bytes: Uncompressed chunk size from which requests are bulk
+        bulk_rate: Requests per second from which a client is bulk
+        window: Seconds of the rate window
+        max_clients: Clients tracked, the least recently active are dropped
+    """
+
+    def __init__(
+        self,
+        bulk_chunk_bytes: int = 64 * 2**20,
+        bulk_rate: float = 20.0,
+        window: float = 10.0,
+        max_clients: int = 10000,
+    ):
+        self.bulk_chunk_bytes = bulk_chunk_bytes
+        self.bulk_rate = bulk_rate
+        self.window = window
+        self.max_clients = max_clients
+        self._rates = OrderedDict()
+        self.counters = {
+            name: dict(requests=0, header=0, size=0, rate=0)
+            for name in PRIORITIES
+        }
+
+    def rate(self, client: Optional[str]) -> float:
+        """Record a request of `client` and return its requests per second."""
+        if not client:
+            return 0.0
+        now = time.monotonic()
+        state = self._rates.get(client)
+        if state is None:
+            state = self._rates[client] = _Rate(now)
+            while len(self._rates) > self.max_clients:
+                self._rates.popitem(last=False)
+        else:
+            self._rates.move_to_end(client)
+        elapsed = now - state.start
+        if elapsed >= 2 * self.window:
+            state.start, state.count, state.previous = now, 0, 0
+        elif elapsed >= self.window:
+            state.start, state.count, state.previous = (
+                state.start + self.window, 0, state.count
+            )
+        state.count += 1
+        weight = 1 - (now - state.start) / self.window
+        return (state.previous * weight + state.count) / self.window
+
+    def classify(
+        self, header: Optional[str], client: Optional[str], chunk_bytes: int
+    ) -> str:
+        rate = self.rate(client)
+        header = (header or "").strip().lower()
+        if header in PRIORITIES:
+            name, reason = header, "header"
+        elif chunk_bytes >= self.bulk_chunk_bytes:
+            name, reason = BULK, "size"
+        elif rate > self.bulk_rate:
+            name, reason = BULK, "rate"
+        else:
+            name, reason = INTERACTIVE, None
+        self.counters[name]["requests"] += 1
+        if reason:
+            self.counters[name][reason] += 1
+        return name
+
+    def stats(self) -> dict:
+        stats = {name: dict(counters) for name, counters in self.counters.items()}
+        stats["clients"] = len(self._rates)
+        return stats
+
+
+class _Flight:
+    __slots__ = ("waiters", "upgraded")
+
+    def __init__(self):
+        self.waiters = {}
+        self.upgraded = asyncio.Event()
+
+    @property
+    def name(self) -> str:
+        return max(
+            (name for name, count in self.waiters.items() if count),
+            key=PRIORITIES.get,
+            default=BULK,
+        )
+
+
+class FlightClasses:
+    """
+    Request classes waiting for shared computations.
+
+    A computation shared by concurrent requests, see
+    :class:`~cloudify.utils.singleflight.AsyncSingleFlight`, is admitted in
+    the queue of the most urgent request waiting for it. If an interactive
+    request joins a computation which still queues as bulk, the computation
+    moves to the interactive queue.
+    """
+
+    def __init__(self):
+        self._flights = {}
+        self.counters = dict(upgraded=0)
+
+    @contextmanager
+    def waiting(self, key: Hashable, name: str):
+        """Register a request of class `name` waiting for the computation `key`."""
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = _Flight()
+        before = flight.name if flight.waiters else None
+        flight.waiters[name] = flight.waiters.get(name, 0) + 1
+        if before is not None and PRIORITIES[flight.name] > PRIORITIES[before]:
+            flight.upgraded.set()
+        try:
+            yield
+        finally:
+            flight.waiters[name] -= 1
+            if not any(flight.waiters.values()) and self._flights.get(key) is flight:
+                del self._flights[key]
+
+    @asynccontextmanager
+    async def admit(self, key: Hashable, admission: Any):
+        """
+        Hold a slot of `admission` for the computation `key` in the queue of
+        the most urgent waiting request and yield that class.
+        """
+        flight = self._flights.get(key) or _Flight()
+        while True:
+            name = flight.name
+            flight.upgraded.clear()
+            slot = admission.admit(name)
+            enter = asyncio.ensure_future(slot.__aenter__())
+            upgraded = asyncio.ensure_future(flight.upgraded.wait())
+            waited = False
+            try:
+                await asyncio.wait(
+                    {enter, upgraded}, return_when=asyncio.FIRST_COMPLETED
+                )
+                waited = True
+            finally:
+                upgraded.cancel()
+                if not enter.done():
+                    enter.cancel()
+                    # the queue entry is removed once the task finished
+                    await asyncio.gather(enter, return_exceptions=True)
+                elif not waited and not enter.cancelled() and enter.exception() is None:
+                    # admitted while this computation was cancelled
+                    await slot.__aexit__(None, None, None)
+            if enter.cancelled():
+                self.counters["upgraded"] += 1
+                continue
+            # raises BackendBusy if the queue timed out
+            enter.result()
+            break
+        try:
+            yield name
+        finally:
+            await slot.__aexit__(None, None, None)
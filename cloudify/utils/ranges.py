@@ -0,0 +1,179 @@
+from typing import Optional, Sequence
+import uuid
+
+from fastapi.responses import Response
+
+# Upper limit of ranges accepted in one request, protects against
+# requests which split one chunk into thousands of tiny parts
+MAX_RANGES = 64
+
+
+def parse_range_header(
+    range_header: Optional[str],
+) -> Optional[list[tuple[Optional[int], Optional[int]]]]:
+    """
+    Parse an HTTP ``Range`` header of the ``bytes`` unit.
+
+    Args:
+        range_header: Value of the ``Range`` header, e.g. ``bytes=0-99,200-``
+
+    Returns:
+        List of (first, last) tuples with inclusive positions. ``first`` is None
+        for suffix ranges (``-500``) and ``last`` is None for open ranges
+        (``100-``). None if the header is absent, malformed or not a byte range,
+        in which case the full object has to be returned.
+    """
+    if not range_header:
+        return None
+    unit, _, spec = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or not spec:
+        return None
+
+    ranges = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        first, sep, last = part.partition("-")
+        if not sep:
+            return None
+        first, last = first.strip(), last.strip()
+        try:
+            if not first:
+                if not last:
+                    return None
+                ranges.append((None, int(last)))
+            else:
+                ranges.append((int(first), int(last) if last else None))
+        except ValueError:
+            return None
+        if ranges[-1][1] is not None and ranges[-1][0] is not None:
+            if ranges[-1][1] < ranges[-1][0]:
+                return None
+    if not ranges or len(ranges) > MAX_RANGES:
+        return None
+    return ranges
+
+
+def resolve_ranges(
+    ranges: Sequence[tuple[Optional[int], Optional[int]]], size: int
+) -> list[tuple[int, int]]:
+    """
+    Turn parsed ranges into absolute, inclusive ranges for an object of ``size`` bytes.
+
+    Unsatisfiable ranges are dropped. An empty result means the request has
+    to be answered with 416.
+
+    Args:
+        ranges: Output of :func:`parse_range_header`
+        size: Total length of the object
+
+    Returns:
+        list[tuple[int, int]]: (first, last) byte positions, both inclusive
+    """
+    resolved = []
+    for first, last in ranges:
+        if first is None:
+            if last == 0 or size == 0:
+                continue
+            first = max(size - last, 0)
+            last = size - 1
+        else:
+            if first >= size:
+                continue
+            if last is None or last >= size:
+                last = size - 1
+        resolved.append((first, last))
+    return resolved
+
+
+def content_range(first: int, last: int, size: Optional[int]) -> str:
+    total = "*" if size is None else str(size)
+    return f"bytes {first}-{last}/{total}"
+
+
+def not_satisfiable_response(size: Optional[int]) -> Response:
+    resp = Response(status_code=416)
+    resp.headers["Content-Range"] = f"bytes */{'*' if size is None else size}"
+    return resp
+
+
+def partial_response(
+    parts: Sequence[bytes],
+    ranges: Sequence[tuple[int, int]],
+    size: Optional[int],
+    media_type: str = "application/octet-stream",
+) -> Response:
+    """
+    Build a 206 response for already fetched byte ranges.
+
+    A single range is returned as plain body with ``Content-Range``, several
+    ranges as ``multipart/byteranges``.
+
+    Args:
+        parts: Bytes for each range, in the same order as ``ranges``
+        ranges: Absolute inclusive (first, last) positions
+        size: Total length of the object, None if unknown
+        media_type: Media type of the full object
+
+    Returns:
+        Response: Partial content response
+    """
+    if len(parts) == 1:
+        resp = Response(parts[0], status_code=206, media_type=media_type)
+        resp.headers["Content-Range"] = content_range(*ranges[0], size)
+    else:
+        boundary = uuid.uuid4().hex
+        body = []
+        for (first, last), part in zip(ranges, parts):
+            body.append(
+                (
+                    f"--{boundary}\r\n"
+                    f"Content-Type: {media_type}\r\n"
+                    f"Content-Range: {content_range(first, last, size)}\r\n\r\n"
+                ).encode()
+            )
+            body.append(part)
+            body.append(b"\r\n")
+        body.append(f"--{boundary}--\r\n".encode())
+        resp = Response(
+            b"".join(body),
+            status_code=206,
+            media_type=f"multipart/byteranges; boundary={boundary}",
+        )
+    resp.headers["Accept-Ranges"] = "bytes"
+    return resp
+
+
+def range_response_from_bytes(
+    data: bytes,
+    range_header: Optional[str],
+    media_type: str = "application/octet-stream",
+) -> Response:
+    """
+    Answer a (possibly ranged) request from an object which is fully in memory.
+
+    Args:
+        data: The complete object
+        range_header: Value of the ``Range`` header, may be None
+        media_type: Media type of the object
+
+    Returns:
+        Response: 200, 206 or 416 response
+    """
+    ranges = parse_range_header(range_header)
+    if ranges is None:
+        resp = Response(data, media_type=media_type)
+        resp.headers["Accept-Ranges"] = "bytes"
+        return resp
+    size = len(data)
+    resolved = resolve_ranges(ranges, size)
+    if not resolved:
+        return not_satisfiable_response(size)
+    view = memoryview(data)
+    return partial_response(
+        [view[first:last + 1] for first, last in resolved],
+        resolved,
+        size,
+        media_type=media_type,
+    )
@@ -0,0 +1,154 @@
+from typing import Any, Hashable, Iterable
+import asyncio
+import time
+
+QUEUED = "queued"
+STAGING = "staging"
+STAGED = "staged"
+FAILED = "failed"
+
+
+class RecallScheduler:
+    """
+    Stage files from tape in bulk instead of one chunk at a time.
+
+    Requested files are collected for `window` seconds per target filesystem,
+    deduplicated and sorted by their position on tape. If the filesystem
+    does not expose positions (a ``tape_position(paths)`` method returning a
+    sortable position per path), files are sorted by path, which keeps files
+    archived together next to each other. The sorted files are then recalled
+    in batches of `batch_size` with one-byte reads.
+
+    Progress is tracked per dataset so that clients can poll how much of
+    their order is on disk.
+
+    Args:
+        batch_size: Files per recall batch
+        window: Seconds to collect requests before the first batch
+        staged_ttl: Seconds after which a staged file is recalled again if
+            requested, as the HSM may have released it from disk meanwhile
+    """
+
+    def __init__(
+        self, batch_size: int = 100, window: float = 5.0, staged_ttl: float = 24 * 3600
+    ):
+        self.batch_size = batch_size
+        self.window = window
+        self.staged_ttl = staged_ttl
+
+        self._files = {}
+        self._errors = {}
+        self._staged_at = {}
+        self._datasets = {}
+        self._pending = {}
+        self._workers = {}
+        self.counters = dict(
+            requested=0,
+            deduplicated=0,
+            batches=0,
+            staged=0,
+            failed=0,
+        )
+
+    def submit(self, dataset: Hashable, fs: Any, paths: Iterable[str]) -> int:
+        """
+        Queue the recall of `paths` on the filesystem `fs` for `dataset`.
+
+        Returns:
+            int: Number of files newly queued, files which are already
+            queued, staging or staged are not recalled again
+        """
+        requested = self._datasets.setdefault(dataset, set())
+        queued = 0
+        expired = time.monotonic() - self.staged_ttl
+        for path in paths:
+            self.counters["requested"] += 1
+            requested.add(path)
+            state = self._files.get(path, FAILED)
+            if state == STAGED and self._staged_at[path] < expired:
+                state = FAILED
+            if state != FAILED:
+                self.counters["deduplicated"] += 1
+                continue
+            self._files[path] = QUEUED
+            self._errors.pop(path, None)
+            self._pending.setdefault(id(fs), (fs, []))[1].append(path)
+            queued += 1
+        if queued and id(fs) not in self._workers:
+            self._workers[id(fs)] = asyncio.ensure_future(self._drain(id(fs)))
+        return queued
+
+    async def _drain(self, fs_key: int):
+        try:
+            # let further requests of the same sweep arrive
+            await asyncio.sleep(self.window)
+            while True:
+                fs, paths = self._pending.pop(fs_key, (None, []))
+                if not paths:
+                    return
+                ordered = await self._order(fs, paths)
+                for i in range(0, len(ordered), self.batch_size):
+                    await self._stage(fs, ordered[i:i + self.batch_size])
+        finally:
+            self._workers.pop(fs_key, None)
+
+    async def _order(self, fs: Any, paths: list) -> list:
+        tape_position = getattr(fs, "tape_position", None)
+        if tape_position is None:
+            return sorted(paths)
+        try:
+            positions = await asyncio.to_thread(tape_position, paths)
+        except Exception as e:
+            print(f"Could not get tape positions: {e}")
+            return sorted(paths)
+        # files without a known position go last
+        known = sorted(p for p in paths if positions.get(p) is not None)
+        known.sort(key=positions.get)
+        return known + sorted(p for p in paths if positions.get(p) is None)
+
+    async def _stage(self, fs: Any, batch: list):
+        self.counters["batches"] += 1
+        for path in batch:
+            self._files[path] = STAGING
+        starts, ends = [0] * len(batch), [1] * len(batch)
+        try:
+            if getattr(fs, "async_impl", False) and getattr(fs, "asynchronous", False):
+                results = await fs._cat_ranges(batch, starts, ends, on_error="return")
+            else:
+                results = await asyncio.to_thread(
+                    fs.cat_ranges, batch, starts, ends, on_error="return"
+                )
+        except Exception as e:
+            results = [e] * len(batch)
+        for path, result in zip(batch, results):
+            if isinstance(result, Exception):
+                self._files[path] = FAILED
+                self._errors[path] = str(result)
+                self.counters["failed"] += 1
+            else:
+                self._files[path] = STAGED
+                self._staged_at[path] = time.monotonic()
+                self.counters["staged"] += 1
+
+    def status(self, dataset: Hashable) -> dict:
+        """Staging progress of the files requested for `dataset`."""
+        paths = self._datasets.get(dataset, set())
+        states = {QUEUED: 0, STAGING: 0, STAGED: 0, FAILED: 0}
+        for path in paths:
+            states[self._files[path]] += 1
+        errors = {p: self._errors[p] for p in sorted(paths) if p in self._errors}
+        return dict(
+            files=len(paths),
+            progress=states[STAGED] / len(paths) if paths else 1.0,
+            errors=dict(list(errors.items())[:20]),
+            **states,
+        )
+
+    def stats(self) -> dict:
+        stats = dict(self.counters)
+        stats.update(
+            files=len(self._files),
+            queued=sum(len(paths) for _, paths in self._pending.values()),
+            workers=len(self._workers),
+        )
+        return stats
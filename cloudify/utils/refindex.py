@@ -0,0 +1,323 @@
+from collections.abc import Mapping
+from pathlib import Path
+from typing import Any, Hashable, Iterator, Optional, Union
+import base64
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import fsspec
+import numpy as np
+from filelock import FileLock
+
+INDEX_VERSION = 2
+# path id of references with inlined data, their offset/size point into inline.bin
+INLINE = -1
+# size of references to a whole file
+WHOLE_FILE = -1
+
+ARRAYS = ["hashes", "path_ids", "offsets", "sizes", "bucket_starts", "key_offsets"]
+
+# Remote references without a modification time or ETag are recompiled
+# after this many seconds
+REMOTE_INDEX_TTL = int(os.environ.get("CLOUDIFY_REMOTE_INDEX_TTL", 24 * 3600))
+
+
+def key_hash(key: str) -> int:
+    """64 bit hash of a chunk key, stable across processes."""
+    return int.from_bytes(
+        hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "little"
+    )
+
+
+def get_reference_dict(fsmap: Any):
+    """Return the reference mapping of a mapper on a ReferenceFileSystem or None."""
+    fs = getattr(fsmap.fs, "sync_fs", fsmap.fs)
+    return getattr(fs, "references", None)
+
+
+def _reference_version(path: str) -> str:
+    """Modification time, ETag or a time bucket of the references at `path`."""
+    try:
+        return str(os.stat(path).st_mtime_ns)
+    except OSError:
+        pass
+    try:
+        fs, fspath = fsspec.core.url_to_fs(path)
+        info = fs.info(fspath)
+    except Exception:
+        info = {}
+    version = [
+        str(info[name])
+        for name in ["ETag", "etag", "mtime", "LastModified", "last_modified", "Last-Modified", "size"]
+        if info.get(name) is not None
+    ]
+    if len(version) <= 1:
+        # a size alone does not tell about rewritten references
+        version.append(str(int(time.time() // REMOTE_INDEX_TTL)))
+    return "-".join(version)
+
+
+def index_fingerprint(source: str) -> str:
+    """Identify the compiled index of `source`, changes when the references are rewritten."""
+    version = _reference_version(source.split("::")[-1])
+    return hashlib.sha256(f"{INDEX_VERSION}\0{source}\0{version}".encode()).hexdigest()
+
+
+def compile_reference_index(references: Any, out_dir: Union[str, Path], source: str = "") -> Path:
+    """
+    Compile kerchunk references into a compact columnar index on disk.
+
+    Paths are interned into a table, offsets and sizes are stored as numpy
+    arrays and small inlined chunks are concatenated into one blob. Keys are
+    bucketed by a 64 bit hash, so a lookup touches only a few entries of the
+    memory-mapped arrays, and stored in a blob to verify a match.
+
+    Args:
+        references: Mapping of key to reference as found in
+            ``ReferenceFileSystem.references`` (dict or lazy parquet mapper)
+        out_dir: Target directory, replaced atomically
+        source: Dataset source, stored for information only
+
+    Returns:
+        Path: The index directory
+    """
+    out_dir = Path(out_dir)
+    path_table = {}
+    hashes, path_ids, offsets, sizes, keys = [], [], [], [], []
+    inline = bytearray()
+
+    for key in references:
+        try:
+            ref = references[key]
+        except KeyError:
+            continue
+        if isinstance(ref, str):
+            ref = ref.encode()
+        if isinstance(ref, (bytes, bytearray)):
+            if ref.startswith(b"base64:"):
+                ref = base64.b64decode(ref[7:])
+            path_id, offset, size = INLINE, len(inline), len(ref)
+            inline += ref
+        else:
+            ref = list(ref)
+            path_id = path_table.setdefault(ref[0], len(path_table))
+            if len(ref) == 1:
+                offset, size = 0, WHOLE_FILE
+            else:
+                offset, size = int(ref[1]), int(ref[2])
+        hashes.append(key_hash(key))
+        keys.append(key.encode("utf-8"))
+        path_ids.append(path_id)
+        offsets.append(offset)
+        sizes.append(size)
+
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    nbuckets = 1 << max(int(len(hashes)).bit_length(), 1)
+    buckets = hashes & np.uint64(nbuckets - 1)
+    order = np.argsort(buckets, kind="stable")
+    keys = [keys[i] for i in order]
+    arrays = dict(
+        hashes=hashes[order],
+        path_ids=np.asarray(path_ids, dtype=np.int32)[order],
+        offsets=np.asarray(offsets, dtype=np.int64)[order],
+        sizes=np.asarray(sizes, dtype=np.int64)[order],
+        bucket_starts=np.searchsorted(
+            buckets[order], np.arange(nbuckets + 1, dtype=np.uint64)
+        ).astype(np.int64),
+        key_offsets=np.cumsum([0] + [len(k) for k in keys], dtype=np.int64),
+    )
+
+    out_dir.parent.mkdir(parents=True, exist_ok=True)
+    tmp_dir = Path(tempfile.mkdtemp(prefix="tmp", dir=out_dir.parent))
+    try:
+        for name, arr in arrays.items():
+            np.save(tmp_dir / f"{name}.npy", arr)
+        (tmp_dir / "inline.bin").write_bytes(bytes(inline))
+        (tmp_dir / "keys.bin").write_bytes(b"".join(keys))
+        (tmp_dir / "paths.json").write_text(
+            json.dumps(sorted(path_table, key=path_table.get))
+        )
+        (tmp_dir / "meta.json").write_text(json.dumps(dict(
+            version=INDEX_VERSION,
+            source=source,
+            count=len(hashes),
+            nbuckets=nbuckets,
+        )))
+        if out_dir.exists():
+            shutil.rmtree(out_dir)
+        os.replace(tmp_dir, out_dir)
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    return out_dir
+
+
+def _map_blob(path: Path) -> np.ndarray:
+    if path.stat().st_size:
+        return np.memmap(path, dtype=np.uint8, mode="r")
+    return np.zeros(0, dtype=np.uint8)
+
+
+class ReferenceIndex(Mapping):
+    """
+    Read-only view on a compiled reference index.
+
+    All arrays are memory-mapped, so processes opening the same index share
+    its pages through the OS page cache instead of each holding their own
+    copy of the references. As a mapping, it gives the references in the
+    form of ``ReferenceFileSystem.references`` and can replace them, see
+    :func:`replace_references`.
+    """
+
+    def __init__(self, index_dir: Union[str, Path]):
+        self.index_dir = Path(index_dir)
+        self.meta = json.loads((self.index_dir / "meta.json").read_text())
+        if self.meta.get("version") != INDEX_VERSION:
+            raise ValueError(f"Incompatible reference index in {index_dir}")
+        for name in ARRAYS:
+            setattr(self, name, np.load(self.index_dir / f"{name}.npy", mmap_mode="r"))
+        self.paths = json.loads((self.index_dir / "paths.json").read_text())
+        self.inline = _map_blob(self.index_dir / "inline.bin")
+        self.keys_blob = _map_blob(self.index_dir / "keys.bin")
+        self.mask = self.meta["nbuckets"] - 1
+
+    def __len__(self) -> int:
+        return self.meta["count"]
+
+    def __contains__(self, key: str) -> bool:
+        return self._find(key) is not None
+
+    def _key(self, i: int) -> bytes:
+        return self.keys_blob[self.key_offsets[i]:self.key_offsets[i + 1]].tobytes()
+
+    def __iter__(self) -> Iterator[str]:
+        for i in range(len(self)):
+            yield self._key(i).decode("utf-8")
+
+    def __getitem__(self, key: str) -> Union[bytes, list]:
+        ref = self.lookup(key)
+        if ref is None:
+            raise KeyError(key)
+        if isinstance(ref, bytes):
+            return ref
+        url, offset, size = ref
+        return [url] if size == WHOLE_FILE else [url, offset, size]
+
+    def _find(self, key: str) -> Optional[int]:
+        h = key_hash(key)
+        target = np.uint64(h)
+        encoded = key.encode("utf-8")
+        bucket = h & self.mask
+        start, stop = self.bucket_starts[bucket], self.bucket_starts[bucket + 1]
+        for i in range(start, stop):
+            # hashes can collide, the stored key decides
+            if self.hashes[i] == target and self._key(i) == encoded:
+                return i
+        return None
+
+    def lookup(self, key: str) -> Optional[Union[bytes, tuple[str, int, int]]]:
+        """
+        Look up a key.
+
+        Returns:
+            None if the key is unknown, the bytes of inlined references or
+            (url, offset, size) with size -1 for whole-file references.
+        """
+        i = self._find(key)
+        if i is None:
+            return None
+        offset, size = int(self.offsets[i]), int(self.sizes[i])
+        path_id = int(self.path_ids[i])
+        if path_id == INLINE:
+            return self.inline[offset:offset + size].tobytes()
+        return self.paths[path_id], offset, size
+
+
+def open_reference_index(fsmap: Any, source: str, index_root: Union[str, Path]) -> Optional[ReferenceIndex]:
+    """
+    Open the compiled index for `source`, compile it first if it is missing.
+
+    A file lock makes sure only one of several server processes compiles an
+    index while the others wait for it.
+
+    Returns:
+        ReferenceIndex or None if the mapper does not hold kerchunk references
+    """
+    references = get_reference_dict(fsmap)
+    if references is None:
+        return None
+    index_root = Path(index_root)
+    index_root.mkdir(parents=True, exist_ok=True)
+    index_dir = index_root / index_fingerprint(source)
+    with FileLock(str(index_dir) + ".lock"):
+        if not (index_dir / "meta.json").exists():
+            compile_reference_index(references, index_dir, source=source)
+    return ReferenceIndex(index_dir)
+
+
+def replace_references(fsmap: Any, index: ReferenceIndex) -> bool:
+    """
+    Let the ReferenceFileSystem of `fsmap` read its references from `index`
+    and drop the in-memory dict, so the index is the only copy in the
+    process. Lazily loaded parquet references are kept, their memory is
+    bounded already.
+
+    Returns:
+        True if the references were replaced
+    """
+    fs = getattr(fsmap.fs, "sync_fs", fsmap.fs)
+    if not isinstance(getattr(fs, "references", None), dict):
+        return False
+    fs.references = index
+    fs.dircache.clear()
+    return True
+
+
+def reference_grid(fsmap: Any, var: str) -> Optional[tuple[tuple, tuple]]:
+    """
+    (shape, chunks) of the variable `var` in the references of `fsmap`, None
+    if it has no array metadata there.
+    """
+    references = get_reference_dict(fsmap)
+    if references is None:
+        return None
+    try:
+        zarray = references[f"{var}/.zarray"]
+    except KeyError:
+        return None
+    try:
+        zarray = json.loads(zarray)
+        return tuple(zarray["shape"]), tuple(zarray["chunks"])
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+def affinity_target(fsmap: Any, key: str) -> Optional[Hashable]:
+    """
+    What the chunk `key` of the references of `fsmap` is read from: the url
+    of a JSON reference, or (variable, record) of lazily loaded parquet
+    references, whose records are separate files.
+
+    Returns:
+        None for inlined data and unknown keys
+    """
+    references = get_reference_dict(fsmap)
+    if references is None:
+        return None
+    if hasattr(references, "record_size"):
+        try:
+            record, _, _ = references._key_to_record(key)
+        except (KeyError, ValueError):
+            return None
+        return key.rsplit("/", 1)[0], record
+    try:
+        ref = references[key]
+    except KeyError:
+        return None
+    if isinstance(ref, (bytes, str)):
+        return None
+    return ref[0]
@@ -0,0 +1,226 @@
+from typing import Any, Optional, Sequence
+import math
+
+import numpy as np
+from xarray.backends.zarr import DIMENSION_KEY, FillValueCoder
+
+ZARR_V3_FORMAT = 3
+ZARR_V3_METADATA_KEY = "zarr.json"
+
+# Index entry of an inner chunk which is not stored in the shard
+EMPTY_CHUNK = 2**64 - 1
+
+BLOSC_SHUFFLE = {0: "noshuffle", 1: "shuffle", 2: "bitshuffle"}
+
+
+def shard_factors(
+    chunks: Sequence[int],
+    numblocks: Sequence[int],
+    itemsize: int,
+    max_chunks: int = 64,
+    max_bytes: int = 256 * 2**20,
+) -> tuple:
+    """
+    Inner chunks per shard along each dimension.
+
+    Factors are doubled dimension by dimension, so shards stay roughly
+    square in chunk space, as long as a shard has at most `max_chunks`
+    inner chunks of at most `max_bytes` uncompressed and does not exceed
+    the number of chunks of the array.
+    """
+    factors = [1] * len(chunks)
+    chunk_bytes = math.prod(chunks) * itemsize
+    grown = True
+    while grown:
+        grown = False
+        for dim, nblocks in enumerate(numblocks):
+            if factors[dim] >= nblocks:
+                continue
+            new = min(factors[dim] * 2, nblocks)
+            total = math.prod(factors) // factors[dim] * new
+            if total > max_chunks or total * chunk_bytes > max_bytes:
+                continue
+            factors[dim] = new
+            grown = True
+    return tuple(factors)
+
+
+def shard_chunks(
+    shard: Sequence[int], factors: Sequence[int], numblocks: Sequence[int]
+) -> list[tuple[int, tuple]]:
+    """
+    (position in the shard index, chunk index of the array) of each inner
+    chunk of `shard` inside the array, in C order.
+    """
+    inner = []
+    for position, local in enumerate(np.ndindex(*factors)):
+        ikeys = tuple(s * f + l for s, f, l in zip(shard, factors, local))
+        if all(i < n for i, n in zip(ikeys, numblocks)):
+            inner.append((position, ikeys))
+    return inner
+
+
+def assemble_shard(*chunks, positions: Sequence[int], nchunks: int) -> bytes:
+    """
+    Concatenate encoded inner chunks into a shard with the index at its end.
+
+    The index holds a little endian (offset, nbytes) uint64 pair for each of
+    the `nchunks` inner chunks in C order, chunks not in `positions` are
+    marked as empty.
+    """
+    parts = []
+    for chunk in chunks:
+        if not isinstance(chunk, (bytes, memoryview)):
+            chunk = memoryview(np.ascontiguousarray(chunk)).cast("B")
+        parts.append(chunk)
+    index = shard_index(positions, [memoryview(c).nbytes for c in parts], nchunks)
+    parts.append(index.tobytes())
+    return b"".join(parts)
+
+
+def shard_index(positions: Sequence[int], sizes: Sequence[int], nchunks: int) -> np.ndarray:
+    """
+    Index of a shard whose inner chunks at `positions` have the encoded
+    `sizes` and are stored in that order, see `assemble_shard`.
+    """
+    index = np.full((nchunks, 2), EMPTY_CHUNK, dtype="<u8")
+    offset = 0
+    for position, nbytes in zip(positions, sizes):
+        index[position] = (offset, nbytes)
+        offset += nbytes
+    return index
+
+
+def shard_size(index: np.ndarray) -> int:
+    """Length in bytes of the shard with `index`, including the index."""
+    stored = index[:, 0] != EMPTY_CHUNK
+    return int(index[stored, 1].sum()) + index.nbytes
+
+
+def v3_data_type(dtype: np.dtype) -> Optional[str]:
+    """Zarr v3 name of a numpy dtype, None for types without core v3 support."""
+    if dtype.kind == "b":
+        return "bool"
+    if dtype.kind in "iufc":
+        return dtype.name
+    return None
+
+
+def v3_fill_value(fill_value: Any, dtype: np.dtype) -> Any:
+    """Zarr v3 array fill value from an encoded v2 fill value."""
+    if fill_value is None:
+        return False if dtype.kind == "b" else 0
+    return fill_value
+
+
+def _decode_fill_value(fill_value: Any) -> Any:
+    if isinstance(fill_value, str):
+        return float(fill_value.replace("Infinity", "inf"))
+    return fill_value
+
+
+def v3_compressor(config: dict, dtype: np.dtype) -> dict:
+    """Zarr v3 codec of a numcodecs compressor config."""
+    config = dict(config)
+    codec_id = config.pop("id")
+    if codec_id == "blosc":
+        shuffle = config.get("shuffle", 1)
+        if shuffle == -1:
+            shuffle = 2 if dtype.itemsize == 1 else 1
+        return dict(
+            name="blosc",
+            configuration=dict(
+                cname=config["cname"],
+                clevel=config["clevel"],
+                shuffle=BLOSC_SHUFFLE[shuffle],
+                typesize=dtype.itemsize,
+                blocksize=config.get("blocksize", 0),
+            ),
+        )
+    if codec_id == "zstd":
+        return dict(
+            name="zstd",
+            configuration=dict(
+                level=config.get("level", 0), checksum=config.get("checksum", False)
+            ),
+        )
+    if codec_id == "gzip":
+        return dict(name="gzip", configuration=dict(level=config.get("level", 1)))
+    return dict(name=f"numcodecs.{codec_id}", configuration=config)
+
+
+def v3_bytes_codec(dtype: np.dtype) -> dict:
+    if dtype.itemsize == 1:
+        return dict(name="bytes")
+    endian = "big" if dtype.byteorder == ">" else "little"
+    return dict(name="bytes", configuration=dict(endian=endian))
+
+
+def v3_array_metadata(zarray: dict, zattrs: dict, factors: Sequence[int]) -> Optional[dict]:
+    """
+    Zarr v3 metadata of a sharded array from its v2 ``.zarray`` and ``.zattrs``.
+
+    The v2 chunks become the inner chunks, `factors` of them along each
+    dimension form a shard. The compressor has to be a config dict. Filters
+    are applied when the chunks are computed and are not declared, as for
+    the v2 endpoint.
+
+    Returns:
+        The ``zarr.json`` of the array, None for unsupported data types
+    """
+    dtype = np.dtype(zarray["dtype"])
+    data_type = v3_data_type(dtype)
+    if data_type is None:
+        return None
+    attributes = dict(zattrs)
+    dimension_names = attributes.pop(DIMENSION_KEY, None)
+    if zarray.get("fill_value") is not None:
+        attributes["_FillValue"] = FillValueCoder.encode(
+            _decode_fill_value(zarray["fill_value"]), dtype
+        )
+
+    inner_codecs = [v3_bytes_codec(dtype)]
+    if zarray.get("compressor") is not None:
+        inner_codecs.append(v3_compressor(zarray["compressor"], dtype))
+    chunks = list(zarray["chunks"])
+    return dict(
+        zarr_format=ZARR_V3_FORMAT,
+        node_type="array",
+        shape=list(zarray["shape"]),
+        data_type=data_type,
+        chunk_grid=dict(
+            name="regular",
+            configuration=dict(
+                chunk_shape=[c * f for c, f in zip(chunks, factors)]
+            ),
+        ),
+        chunk_key_encoding=dict(name="default", configuration=dict(separator="/")),
+        fill_value=v3_fill_value(zarray.get("fill_value"), dtype),
+        codecs=[
+            dict(
+                name="sharding_indexed",
+                configuration=dict(
+                    chunk_shape=chunks,
+                    codecs=inner_codecs,
+                    index_codecs=[dict(name="bytes", configuration=dict(endian="little"))],
+                    index_location="end",
+                ),
+            )
+        ],
+        attributes=attributes,
+        dimension_names=dimension_names,
+    )
+
+
+def v3_group_metadata(attributes: dict, arrays: dict) -> dict:
+    """Zarr v3 ``zarr.json`` of the root group with inline consolidated metadata."""
+    return dict(
+        zarr_format=ZARR_V3_FORMAT,
+        node_type="group",
+        attributes=attributes,
+        consolidated_metadata=dict(
+            kind="inline",
+            must_understand=False,
+            metadata=arrays,
+        ),
+    )
@@ -0,0 +1,83 @@
+from typing import Any, Callable, Hashable
+import asyncio
+import threading
+
+
+class AsyncSingleFlight:
+    """
+    Coalesce concurrent identical coroutine calls.
+
+    While a call for a key is in flight, further calls for the same key wait
+    for its result instead of starting their own. The shared call is shielded,
+    so a client disconnecting does not cancel it for the others.
+    """
+
+    def __init__(self):
+        self._inflight = {}
+        self.counters = dict(calls=0, coalesced=0)
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._inflight)
+
+    async def do(self, key: Hashable, func: Callable, *args, **kwargs) -> Any:
+        self.counters["calls"] += 1
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func(*args, **kwargs))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._inflight.pop(key, None))
+        else:
+            self.counters["coalesced"] += 1
+        return await asyncio.shield(task)
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Thread based variant of :class:`AsyncSingleFlight` for sync handlers
+    which run in the threadpool of the server.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.counters = dict(calls=0, coalesced=0)
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._calls)
+
+    def do(self, key: Hashable, func: Callable, *args, **kwargs) -> Any:
+        with self._lock:
+            self.counters["calls"] += 1
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+            else:
+                self.counters["coalesced"] += 1
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result
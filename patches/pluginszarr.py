@@ -1,9 +1,14 @@
+import asyncio
+import copy
 import logging
+import math
+import os
 from typing import Sequence
 from datetime import datetime
 todaystring=datetime.today().strftime("%a, %d %b %Y %H:%M:%S GMT")
 
 import cachey  # type: ignore
+import numpy as np
 import xarray as xr
 from fastapi import APIRouter, Depends, HTTPException, Path, Request
 from starlette.responses import Response  # type: ignore
@@ -16,20 +21,41 @@ from ...utils.cache import CostTimer
 from ...utils.zarr import (
     ZARR_METADATA_KEY,
     array_meta_key,
+    as_buffer,
     attrs_key,
+    ChunkTooLarge,
+    admission,
+    chunk_batcher,
+    classified_flight,
     encode_chunk,
-    get_data_chunk,
+    get_data_chunk_async,
     get_zmetadata,
     get_zvariables,
     group_meta_key,
     jsonify_zmetadata,
+    flight_classes,
+    memory_admission,
+    request_classifier,
+    worker_affinity,
 )
 
 # type: ignore
 from .. import Dependencies, Plugin, hookimpl
 
+from cloudify.utils.clients import client_id
+from cloudify.utils.limiter import BackendBusy
+from cloudify.utils.singleflight import AsyncSingleFlight
+
 logger = logging.getLogger('zarr_api')
 
+# Concurrent requests for the same chunk share one dask computation
+chunk_flights = AsyncSingleFlight()
+
+# Encoded chunks, weighted by the time it took to compute them. This is
+# separate from the app cache which holds metadata and may be sized to zero.
+ZARR_CHUNK_CACHE_BYTES = int(os.environ.get("ZARR_CHUNK_CACHE_BYTES", 512 * 2**20))
+chunk_cache = cachey.Cache(available_bytes=ZARR_CHUNK_CACHE_BYTES)
+
 def validate_dask_arrays(dataset):
     """Raise an error if any data variable is not a Dask array"""
     non_dask_vars = [
@@ -47,9 +73,36 @@ class ZarrPlugin(Plugin):
 
     name: str = 'zarr'
 
+    app_router_prefix: str = '/zarr'
+    app_router_tags: Sequence[str] = ['zarr']
+
     dataset_router_prefix: str = '/zarr'
     dataset_router_tags: Sequence[str] = ['zarr']
 
+    @hookimpl
+    def app_router(self):  # noqa: D102
+        router = APIRouter(prefix=self.app_router_prefix, tags=list(self.app_router_tags))
+
+        @router.get('/stats')
+        def get_stats():
+            """Queues per request class and chunk computation counters."""
+            return JSONResponse(
+                dict(
+                    classes=request_classifier.stats(),
+                    admission=admission.stats(),
+                    affinity=dict(worker_affinity.counters),
+                    memory=memory_admission.stats(),
+                    batches=dict(chunk_batcher.counters),
+                    flights=dict(
+                        chunk_flights.counters,
+                        in_flight=chunk_flights.in_flight,
+                        **flight_classes.counters,
+                    ),
+                )
+            )
+
+        return router
+
     @hookimpl
     def dataset_router(self, deps: Dependencies) -> APIRouter:  # noqa: D102
         router = APIRouter(
@@ -96,7 +149,7 @@ class ZarrPlugin(Plugin):
             return JSONResponse(zmetadata['metadata'][attrs_key])
 
         @router.api_route('/{var}/{chunk}',methods=['GET', 'HEAD'])        
-        def get_variable_chunk(
+        async def get_variable_chunk(
             request: Request,                
             var: str = Path(description='Variable in dataset'),
             chunk: str = Path(description='Zarr chunk'),
@@ -111,9 +164,10 @@ class ZarrPlugin(Plugin):
             if var not in dataset.variables:
                 raise HTTPException(status_code=404, detail='Not in dataset')            
             validate_dask_arrays(dataset)
-            zvariables = get_zvariables(dataset, cache)
+            # creating the metadata of a dataset for the first time is slow
+            zvariables = await asyncio.to_thread(get_zvariables, dataset, cache)
             app=request.app
-            zmetadata = get_zmetadata(dataset, cache, zvariables)
+            zmetadata = await asyncio.to_thread(get_zmetadata, dataset, cache, zvariables)
             # First check that this request wasn't for variable metadata
             if array_meta_key in chunk:
                 newzmeta=copy.deepcopy(zmetadata['metadata'][f'{var}/{array_meta_key}'])
@@ -132,24 +186,54 @@ class ZarrPlugin(Plugin):
                 logger.debug('var is %s', var)
                 logger.debug('chunk is %s', chunk)
 
-                #cache_key = dataset.attrs.get(DATASET_ID_ATTR_KEY, '') + '/' + f'{var}/{chunk}'
-                #response = cache.get(cache_key)
-
-                #if response is None:
-                    #with CostTimer() as ct:
-                arr_meta = zmetadata['metadata'][f'{var}/{array_meta_key}']
-                da = zvariables[var].data
-
-                data_chunk = get_data_chunk(
-                        app.state.dask_client,
-                        da,
-                        chunk,
-                        out_shape=arr_meta['chunks'],
-                        filters=arr_meta['filters'],
-                        compressor=arr_meta['compressor'],                        
+                cache_key = dataset.attrs.get(DATASET_ID_ATTR_KEY, '') + '/' + f'{var}/{chunk}'
+                data_chunk = chunk_cache.get(cache_key)
+
+                if data_chunk is None:
+                    arr_meta = zmetadata['metadata'][f'{var}/{array_meta_key}']
+                    da = zvariables[var].data
+                    request_class = request_classifier.classify(
+                        request.headers.get('x-priority'),
+                        client_id(request),
+                        math.prod(arr_meta['chunks']) * np.dtype(arr_meta['dtype']).itemsize,
+                    )
+
+                    flight_key = (dataset.attrs.get(DATASET_ID_ATTR_KEY, ''), var, chunk)
+
+                    async def compute(priority):
+                        # the cache cost is the compute time, without the
+                        # time spent queued for admission
+                        with CostTimer() as ct:
+                            data = await get_data_chunk_async(
+                                app.state.dask_client,
+                                da,
+                                chunk,
+                                out_shape=arr_meta['chunks'],
+                                filters=arr_meta['filters'],
+                                compressor=arr_meta['compressor'],
+                                batch_key=flight_key[0],
+                                affinity=(dataset.encoding.get('source') or flight_key[0], var),
+                                priority=priority,
+                            )
+                        return data, ct.time
+
+                    try:
+                        data_chunk, cost = await classified_flight(
+                            chunk_flights, flight_key, request_class, compute
+                        )
+                    except BackendBusy as e:
+                        raise HTTPException(
+                            status_code=503,
+                            detail=(
+                                'Not enough worker memory' if e.gate == 'memory'
+                                else f'Too many {request_class} requests'
+                            ),
+                            headers={'Retry-After': str(e.retry_after)},
                         )
-                if not isinstance(data_chunk, bytes):
-                    data_chunk = data_chunk.tobytes()
+                    except ChunkTooLarge as e:
+                        raise HTTPException(status_code=413, detail=str(e))
+                    data_chunk = as_buffer(data_chunk)
+                    chunk_cache.put(cache_key, data_chunk, cost, len(data_chunk))
 
                 #Done by dask
                 #echunk = encode_chunk(
@@ -171,7 +255,6 @@ class ZarrPlugin(Plugin):
                 response.headers["Access-Control-Allow-Origin"] = "*"
                 response.headers["Access-Control-Allow-Methods"] = "POST,GET,HEAD"
                 response.headers["Access-Control-Allow-Headers"] = "*"
-                    #cache.put(cache_key, response, ct.time, len(echunk))
 
                 return response
 
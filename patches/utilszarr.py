@@ -1,7 +1,13 @@
 import base64
 import copy
+import hashlib
+import json
 import logging
 import numbers
+import os
+import tempfile
+import weakref
+from collections.abc import Mapping
 from types import SimpleNamespace
 from typing import (
     Any,
@@ -15,6 +21,7 @@ import cachey
 import dask.array
 import numpy as np
 import xarray as xr
+import numcodecs
 from numcodecs.abc import Codec
 from numcodecs.compat import ensure_ndarray
 from xarray.backends.zarr import (
@@ -61,13 +68,33 @@ def normalize_shape(shape: Union[int, Tuple[int, ...], None]) -> Tuple[int, ...]
     return shape
 
 
+# Bump if the layout of the generated metadata changes
+ZARR_METADATA_CACHE_VERSION = 2
+
+# Metadata of the datasets of this process, the app cache may be sized to zero
+_dataset_memo = {}
+
+
+def _memo(dataset: xr.Dataset) -> dict:
+    """Process local memo of a dataset, dropped with the dataset."""
+    entry = _dataset_memo.get(id(dataset))
+    if entry is None or entry[0]() is not dataset:
+        key = id(dataset)
+        ref = weakref.ref(dataset, lambda _: _dataset_memo.pop(key, None))
+        entry = _dataset_memo[key] = (ref, {})
+    return entry[1]
+
+
 def get_zvariables(dataset: xr.Dataset, cache: cachey.Cache):
     """Returns a dictionary of zarr encoded variables, using the cache when possible."""
     cache_key = dataset.attrs.get(DATASET_ID_ATTR_KEY, '') + '/' + 'zvariables'
     zvariables = cache.get(cache_key)
 
     if zvariables is None:
-        zvariables = create_zvariables(dataset)
+        memo = _memo(dataset)
+        zvariables = memo.get('zvariables')
+        if zvariables is None:
+            zvariables = memo['zvariables'] = LazyZVariables(dataset)
 
         # we want to permanently cache this: set high cost value
         cache.put(cache_key, zvariables, 99999)
@@ -85,7 +112,10 @@ def get_zmetadata(
     zmeta = cache.get(cache_key)
 
     if zmeta is None:
-        zmeta = create_zmetadata(dataset)
+        memo = _memo(dataset)
+        zmeta = memo.get('zmetadata')
+        if zmeta is None:
+            zmeta = memo['zmetadata'] = load_or_create_zmetadata(dataset)
 
         # we want to permanently cache this: set high cost value
         cache.put(cache_key, zmeta, 99999)
@@ -93,6 +123,138 @@ def get_zmetadata(
     return zmeta
 
 
+class LazyZVariables(Mapping):
+    """Zarr encoded variables of a dataset, encoded on first access."""
+
+    def __init__(self, dataset: xr.Dataset):
+        self._dataset = dataset
+        self._encoded = {}
+
+    def __getitem__(self, key):
+        zvar = self._encoded.get(key)
+        if zvar is None:
+            zvar = encode_zarr_variable(self._dataset.variables[key], name=key)
+            self._encoded[key] = zvar
+        return zvar
+
+    def __iter__(self):
+        return iter(self._dataset.variables)
+
+    def __len__(self):
+        return len(self._dataset.variables)
+
+
+def _fingerprint_default(obj: Any) -> Any:
+    """JSON encoding of the attribute and encoding values json cannot dump."""
+    if isinstance(obj, Codec):
+        return obj.get_config()
+    if isinstance(obj, np.dtype):
+        return obj.str
+    if isinstance(obj, (np.datetime64, np.timedelta64)):
+        # item() may return a datetime, which json cannot dump either
+        return str(obj)
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, bytes):
+        return base64.b64encode(obj).decode('ascii')
+    raise TypeError(f'cannot fingerprint {type(obj).__name__} value {obj!r}')
+
+
+def zmetadata_fingerprint(dataset: xr.Dataset) -> str:
+    """
+    Hash of everything the consolidated metadata of `dataset` is derived from.
+
+    Covers the source, the global attributes and per variable the dims,
+    shape, dtype, chunks, attributes and encoding. The encoding holds the
+    compressor and filters set by the preprocessing, so changing them
+    invalidates persisted metadata.
+    """
+    variables = {
+        key: [
+            list(var.dims),
+            list(var.shape),
+            var.dtype.str,
+            var.chunks,
+            var.attrs,
+            var.encoding,
+        ]
+        for key, var in dataset.variables.items()
+    }
+    parts = dict(
+        version=ZARR_METADATA_CACHE_VERSION,
+        id=dataset.attrs.get(DATASET_ID_ATTR_KEY, ''),
+        source=dataset.encoding.get('source'),
+        attrs=dataset.attrs,
+        variables=variables,
+    )
+    dumped = json.dumps(parts, sort_keys=True, default=_fingerprint_default)
+    return hashlib.sha256(dumped.encode('utf-8')).hexdigest()
+
+
+def _codecs_to_config(zmeta: dict) -> dict:
+    zmeta = copy.deepcopy(zmeta)
+    for key, meta in zmeta['metadata'].items():
+        if not key.endswith(array_meta_key):
+            continue
+        if meta.get('compressor') is not None:
+            meta['compressor'] = meta['compressor'].get_config()
+        if meta.get('filters'):
+            meta['filters'] = [f.get_config() for f in meta['filters']]
+    return zmeta
+
+
+def _codecs_from_config(zmeta: dict) -> dict:
+    for key, meta in zmeta['metadata'].items():
+        if not key.endswith(array_meta_key):
+            continue
+        if meta.get('compressor') is not None:
+            meta['compressor'] = numcodecs.get_codec(meta['compressor'])
+        if meta.get('filters'):
+            meta['filters'] = [numcodecs.get_codec(f) for f in meta['filters']]
+    return zmeta
+
+
+def load_or_create_zmetadata(dataset: xr.Dataset, cache_dir: Optional[str] = None) -> dict:
+    """
+    Consolidated zmetadata of `dataset`, loaded from `cache_dir` if it was
+    persisted for the same fingerprint before, created and persisted else.
+
+    Args:
+        dataset: The served dataset
+        cache_dir: Directory shared by all server processes, defaults to
+            the env variable `ZARR_METADATA_CACHE_DIR`. Nothing is persisted
+            if neither is set.
+    """
+    cache_dir = cache_dir or os.environ.get("ZARR_METADATA_CACHE_DIR")
+    # create_zmetadata rechunks irregular variables in place, this has to
+    # happen whether or not the metadata comes from disk
+    regularize_chunks(dataset)
+    if not cache_dir:
+        return create_zmetadata(dataset)
+
+    path = os.path.join(cache_dir, zmetadata_fingerprint(dataset) + '.json')
+    try:
+        with open(path) as f:
+            return _codecs_from_config(json.load(f))
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.warning('Ignoring unreadable zmetadata cache %s: %s', path, e)
+
+    zmeta = create_zmetadata(dataset)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(prefix='tmp', dir=cache_dir)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(_codecs_to_config(zmeta), f)
+        os.replace(tmp, path)
+    except Exception as e:
+        logger.warning('Could not persist zmetadata to %s: %s', path, e)
+    return zmeta
+
+
 def _extract_dataset_zattrs(dataset: xr.Dataset) -> dict:
     """Helper function to create zattrs dictionary from Dataset global attrs."""
     zattrs = {}
@@ -178,6 +340,18 @@ def create_zvariables(dataset: xr.Dataset) -> dict:
     return zvariables
 
 
+def regularize_chunks(dataset: xr.Dataset):
+    """Rechunk dask variables with non-uniform chunks in place."""
+    for key, dvar in dataset.variables.items():
+        # check taken from xarray.backends.zarr:_determine_zarr_chunks
+        # if the variable is a dask_array and the chunks are not uniform, try to fix the chunks
+        if isinstance(dvar.data, DaskArrayType) and any(
+            (len(set(chunks[:-1])) > 1 or chunks[0] < chunks[-1]) for chunks in dvar.data.chunks
+        ):
+            da = dataset[key]
+            da.variable.data = da.variable.data.rechunk(dvar.data.chunksize)
+
+
 def create_zmetadata(dataset: xr.Dataset) -> dict:
     """Helper function to create a consolidated zmetadata dictionary."""
     zmeta = {
@@ -187,17 +361,10 @@ def create_zmetadata(dataset: xr.Dataset) -> dict:
     zmeta['metadata'][group_meta_key] = {'zarr_format': ZARR_FORMAT}
     zmeta['metadata'][attrs_key] = _extract_dataset_zattrs(dataset)
 
+    regularize_chunks(dataset)
     for key, dvar in dataset.variables.items():
         da = dataset[key]
 
-        # check taken from xarray.backends.zarr:_determine_zarr_chunks
-        # if the variable is a dask_array and the chunks are not uniform, try to fix the chunks
-        if isinstance(dvar.data, DaskArrayType) and any(
-            (len(set(chunks[:-1])) > 1 or chunks[0] < chunks[-1]) for chunks in dvar.data.chunks
-        ):
-            da.variable.data = da.variable.data.rechunk(dvar.data.chunksize)
-            dvar = da.variable
-
         encoded_da = encode_zarr_variable(dvar, name=key)
         encoding = extract_zarr_variable_encoding(
             dvar,
@@ -242,12 +409,40 @@ def jsonify_zmetadata(
     return zjson
 
 
+def pad_chunk(chunk: np.typing.ArrayLike, out_shape: tuple) -> np.typing.ArrayLike:
+    """Pad an incomplete edge chunk to the full chunk shape `out_shape`."""
+    # zarr expects full edge chunks, contents out of bounds for the array are
+    # undefined. Zeros compress best.
+    if chunk.shape == tuple(out_shape):
+        return chunk
+    new_chunk = np.zeros_like(chunk, shape=out_shape)
+    write_slice = tuple([slice(0, s) for s in chunk.shape])
+    new_chunk[write_slice] = chunk
+    return new_chunk
+
+
+def as_buffer(chunk: Any) -> Union[bytes, memoryview]:
+    """Flat byte view on an encoded chunk, without copying it."""
+    if isinstance(chunk, (bytes, memoryview)):
+        return chunk
+    return memoryview(np.ascontiguousarray(chunk)).cast("B")
+
+
 def encode_chunk(
     chunk: np.typing.ArrayLike,
     filters: Optional[list[Codec]] = None,
     compressor: Optional[Codec] = None,
+    out_shape: Optional[tuple] = None,
 ) -> np.typing.ArrayLike:
-    """Helper function largely copied from zarr.Array."""
+    """Helper function largely copied from zarr.Array.
+
+    If `out_shape` is given, edge chunks are padded to it before encoding.
+    This runs on the dask workers, so the padded copy never reaches the web
+    server.
+    """
+    if out_shape is not None:
+        chunk = pad_chunk(chunk, out_shape)
+
     # apply filters
     if filters:
         for f in filters:
@@ -263,27 +458,761 @@ def encode_chunk(
 
     return chunk
 
+from collections import OrderedDict
+from functools import partial
 from dask.distributed import Client
+from dask.highlevelgraph import HighLevelGraph
+from dask.optimization import cull
+from dask.base import tokenize
 import os
 import gc
-#import asyncio
+import asyncio
+import math
+import threading
+import time
+from cloudify.utils.limiter import AdmissionQueues, BackendBusy
+from cloudify.utils.priority import PRIORITIES, FlightClasses, RequestClassifier
+from cloudify.utils.refindex import affinity_target, reference_grid
+from cloudify.utils.singleflight import AsyncSingleFlight, SingleFlight
 gccounter=0
 GCLIMIT=100
+
+# Bounds of the chunk task templates: materialized graphs of variables
+# without a HighLevelGraph and culled subgraphs of single chunks
+ZARR_GRAPH_CACHE_SIZE = int(os.environ.get("ZARR_GRAPH_CACHE_SIZE", 16))
+ZARR_TASK_CACHE_SIZE = int(os.environ.get("ZARR_TASK_CACHE_SIZE", 100000))
+
+class ChunkTemplates:
+    """
+    Precompiled tasks for computing single encoded chunks of dask arrays.
+
+    Slicing a block out of a dask array with `da.blocks` and wrapping it with
+    `map_blocks` tokenizes and walks the graph of the whole variable for each
+    request. Instead, the subgraph of a chunk is culled layer by layer from
+    the HighLevelGraph of the variable on first use and kept in an LRU, so
+    that serving a hot chunk is a dictionary lookup. Only graphs without
+    layers are materialized whole, in a smaller LRU.
+
+    Building a template is CPU bound, `get_async` does it in a thread and
+    coalesces concurrent builds of the same chunk.
+    """
+
+    def __init__(self, graph_cache_size=ZARR_GRAPH_CACHE_SIZE, task_cache_size=ZARR_TASK_CACHE_SIZE):
+        self.graph_cache_size = graph_cache_size
+        self.task_cache_size = task_cache_size
+        self._graphs = OrderedDict()
+        self._tasks = OrderedDict()
+        self._lock = threading.Lock()
+        self._graph_builds = SingleFlight()
+        self._task_builds = AsyncSingleFlight()
+        self.counters = dict(graphs=0, tasks=0, task_hits=0)
+
+    def _graph(self, da: dask.array.Array) -> dict:
+        with self._lock:
+            dsk = self._graphs.get(da.name)
+            if dsk is not None:
+                self._graphs.move_to_end(da.name)
+                return dsk
+        # materialize outside of the lock, concurrent callers share the result
+        dsk = self._graph_builds.do(da.name, lambda: dict(da.__dask_graph__()))
+        with self._lock:
+            if da.name not in self._graphs:
+                self._graphs[da.name] = dsk
+                self.counters["graphs"] += 1
+                while len(self._graphs) > self.graph_cache_size:
+                    self._graphs.popitem(last=False)
+        return dsk
+
+    def _cull(self, da: dask.array.Array, block_key: tuple) -> dict:
+        graph = da.__dask_graph__()
+        if isinstance(graph, HighLevelGraph):
+            # culls each layer by itself, blockwise layers without
+            # materializing their tasks
+            return dict(graph.cull({block_key}))
+        task, _ = cull(self._graph(da), [block_key])
+        return task
+
+    def _key(self, da, ikeys, filters, compressor, out_shape) -> tuple:
+        if len(ikeys) != da.ndim or any(
+            not 0 <= i < n for i, n in zip(ikeys, da.numblocks)
+        ):
+            raise IndexError(f"Chunk {ikeys} out of range {da.numblocks}")
+        encode_name = "encode-" + tokenize(da.name, filters, compressor, out_shape)
+        return (encode_name,) + ikeys
+
+    def _cached(self, task_key: tuple) -> Optional[dict]:
+        with self._lock:
+            task = self._tasks.get(task_key)
+            if task is not None:
+                self._tasks.move_to_end(task_key)
+                self.counters["task_hits"] += 1
+        return task
+
+    def get(self, da, ikeys, filters=None, compressor=None, out_shape=None) -> tuple[dict, tuple]:
+        """
+        Graph and output key computing the encoded chunk `ikeys` of `da`,
+        padded to `out_shape`.
+        """
+        task_key = self._key(da, ikeys, filters, compressor, out_shape)
+        task = self._cached(task_key)
+        if task is not None:
+            return task, task_key
+
+        block_key = (da.name,) + ikeys
+        task = self._cull(da, block_key)
+        task[task_key] = (
+            partial(encode_chunk, filters=filters, compressor=compressor, out_shape=out_shape),
+            block_key,
+        )
+        with self._lock:
+            self._tasks[task_key] = task
+            self.counters["tasks"] += 1
+            while len(self._tasks) > self.task_cache_size:
+                self._tasks.popitem(last=False)
+        return task, task_key
+
+    async def get_async(self, da, ikeys, filters=None, compressor=None, out_shape=None) -> tuple[dict, tuple]:
+        """Like `get`, building missing templates in a thread."""
+        task_key = self._key(da, ikeys, filters, compressor, out_shape)
+        task = self._cached(task_key)
+        if task is not None:
+            return task, task_key
+        return await self._task_builds.do(
+            task_key,
+            asyncio.to_thread,
+            self.get,
+            da,
+            ikeys,
+            filters=filters,
+            compressor=compressor,
+            out_shape=out_shape,
+        )
+
+chunk_templates = ChunkTemplates()
+
+# Worker threads, task counts and memory as reported by the scheduler
+ZARR_WORKER_REFRESH_S = float(os.environ.get("ZARR_WORKER_REFRESH_S", 2))
+
+class WorkerStates:
+    """
+    Threads, queued tasks and memory of the dask workers.
+
+    Taken from the scheduler at most every `refresh` seconds, in the
+    background for asynchronous clients.
+    """
+
+    def __init__(self, refresh=ZARR_WORKER_REFRESH_S):
+        self.refresh = refresh
+        self.workers = {}
+        self._updated = 0.
+        self._refreshing = None
+
+    def update(self, info: dict):
+        workers = {}
+        for address, worker in info.get("workers", {}).items():
+            metrics = worker.get("metrics", {})
+            counts = metrics.get("task_counts", {})
+            workers[address] = dict(
+                nthreads=worker.get("nthreads", 1),
+                load=sum(counts.get(state, 0) for state in ("executing", "ready", "constrained")),
+                memory=metrics.get("memory", 0),
+                memory_limit=worker.get("memory_limit") or 0,
+            )
+        self.workers = workers
+
+    def _stale(self) -> bool:
+        now = time.monotonic()
+        if now - self._updated < self.refresh:
+            return False
+        self._updated = now
+        return True
+
+    async def refresh_async(self, client: Client):
+        """Update the worker states in the background, wait only for the first."""
+        if self._refreshing is None and self._stale():
+            self._refreshing = asyncio.ensure_future(self._identity(client))
+            self._refreshing.add_done_callback(lambda _: setattr(self, "_refreshing", None))
+        if self._refreshing is not None and not self.workers:
+            await asyncio.shield(self._refreshing)
+
+    async def _identity(self, client: Client):
+        try:
+            try:
+                info = await client.scheduler.identity(n_workers=-1)
+            except TypeError:
+                info = await client.scheduler.identity()
+        except Exception as e:
+            logger.warning('Could not get worker states: %s', e)
+            return
+        self.update(info)
+
+    def refresh_sync(self, client: Client):
+        if not self._stale():
+            return
+        try:
+            try:
+                info = client.scheduler_info(n_workers=-1)
+            except TypeError:
+                info = client.scheduler_info()
+        except Exception as e:
+            logger.warning('Could not get worker states: %s', e)
+            return
+        self.update(info)
+
+worker_states = WorkerStates()
+
+# Pin chunk computations to dask workers by the file they read, so that the
+# fsspec, block and reference caches of a worker are reused. Chunks of
+# sources without registered references are grouped by
+# ZARR_AFFINITY_BLOCKS leading-dimension blocks instead. A worker with more
+# than ZARR_AFFINITY_SATURATION tasks per thread is skipped for the least
+# loaded one.
+ZARR_AFFINITY = os.environ.get("ZARR_AFFINITY", "1") != "0"
+ZARR_AFFINITY_BLOCKS = int(os.environ.get("ZARR_AFFINITY_BLOCKS", 1))
+ZARR_AFFINITY_SATURATION = float(os.environ.get("ZARR_AFFINITY_SATURATION", 2))
+
+class WorkerAffinity:
+    """
+    Choose the dask worker for a chunk by rendezvous hashing of its source.
+
+    For sources whose kerchunk mapper is registered with
+    `register_references`, the key is the file the chunk is read from, see
+    `affinity_target`. This needs the dask block to be exactly one chunk of
+    the references: the served variable has the shape of the referenced
+    one and the block starts and ends on its chunk boundaries. Other blocks,
+    e.g. of rechunked or sliced views, and other sources fall back to an
+    approximation, the (source, variable) and the group of `blocks`
+    leading-dimension blocks, counted as `approximated`. Each key ranks all
+    workers by a hash which is the same in every server process, the first
+    one is used. Adding or removing a worker only moves the keys pinned to
+    it. Worker loads are taken from `states` and from the chunks this
+    process has in flight per worker.
+    """
+
+    def __init__(self, states: WorkerStates = worker_states, blocks=ZARR_AFFINITY_BLOCKS, saturation=ZARR_AFFINITY_SATURATION):
+        self.states = states
+        self.blocks = max(blocks, 1)
+        self.saturation = saturation
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._mappers = {}
+        self._grids = {}
+        self.counters = dict(pinned=0, fallback=0, unpinned=0, targets=0, approximated=0)
+
+    def register_references(self, source: str, fsmap: Any):
+        """Resolve the chunks of the dataset with `source` through the references of `fsmap`."""
+        self._mappers[source] = fsmap
+        self._grids = {k: v for k, v in self._grids.items() if k[0] != source}
+
+    def _reference_chunk(self, source: tuple, ikeys: tuple, chunks: tuple) -> Optional[tuple]:
+        """Index of the reference chunk which is the dask block `ikeys`, None if there is none."""
+        grid = self._grids.get(source, False)
+        if grid is False:
+            grid = self._grids[source] = reference_grid(self._mappers[source[0]], source[1])
+        if grid is None:
+            return None
+        shape, ref_chunks = grid
+        if len(ikeys) != len(shape) or tuple(map(sum, chunks)) != shape:
+            return None
+        index = []
+        for i, dim_chunks, size, ref_chunk in zip(ikeys, chunks, shape, ref_chunks):
+            start = sum(dim_chunks[:i])
+            stop = start + dim_chunks[i]
+            if start % ref_chunk or stop != min(start + ref_chunk, size):
+                return None
+            index.append(start // ref_chunk)
+        return tuple(index)
+
+    def affinity_key(self, source: Any, ikeys: tuple, chunks: Optional[tuple] = None) -> tuple:
+        """
+        Key of the dask block `ikeys` of `source`, a (dataset source,
+        variable) pair or any other hashable. `chunks` are the dask chunks
+        of the served array, without them blocks are not resolved through
+        the references.
+        """
+        if (
+            chunks is not None
+            and isinstance(source, tuple)
+            and len(source) == 2
+            and source[0] in self._mappers
+        ):
+            index = self._reference_chunk(source, ikeys, chunks)
+            target = None
+            if index is not None:
+                key = f"{source[1]}/" + ".".join(map(str, index or (0,)))
+                target = affinity_target(self._mappers[source[0]], key)
+            if target is not None:
+                self.counters["targets"] += 1
+                return (source[0], target)
+            self.counters["approximated"] += 1
+        return (source, ikeys[0] // self.blocks if ikeys else 0)
+
+    def _load(self, address: str) -> float:
+        state = self.states.workers[address]
+        return max(state["load"], self._inflight.get(address, 0)) / max(state["nthreads"], 1)
+
+    def pick(self, key: tuple) -> Optional[str]:
+        """Worker for the affinity `key`, None if no worker is known."""
+        workers = self.states.workers
+        if not workers:
+            self.counters["unpinned"] += 1
+            return None
+        token = repr(key).encode()
+        ranked = sorted(
+            workers,
+            key=lambda w: hashlib.blake2b(token + w.encode(), digest_size=8).digest(),
+            reverse=True,
+        )
+        with self._lock:
+            worker = ranked[0]
+            if self._load(worker) < self.saturation:
+                self.counters["pinned"] += 1
+            else:
+                # least loaded, ties in the order of the ranking
+                worker = min(ranked, key=self._load)
+                self.counters["fallback"] += 1
+            self._inflight[worker] = self._inflight.get(worker, 0) + 1
+        return worker
+
+    def release(self, worker: Optional[str]):
+        if worker is None:
+            return
+        with self._lock:
+            self._inflight[worker] -= 1
+            if not self._inflight[worker]:
+                del self._inflight[worker]
+
+worker_affinity = WorkerAffinity()
+
+# Admit chunk computations only while the workers have memory for them.
+# A chunk needs about ZARR_MEMORY_OVERHEAD times its decoded size while it
+# is computed, workers are filled up to ZARR_MEMORY_HIGH_WATER of their
+# memory limit, below the default spill threshold of dask. Requests wait up
+# to ZARR_MEMORY_TIMEOUT seconds for memory.
+ZARR_MEMORY_ADMISSION = os.environ.get("ZARR_MEMORY_ADMISSION", "1") != "0"
+ZARR_MEMORY_HIGH_WATER = float(os.environ.get("ZARR_MEMORY_HIGH_WATER", 0.55))
+ZARR_MEMORY_OVERHEAD = float(os.environ.get("ZARR_MEMORY_OVERHEAD", 3))
+ZARR_MEMORY_TIMEOUT = float(os.environ.get("ZARR_MEMORY_TIMEOUT", 30))
+ZARR_MEMORY_RETRY_AFTER = int(os.environ.get("ZARR_MEMORY_RETRY_AFTER", 10))
+
+class ChunkTooLarge(Exception):
+    """Raised for computations which do not fit into any worker."""
+
+    def __init__(self, nbytes: int, capacity: int):
+        super().__init__(
+            f"Chunk computation needs {nbytes} bytes, workers admit at most {capacity}"
+        )
+        self.nbytes = nbytes
+        self.capacity = capacity
+
+class MemoryAdmission:
+    """
+    Hold back chunk computations which would push workers into spilling.
+
+    The memory a computation needs is estimated from the decoded chunk size.
+    The headroom of a worker is its memory limit times `high_water` minus
+    the memory it uses. A computation is admitted if it fits into the
+    largest headroom of a worker and, together with the computations this
+    process already admitted, into the summed headroom of all workers.
+    Otherwise it waits for admitted computations to finish or for fresh
+    worker states, and fails with BackendBusy after `timeout` seconds.
+    Computations which would not even fit into an empty worker fail at
+    once with ChunkTooLarge.
+    Without memory limits of the workers everything is admitted.
+    """
+
+    def __init__(self, states: WorkerStates = worker_states, high_water=ZARR_MEMORY_HIGH_WATER, overhead=ZARR_MEMORY_OVERHEAD, timeout=ZARR_MEMORY_TIMEOUT, retry_after=ZARR_MEMORY_RETRY_AFTER):
+        self.states = states
+        self.high_water = high_water
+        self.overhead = overhead
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.reserved = 0
+        self._waiters = set()
+        self.counters = dict(admitted=0, queued=0, rejected=0, too_large=0, wait_seconds=0.)
+
+    def estimate(self, shape: tuple, dtype: np.dtype) -> int:
+        """Bytes needed to compute a chunk of `shape` and `dtype`."""
+        return int(math.prod(shape) * np.dtype(dtype).itemsize * self.overhead)
+
+    def headroom(self) -> Optional[tuple[int, int]]:
+        """(summed, largest) headroom of the workers.
+
+        None if no worker states are known yet or no worker has a memory
+        limit; admission does not gate on memory then.
+        """
+        headrooms = [
+            max(int(w["memory_limit"] * self.high_water) - w["memory"], 0)
+            for w in self.states.workers.values()
+            if w["memory_limit"]
+        ]
+        if not headrooms:
+            return None
+        return sum(headrooms), max(headrooms)
+
+    def capacity(self) -> Optional[int]:
+        """Largest headroom a worker has without any memory in use, None if unknown."""
+        limits = [w["memory_limit"] for w in self.states.workers.values() if w["memory_limit"]]
+        if not limits:
+            return None
+        return int(max(limits) * self.high_water)
+
+    def _check_capacity(self, nbytes: int):
+        # freeing memory would not help, do not queue
+        capacity = self.capacity()
+        if capacity is not None and nbytes > capacity:
+            self.counters["too_large"] += 1
+            raise ChunkTooLarge(nbytes, capacity)
+
+    def fits(self, nbytes: int) -> bool:
+        headroom = self.headroom()
+        if headroom is None:
+            return True
+        total, largest = headroom
+        return nbytes <= largest and self.reserved + nbytes <= total
+
+    async def acquire(self, client: Client, nbytes: int):
+        await self.states.refresh_async(client)
+        self._check_capacity(nbytes)
+        if self.fits(nbytes):
+            self.reserved += nbytes
+            self.counters["admitted"] += 1
+            return
+        self.counters["queued"] += 1
+        loop = asyncio.get_running_loop()
+        started = time.monotonic()
+        deadline = started + self.timeout
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.counters["rejected"] += 1
+                    raise BackendBusy("memory", self.retry_after)
+                waiter = loop.create_future()
+                self._waiters.add(waiter)
+                try:
+                    # woken by finished computations, or rechecked with
+                    # fresh worker states
+                    await asyncio.wait_for(waiter, min(remaining, self.states.refresh))
+                except asyncio.TimeoutError:
+                    pass
+                finally:
+                    self._waiters.discard(waiter)
+                await self.states.refresh_async(client)
+                self._check_capacity(nbytes)
+                if self.fits(nbytes):
+                    self.reserved += nbytes
+                    self.counters["admitted"] += 1
+                    return
+        finally:
+            self.counters["wait_seconds"] += time.monotonic() - started
+
+    def release(self, nbytes: int):
+        self.reserved -= nbytes
+        for waiter in self._waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def stats(self) -> dict:
+        stats = dict(self.counters)
+        headroom = self.headroom()
+        stats.update(
+            reserved_bytes=self.reserved,
+            waiting=len(self._waiters),
+            headroom_bytes=headroom[0] if headroom else None,
+        )
+        return stats
+
+memory_admission = MemoryAdmission()
+
+def _worker_kwargs(worker: Optional[str]) -> dict:
+    if worker is None:
+        return {}
+    # the pin is a preference, the scheduler may still move the task
+    return dict(workers=[worker], allow_other_workers=True)
+
 #async def calc_chunk(chunk_client,chunk_data_raw):
-def calc_chunk(chunk_client,chunk_data_raw):
+def calc_chunk(chunk_client,chunk_task,worker=None,priority=0):
     global gccounter
     chunk_data = None
 #    zarraddress=os.environ["ZARR_ADDRESS"]
 #    with chunk_client:
-    chunk_data = chunk_client.compute(chunk_data_raw)
-    chunk_data = chunk_client.gather(chunk_data)
-    del chunk_data_raw
+    dsk, key = chunk_task
+    chunk_data = chunk_client.get(dsk, key, priority=priority, **_worker_kwargs(worker))
+    del chunk_task
     if gccounter > GCLIMIT:
         chunk_client.run(gc.collect)
         gccounter=0
     gccounter+=1
     return chunk_data
 
+async def collect_garbage_async(chunk_client, nchunks=1):
+    global gccounter
+    if gccounter > GCLIMIT:
+        await chunk_client.run(gc.collect)
+        gccounter=0
+    gccounter+=nchunks
+
+async def calc_chunk_async(chunk_client,chunk_task,worker=None,priority=0):
+    """Like `calc_chunk` for an asynchronous client, the event loop stays free while the cluster computes."""
+    dsk, key = chunk_task
+    chunk_data = await chunk_client.get(
+        dsk, [key], sync=False, priority=priority, **_worker_kwargs(worker)
+    )[0]
+    del chunk_task
+    await collect_garbage_async(chunk_client)
+    return chunk_data
+
+# Window in which concurrent chunk requests of a dataset are collected into
+# one submission, 0 submits each chunk on its own
+ZARR_BATCH_WINDOW_MS = float(os.environ.get("ZARR_BATCH_WINDOW_MS", 5))
+ZARR_BATCH_MAX_SIZE = int(os.environ.get("ZARR_BATCH_MAX_SIZE", 64))
+
+class ChunkBatcher:
+    """
+    Merge concurrent chunk computations into one dask submission.
+
+    The first chunk of a batch opens a window of `window_ms`. All chunks with
+    the same batch key arriving within the window, or until `max_size` chunks
+    are collected, are submitted with one `client.get` call on their merged
+    task graphs, i.e. one graph update on the scheduler. Each request then awaits only its own
+    result, so a failing chunk does not fail the others. Chunks pinned to
+    different workers or of different priorities are batched separately.
+    """
+
+    def __init__(self, window_ms: float = ZARR_BATCH_WINDOW_MS, max_size: int = ZARR_BATCH_MAX_SIZE):
+        self.window = window_ms / 1000.
+        self.max_size = max_size
+        self._batches = {}
+        # submissions in flight, the event loop only keeps weak references
+        self._submissions = set()
+        self.counters = dict(chunks=0, submissions=0)
+
+    async def compute(self, client: Client, batch_key: Any, chunk_task: tuple, worker: Optional[str] = None, priority: int = 0):
+        if self.window <= 0 or self.max_size <= 1:
+            return await calc_chunk_async(client, chunk_task, worker, priority)
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        batch_key = (batch_key, worker, priority)
+        batch = self._batches.get(batch_key)
+        if batch is None:
+            batch = self._batches[batch_key] = []
+            loop.call_later(self.window, self._flush, client, batch_key, batch)
+        batch.append((chunk_task, fut))
+        if len(batch) >= self.max_size:
+            self._flush(client, batch_key, batch)
+        return await fut
+
+    def _flush(self, client, batch_key, batch):
+        # the timer of a batch flushed early because it was full
+        if self._batches.get(batch_key) is not batch:
+            return
+        del self._batches[batch_key]
+        task = asyncio.ensure_future(self._submit(client, batch, batch_key[1], batch_key[2]))
+        self._submissions.add(task)
+        task.add_done_callback(partial(self._submitted, batch))
+
+    def _submitted(self, batch, task):
+        self._submissions.discard(task)
+        if not task.cancelled() and task.exception() is None:
+            return
+        if not task.cancelled():
+            logger.error("Chunk batch submission failed: %r", task.exception())
+        # requests of the batch must not wait forever
+        for _, fut in batch:
+            if fut.done():
+                continue
+            if task.cancelled():
+                fut.cancel()
+            else:
+                fut.set_exception(task.exception())
+
+    async def _submit(self, client, batch, worker=None, priority=0):
+        self.counters["chunks"] += len(batch)
+        self.counters["submissions"] += 1
+        try:
+            dsk = {}
+            for (task, _), _ in batch:
+                dsk.update(task)
+            futures = client.get(
+                dsk,
+                [key for (_, key), _ in batch],
+                sync=False,
+                priority=priority,
+                **_worker_kwargs(worker),
+            )
+            results = await asyncio.gather(*futures, return_exceptions=True)
+        except Exception as e:
+            results = [e] * len(batch)
+        for (_, fut), result in zip(batch, results):
+            if fut.done():
+                continue
+            if isinstance(result, BaseException):
+                fut.set_exception(result)
+            else:
+                fut.set_result(result)
+        await collect_garbage_async(client, len(results))
+
+chunk_batcher = ChunkBatcher()
+
+async def compute_task_async(
+    client: Client,
+    chunk_task: tuple,
+    batch_key: Any = None,
+    affinity: Any = None,
+    ikeys: tuple = (),
+    priority: int = 0,
+    nbytes: int = 0,
+    chunks: Optional[tuple] = None,
+):
+    """
+    Compute a (graph, key) task with an asynchronous client through
+    `chunk_batcher`, pinned to a worker by `affinity` and the block `ikeys`
+    of an array with the dask `chunks`, with the dask task priority
+    `priority`. The task is only submitted once `memory_admission` has room
+    for the `nbytes` it needs.
+    """
+    reserved = 0
+    if ZARR_MEMORY_ADMISSION and nbytes:
+        await memory_admission.acquire(client, nbytes)
+        reserved = nbytes
+    worker = None
+    try:
+        if ZARR_AFFINITY and affinity is not None:
+            await worker_states.refresh_async(client)
+            worker = worker_affinity.pick(
+                worker_affinity.affinity_key(affinity, ikeys, chunks)
+            )
+        return await chunk_batcher.compute(client, batch_key, chunk_task, worker, priority)
+    finally:
+        worker_affinity.release(worker)
+        if reserved:
+            memory_admission.release(reserved)
+
+# Chunk requests of all zarr endpoints are classified as interactive or bulk,
+# from the X-Priority header, the uncompressed chunk size and the request
+# rate of the client. Each class has its own admission queue of
+# computations and dask priority, so that small interactive chunks overtake
+# bulk downloads.
+request_classifier = RequestClassifier(
+    bulk_chunk_bytes=int(os.environ.get("ZARR_BULK_CHUNK_BYTES", 64 * 2**20)),
+    bulk_rate=float(os.environ.get("ZARR_BULK_RATE", 20)),
+)
+admission = AdmissionQueues(
+    {
+        "interactive": int(os.environ.get("ZARR_INTERACTIVE_SLOTS", 0)),
+        "bulk": int(os.environ.get("ZARR_BULK_SLOTS", 16)),
+    },
+    queue_timeout=float(os.environ.get("ZARR_ADMISSION_TIMEOUT", 60)),
+)
+# A shared chunk computation queues in the class of its most urgent request
+flight_classes = FlightClasses()
+
+async def classified_flight(flights: Any, key: Any, request_class: str, compute: Any):
+    """
+    Await `compute(priority)` through the single-flight `flights` under
+    `key`, admitted by `admission` in the queue of the most urgent request
+    waiting for it, see `FlightClasses`. `priority` is the dask priority of
+    that class.
+    """
+
+    async def run():
+        async with flight_classes.admit(key, admission) as flight_class:
+            return await compute(PRIORITIES[flight_class])
+
+    with flight_classes.waiting(key, request_class):
+        return await flights.do(key, run)
+
+async def compute_tasks_async(
+    client: Client,
+    chunk_tasks: list,
+    nbytes: int = 0,
+    priority: int = 0,
+):
+    """
+    Compute many (graph, key) tasks with an asynchronous client in one
+    submission, so tasks they share, e.g. the splits of a rechunk, run once.
+    Yields (index, result) pairs in the order the results arrive. The
+    submission waits for `memory_admission` to have room for `nbytes`.
+    """
+    reserved = 0
+    if ZARR_MEMORY_ADMISSION and nbytes:
+        await memory_admission.acquire(client, nbytes)
+        reserved = nbytes
+    try:
+        dsk = {}
+        for task, _ in chunk_tasks:
+            dsk.update(task)
+        futures = client.get(
+            dsk, [key for _, key in chunk_tasks], sync=False, priority=priority
+        )
+
+        async def result(i, future):
+            return i, await future
+
+        for done in asyncio.as_completed([result(i, f) for i, f in enumerate(futures)]):
+            yield await done
+        await collect_garbage_async(client, len(chunk_tasks))
+    finally:
+        if reserved:
+            memory_admission.release(reserved)
+
+async def get_data_chunk_async(
+    client: Client,
+    da: xr.DataArray,
+    chunk_id: str,
+    out_shape: tuple,
+    filters: Optional[list[Codec]] = None,
+    compressor: Optional[Codec] = None,
+    batch_key: Any = None,
+    affinity: Any = None,
+    priority: int = 0,
+    nbytes: Optional[int] = None,
+) -> np.typing.ArrayLike:
+    """Async variant of `get_data_chunk`.
+
+    With an asynchronous dask client the computation is awaited, so many
+    chunks can be in flight without blocking a thread each. Chunks with the
+    same `batch_key` are submitted together by `chunk_batcher`. Synchronous
+    clients and numpy arrays are handled by `get_data_chunk` in a thread.
+
+    `affinity` identifies the source of the array, e.g. the reference file
+    and variable. Chunks of the same source are pinned to the same worker,
+    see `WorkerAffinity`. `priority` is the dask priority of the chunk
+    tasks, higher runs first. Computations wait for worker memory, see
+    `MemoryAdmission`; synchronous clients are not admission controlled.
+    `nbytes` overrides the memory estimate of the decoded chunk, e.g. for
+    chunks reading much more of their inputs.
+    """
+    if isinstance(da, DaskArrayType) and getattr(client, "asynchronous", False):
+        ikeys = tuple(map(int, chunk_id.split('.')))
+        return await compute_task_async(
+            client,
+            await chunk_templates.get_async(
+                da, ikeys, filters=filters, compressor=compressor, out_shape=out_shape
+            ),
+            batch_key=batch_key,
+            affinity=affinity,
+            ikeys=ikeys,
+            priority=priority,
+            chunks=da.chunks,
+            nbytes=(
+                memory_admission.estimate(out_shape, da.dtype)
+                if nbytes is None else nbytes
+            ),
+        )
+    return await asyncio.to_thread(
+        get_data_chunk,
+        client,
+        da,
+        chunk_id,
+        out_shape,
+        filters=filters,
+        compressor=compressor,
+        affinity=affinity,
+        priority=priority,
+    )
+
 def get_data_chunk(
     client: Client,
     da: xr.DataArray,
@@ -291,22 +1220,30 @@ def get_data_chunk(
     out_shape: tuple,
     filters: Optional[list[Codec]] = None,
     compressor: Optional[Codec] = None,
+    affinity: Any = None,
+    priority: int = 0,
 ) -> np.typing.ArrayLike:
     """Get one chunk of data from this DataArray (da).
 
-    If this is an incomplete edge chunk, pad the returned array to match out_shape.
+    The chunk is returned encoded. If this is an incomplete edge chunk, it is
+    padded to match out_shape before encoding.
     """
     ikeys = tuple(map(int, chunk_id.split('.')))
     if isinstance(da, DaskArrayType):
         #chunk_data = da.blocks[ikeys]
-        chunk_data_raw = da.blocks[ikeys].copy()
-        chunk_data_raw = chunk_data_raw.map_blocks(
-                encode_chunk,
-                dtype=chunk_data_raw.dtype,       # output dtype must be known
-                filters=filters,  # pass extra args here
-                compressor=compressor,
-                )
-        return  calc_chunk(client,chunk_data_raw)
+        chunk_task = chunk_templates.get(
+            da, ikeys, filters=filters, compressor=compressor, out_shape=out_shape
+        )
+        worker = None
+        if ZARR_AFFINITY and affinity is not None:
+            worker_states.refresh_sync(client)
+            worker = worker_affinity.pick(
+                worker_affinity.affinity_key(affinity, ikeys, da.chunks)
+            )
+        try:
+            return calc_chunk(client, chunk_task, worker, priority)
+        finally:
+            worker_affinity.release(worker)
     else:
         if da.ndim > 0 and ikeys != ((0,) * da.ndim):
             raise ValueError(
@@ -317,17 +1254,9 @@ def get_data_chunk(
 
     logger.debug('checking chunk output size, %s == %s' % (chunk_data.shape, out_shape))
 
-    #if isinstance(chunk_data, DaskArrayType):
-    #    chunk_data = chunk_data.compute()
-
-    # zarr expects full edge chunks, contents out of bounds for the array are undefined
-    if chunk_data.shape != tuple(out_shape):
-        new_chunk = np.empty_like(chunk_data, shape=out_shape)
-        write_slice = tuple([slice(0, s) for s in chunk_data.shape])
-        new_chunk[write_slice] = chunk_data
-        return new_chunk
-    else:
-        return chunk_data
+    return encode_chunk(
+        chunk_data, filters=filters, compressor=compressor, out_shape=out_shape
+    )
 
 
 def encode_fill_value(v: Any, dtype: np.dtype, object_codec: Any = None) -> Any:
@@ -4,6 +4,9 @@ from cloudify.plugins.stacer import *
 from cloudify.utils.daskhelper import *
 from cloudify.plugins.dynamic_datasets import *
 from cloudify.plugins.kerchunk import *
+from cloudify.plugins.zarrv3 import *
+from cloudify.plugins.subset import *
+from cloudify.plugins.timeseries import *
 from cloudify.plugins.dynamic_variables import *
 from cloudify.plugins.statistics import *
 from cloudify_cosmorea import *
@@ -20,6 +23,7 @@ from cloudify.utils.datasethelper import *
 import os
 import intake
 import xpublish as xp
+from xpublish.utils.zarr import worker_affinity
 import fastapi
 import uvicorn
 from starlette.middleware.cors import CORSMiddleware
@@ -28,6 +32,8 @@ from filelock import FileLock
 import shutil
 
 os.environ["FORWARDED_ALLOW_IPS"] = "127.0.0.1"
+# consolidated /zarr metadata shared by the uvicorn workers and restarts
+os.environ.setdefault("ZARR_METADATA_CACHE_DIR", "/tmp/zarr-metadata-cache")
 
 TREE_DIR = Path("/tmp/tree.zarr")
 
@@ -45,7 +51,14 @@ L_DASK = True
 #    print("ThreadPoolExecutor set to 100 worker.")
 
 #if __name__ == "__main__":  # This avoids infinite subprocess creation
-kp = KerchunkPlugin()
+kp = KerchunkPlugin(
+    chunk_cache_memory_bytes=2**30,
+    # per uvicorn worker, all of them share the directory
+    chunk_cache_disk_bytes=50 * 2**30,
+    chunk_cache_dir="/tmp/kerchunk-chunk-cache",
+    reference_index_dir="/tmp/kerchunk-reference-index",
+)
+sp = SubsetPlugin(subset_dir="/tmp/subset-views")
 collection = xp.Rest(
     #dsdict,
     #cache_kws=dict(available_bytes=100000000),
@@ -57,6 +70,14 @@ collection = xp.Rest(
     ),
 )
 collection.register_plugin(kp)
+collection.register_plugin(ZarrV3Plugin())
+collection.register_plugin(sp)
+collection.register_plugin(
+    TimeseriesPlugin(
+        cache_disk_bytes=50 * 2**30,
+        cache_dir="/tmp/zarr-timeseries-cache",
+    )
+)
 collection.register_plugin(Stac())
 collection.register_plugin(Stats())
 app = collection.app
@@ -126,6 +147,10 @@ async def start_all_datasets():
             print(set(mapper_dict.keys())-set(dsdict.keys()))
 
     kp.mapper_dict = mapper_dict
+    await kp.load_reference_indexes()
+    for source, fsmap in mapper_dict.items():
+        worker_affinity.register_references(source, fsmap)
+    sp.datasets = dsdict
     # collection = xp.Rest([], cache_kws=dict(available_bytes=0))
     # collection.register_plugin(DynamicKerchunk())
     # collection.register_plugin(DynamicKerchunk())
@@ -194,7 +219,11 @@ async def start_all_datasets():
     #await set_custom_executor()
     if L_DASK:
         from dask.distributed import Client   
-        app.state.dask_client = Client(os.environ["ZARR_ADDRESS"])
+        # asynchronous, so that /zarr chunk requests await the cluster
+        # instead of blocking a thread each
+        app.state.dask_client = await Client(
+            os.environ["ZARR_ADDRESS"], asynchronous=True
+        )
     
 
 app.add_event_handler("startup", start_all_datasets)
@@ -1,9 +1,12 @@
 from typing import Dict, Any
+from functools import partial
+import asyncio
 import glob
 from tqdm import tqdm
 import xarray as xr
 from cloudify.utils.datasethelper import (
     #reset_encoding_get_mapper,
+    open_concurrently,
     open_zarr_and_mapper,
     adapt_for_zarr_plugin_and_stac,
     set_compression,
@@ -35,23 +38,29 @@ def add_cordexcmip6(
     
     dsone = None
     local_dsdict={}
-    for ini in tqdm(parquet_dirs):
+    chunks="auto"
+    if not l_dask:
+        chunks=None
+    opts=dict(
+        consolidated=False,
+        chunks=chunks,
+    )
+    loop = asyncio.get_running_loop()
+    opened = open_concurrently({
+        ini: partial(
+            open_zarr_and_mapper,
+            "reference::/"+ini,
+            storage_options=dict(cache_size=0,lazy=True,remote_protocol="file"),
+            loop=loop,
+            **opts
+        )
+        for ini in parquet_dirs
+    })
+    for ini, (ds, mapper) in tqdm(opened.items()):
         dsname='cordex-cmip6.'+'.'.join('.'.join(ini.split('/')[6:]).split('.')[:-1])
-        print(dsname)
         #if not "0819" in ini:
         #    continue
-        chunks="auto"
-        if not l_dask:
-            chunks=None
-        opts=dict(
-            consolidated=False,
-            chunks=chunks,
-        )                
-        ds, mapper_dict["reference::/"+ini] = open_zarr_and_mapper(
-                "reference::/"+ini, 
-                storage_options=dict(cache_size=0,lazy=True,remote_protocol="file"),
-                **opts
-                )
+        mapper_dict["reference::/"+ini] = mapper
         print(dsname)
             #mapper_dict, ds = reset_encoding_get_mapper(mapper_dict, dsname, ds, l_dask=l_dask)
         if l_dask:
@@ -1,7 +1,10 @@
 from typing import Dict, Any, Optional
+from functools import partial
+import asyncio
 from cloudify.utils.datasethelper import (
     reset_encoding_get_mapper, 
     adapt_for_zarr_plugin_and_stac, 
+    open_concurrently,
     open_zarr_and_mapper, 
     set_compression,
     apply_lossy_compression
@@ -71,13 +74,30 @@ def add_cosmorea(
         except Exception as e:
             raise ValueError(f"Failed to load base coordinates: {str(e)}")
 
-    # Process each dataset in the catalog
-    local_dsdict={}
+    chunks="auto"
+    if not l_dask:
+        chunks=None
+    loop = asyncio.get_running_loop()
+
+    def open_cosmorea(urlpath, storage_options):
+        ds, mapper = open_zarr_and_mapper(
+                urlpath,
+                storage_options=storage_options,
+                loop=loop,
+                drop_variables=drop_vars,
+                chunks=chunks,
+                consolidated=False
+                )
+        for onedim in onedims:
+            if onedim in ds.variables and "time" in ds[onedim].dims:
+                ds[onedim] = ds.reset_coords()[onedim].isel(time=0).load()
+        return ds, mapper
+
+    # Open each dataset in the catalog
+    openers = {}
+    urlpaths = {}
     for dsname in [a for a in cat.entries if not "parquet" in a]:
         print(dsname)
-        chunks="auto"
-        if not l_dask:
-            chunks=None
         desc = cat[dsname].to_dict()
         kwargs = desc.get("kwargs")
         args = kwargs.get("args")[0]
@@ -87,16 +107,13 @@ def add_cosmorea(
         storage_options["remote_protocol"] = "file"
         storage_options["cache_size"]=0
         dsid = "cosmo-rea-" + dsname            
-        ds, mapper = open_zarr_and_mapper(
-                urlpath,
-                storage_options=storage_options,
-                drop_variables=drop_vars,
-                chunks=chunks,
-                consolidated=False
-                )
-        for onedim in onedims:
-            if onedim in ds.variables and "time" in ds[onedim].dims:
-                ds[onedim] = ds.reset_coords()[onedim].isel(time=0).load()
+        openers[dsid] = partial(open_cosmorea, urlpath, storage_options)
+        urlpaths[dsid] = urlpath
+
+    # Process each dataset
+    local_dsdict={}
+    for dsid, (ds, mapper) in open_concurrently(openers).items():
+        urlpath = urlpaths[dsid]
         if l_dask:
             for l in ["latitude", "longitude"]:
                 ds.coords[l] = dsone[l]
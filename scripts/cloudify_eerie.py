@@ -11,6 +11,8 @@ from cloudify.utils.datasethelper import (
     gribscan_to_float,
     dotted_get
 )
+from cloudify.utils.codecbench import calibrate_codecs
+from cloudify.utils.bitinformation import get_keepbits
 import xarray as xr
 from cloudify.utils.statistics import (
     build_summary_df,
@@ -88,6 +90,14 @@ def add_eerie(
     # EERIE catalog path
     source_catalog = "/work/bm1344/DKRZ/intake_catalogues/dkrz/disk/main2.yaml"
     L_STATS = True
+    # Benchmark codecs per variable instead of using one for all, the
+    # choice is stored per dataset in CODEC_CALIBRATION_DIR
+    L_CALIBRATE_CODECS = False
+    CODEC_CALIBRATION_DIR = "/tmp/codec-calibration"
+    # Keepbits of the lossy rounding from the real information content of
+    # each variable instead of 10 for all, cached in KEEPBITS_DIR
+    L_KEEPBITS_FROM_INFORMATION = False
+    KEEPBITS_DIR = "/tmp/keepbits"
     try:
         cat = intake.open_catalog(source_catalog)
     except Exception as e:
@@ -221,7 +231,10 @@ def add_eerie(
             
             if not "grid" in dsid:
                 if "native" in dsid or "_11" in dsid or "_10" in dsid:
-                    ds = apply_lossy_compression(ds, l_dask)
+                    keepbits = None
+                    if L_KEEPBITS_FROM_INFORMATION:
+                        keepbits = get_keepbits(ds, dsid, KEEPBITS_DIR, inflevel=0.99)
+                    ds = apply_lossy_compression(ds, l_dask, keepbits)
 
             ds.encoding["source"]=urlpath
 
@@ -233,7 +246,12 @@ def add_eerie(
         #)
         ds = adapt_for_zarr_plugin_and_stac(dsid, ds)
         if l_dask:
-            ds = set_compression(ds)
+            codecs = None
+            if L_CALIBRATE_CODECS:
+                codecs = calibrate_codecs(
+                    ds, dsid, CODEC_CALIBRATION_DIR, policy="min_bytes", min_throughput=500
+                )
+            ds = set_compression(ds, codecs)
         dsdict[dsid] = ds
     del localdsdict
 
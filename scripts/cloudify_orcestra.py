@@ -1,9 +1,12 @@
 from typing import Dict, Any
+from functools import partial
+import asyncio
 import glob
 from tqdm import tqdm
 import xarray as xr
 from cloudify.utils.datasethelper import (
     #reset_encoding_get_mapper,
+    open_concurrently,
     open_zarr_and_mapper,
     adapt_for_zarr_plugin_and_stac,
     set_compression,
@@ -63,7 +66,17 @@ def add_orcestra(
     ]
     dsone = None
     local_dsdict={}
-    for ini in tqdm(init_dates_trunks):
+    chunks="auto"
+    if not l_dask:
+        chunks=None
+    opts=dict(
+        consolidated=True,
+        chunks=chunks,
+    )
+    loop = asyncio.get_running_loop()
+    openers = {}
+    dsnames = {}
+    for ini in init_dates_trunks:
         #if not "0819" in ini:
         #    continue
         init_date = ini.split("/")[-1]
@@ -72,29 +85,28 @@ def add_orcestra(
             dsname = f'{conf_dict["project_id"].lower()}.{conf_dict["source_id"]}.s2024-{init_date[0:2]}-{init_date[2:4]}_{dim}_PT10M_12'
             if dim == "3d":
                 dsname = dsname.replace("PT10M", "PT4H")
-            chunks="auto"
-            if not l_dask:
-                chunks=None
-            opts=dict(
-                consolidated=True,
-                chunks=chunks,
-            )                
-            ds, mapper_dict[dstrunk] = open_zarr_and_mapper(
-                dstrunk, storage_options=dict(cache_size=0),**opts
+            openers[dstrunk] = partial(
+                open_zarr_and_mapper,
+                dstrunk, storage_options=dict(cache_size=0), loop=loop, **opts
             )
-            if not dsone:
-                dsone = ds.copy()
-            ds["cell"] = dsone["cell"]
-            ds.attrs.update(conf_dict)
-            #print(ds.encoding["source"])
-            print(dsname)
-            #mapper_dict, ds = reset_encoding_get_mapper(mapper_dict, dsname, ds, l_dask=l_dask)
-            ds = adapt_for_zarr_plugin_and_stac(dsname, ds)
-            ds = set_compression(ds)
-            ds.encoding["source"]=dstrunk
-            dsdict[dsname] = ds
-            local_dsdict[dsname] = ds
-            
+            dsnames[dstrunk] = dsname
+
+    for dstrunk, (ds, mapper) in tqdm(open_concurrently(openers).items()):
+        dsname = dsnames[dstrunk]
+        mapper_dict[dstrunk] = mapper
+        if not dsone:
+            dsone = ds.copy()
+        ds["cell"] = dsone["cell"]
+        ds.attrs.update(conf_dict)
+        #print(ds.encoding["source"])
+        print(dsname)
+        #mapper_dict, ds = reset_encoding_get_mapper(mapper_dict, dsname, ds, l_dask=l_dask)
+        ds = adapt_for_zarr_plugin_and_stac(dsname, ds)
+        ds = set_compression(ds)
+        ds.encoding["source"]=dstrunk
+        dsdict[dsname] = ds
+        local_dsdict[dsname] = ds
+        
 
     df=build_summary_df(local_dsdict)
     df.to_csv("/tmp/orcestra_datasets.csv")
@@ -1,10 +1,13 @@
 from typing import Dict, Any
+from functools import partial
+import asyncio
 import glob
 from pathlib import Path
 from tqdm import tqdm
 import xarray as xr
 from cloudify.utils.datasethelper import (
     #reset_encoding_get_mapper,
+    open_concurrently,
     open_zarr_and_mapper,
     adapt_for_zarr_plugin_and_stac,
     set_compression,
@@ -61,15 +64,21 @@ def add_orcestra(
         for a in sorted(glob.glob(TRUNK + "/*.zarr"))
     ]
     local_dsdict={}
-    for ini in tqdm(init_dates_trunks):
+    chunks="auto"
+    if not l_dask:
+        chunks=None
+    loop = asyncio.get_running_loop()
+    opened = open_concurrently({
+        ini: partial(
+            open_zarr_and_mapper,
+            ini, storage_options=dict(cache_size=0), loop=loop, chunks=chunks
+        )
+        for ini in init_dates_trunks
+    })
+    for ini, (ds, mapper) in tqdm(opened.items()):
         print(ini)
         dsname = '.'.join(ini.split('/')[-1].split('.')[:-1])
-        chunks="auto"
-        if not l_dask:
-            chunks=None
-        ds, mapper_dict[ini] = open_zarr_and_mapper(
-            ini, storage_options=dict(cache_size=0),chunks=chunks
-        )
+        mapper_dict[ini] = mapper
         ds.attrs.update(conf_dict)
         ds = adapt_for_zarr_plugin_and_stac(dsname, ds)
         ds.encoding["source"]=ini
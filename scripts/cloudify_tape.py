@@ -3,7 +3,10 @@ import fsspec
 fsspec.register_implementation("hsm", HSMFileSystem)
 import xarray as xr
 from typing import Dict, Any, Optional
+from functools import partial
+import asyncio
 from cloudify.utils.datasethelper import (
+    open_concurrently,
     open_zarr_and_mapper,
 )
 
@@ -14,7 +17,8 @@ def add_tape(
 ) -> tuple[Dict[str, Any], Dict[str, xr.Dataset]]:
 
     urlpath="reference:://work/bm1344/DKRZ/kerchunks_pp_batched/ICON/hist-1950/v20240618/atmos_native_2d_1h_inst_hsm.parq"
-    dsdict["tape_test"], mapper_dict[urlpath] = open_zarr_and_mapper(
+    opened = open_concurrently({"tape_test": partial(
+            open_zarr_and_mapper,
             urlpath,
             storage_options=dict(
                 remote_protocol="hsm",
@@ -25,9 +29,13 @@ def add_tape(
                     asyncronous=True
                     )
                 ),
+            loop=asyncio.get_running_loop(),
             chunks="auto",
             consolidated=False
-            )
+            )})
+    if "tape_test" not in opened:
+        return mapper_dict, dsdict
+    dsdict["tape_test"], mapper_dict[urlpath] = opened["tape_test"]
     dsdict["tape_test"].attrs["from_tape"]="Yes"
     dsdict["tape_test"].encoding["source"]=urlpath
     return mapper_dict, dsdict    